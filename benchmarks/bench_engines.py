@@ -0,0 +1,75 @@
+# Connections held and messages/sec: thread-per-connection vs. asyncio vs. reactor engines.
+#   python benchmarks/bench_engines.py --connections 2000 --senders 20 --messages 500
+import argparse
+import threading
+import time
+
+from benchlib import LineClient, report, start_server
+
+
+def hold_connections(server, n):
+    clients = []
+    for i in range(n):
+        try:
+            c = LineClient(server.host, server.port)
+        except OSError:
+            break
+        c.send({'action': 'register', 'username': f'idle{i}'})
+        c.send({'action': 'login', 'username': f'idle{i}'})
+        clients.append(c)
+    held = 0
+    for c in clients:
+        try:
+            c.recv(); c.recv()
+            held += 1
+        except (OSError, ValueError):
+            pass
+    return clients, held
+
+
+def blast(server, senders, messages):
+    # Each sender messages itself: one delivery + one ack per message.
+    clients = [LineClient(server.host, server.port) for _ in range(senders)]
+    for i, c in enumerate(clients):
+        c.login(f'sender{i}')
+
+    def run(i, c):
+        payload = {'action': 'send_message', 'recipient': f'sender{i}', 'message': 'x' * 64}
+        for _ in range(messages):
+            c.send(payload)
+        for _ in range(messages * 2):
+            c.recv_line()
+
+    threads = [threading.Thread(target=run, args=(i, c)) for i, c in enumerate(clients)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+    for c in clients: c.close()
+    return senders * messages / elapsed
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--connections', type=int, default=2000)
+    ap.add_argument('--senders', type=int, default=20)
+    ap.add_argument('--messages', type=int, default=500)
+    ap.add_argument('--engines', nargs='+', default=['thread', 'asyncio', 'reactor'])
+    ap.add_argument('--reactors', type=int, default=4)
+    args = ap.parse_args()
+
+    rows = []
+    for engine in args.engines:
+        kwargs = {'reactors': args.reactors} if engine == 'reactor' else {}
+        server = start_server(engine=engine, **kwargs)
+        idle, held = hold_connections(server, args.connections)
+        threads_alive = threading.active_count()
+        rate = blast(server, args.senders, args.messages)
+        rows.append((engine, held, threads_alive, f"{rate:,.0f}"))
+        for c in idle: c.close()
+    report(f"{args.connections} idle connections, {args.senders} senders x {args.messages} msgs",
+           rows, ('engine', 'held', 'threads', 'msgs/sec'))
+
+
+if __name__ == '__main__':
+    main()
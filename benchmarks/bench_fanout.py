@@ -0,0 +1,57 @@
+# Per-recipient send_json vs. encode-once fanout for one group message.
+#   python benchmarks/bench_fanout.py
+import argparse
+import time
+
+from benchlib import ChatServer, report
+from common.protocol import WIRE_V1
+
+
+class NullConnection:
+    # Stand-in connection: accepts the bytes and keeps nothing
+    wire_version = WIRE_V1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    server = ChatServer()
+    payload = {
+        'type': 'group_message', 'group_id': 'group_1', 'group_name': 'Nhóm 1',
+        'sender': 'alice', 'message': 'Xin chào cả nhóm 👋 ' * 8,
+        'timestamp': '12:00', 'avatar': '😀'
+    }
+    rows = []
+    for n in args.sizes:
+        members = [NullConnection() for _ in range(n)]
+
+        def per_recipient():
+            for cli in members:
+                server.send_json(cli, payload)
+
+        def encode_once():
+            server.fanout(members, payload)
+
+        a = timed(per_recipient, args.repeat)
+        b = timed(encode_once, args.repeat)
+        rows.append((n, f"{a * 1e3:.3f}", f"{b * 1e3:.3f}", f"{a / b:.1f}x"))
+    report("group fanout, ms per message", rows, ('members', 'send_json', 'fanout', 'speedup'))
+
+
+if __name__ == '__main__':
+    main()
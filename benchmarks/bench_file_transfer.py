@@ -0,0 +1,65 @@
+# File relay throughput: v1 base64-in-JSON chunks vs. v2 binary chunk frames.
+# Both ends are real sockets through a running server, so the numbers include
+# the sender's encode, the server's relay and the receiver's decode.
+#   python benchmarks/bench_file_transfer.py --mb 64
+import argparse
+import base64
+import os
+import threading
+import time
+
+from benchlib import LineClient, V2Client, report, start_server
+
+CHUNK_SIZE = 48 * 1024
+
+
+def transfer(server, client_cls, total_mb):
+    sender = client_cls(server.host, server.port)
+    receiver = client_cls(server.host, server.port)
+    sender.login('sender'); receiver.login('receiver')
+    piece = os.urandom(CHUNK_SIZE)
+    count = total_mb * 1024 * 1024 // CHUNK_SIZE
+    tid = f"{int(time.time() * 1000)}_bench.bin"
+    v1 = client_cls is LineClient
+    received = [0]
+
+    def receive():
+        while True:
+            msg = receiver.recv()
+            if msg.get('type') == 'file_chunk':
+                data = msg['data']
+                received[0] += len(base64.b64decode(data) if isinstance(data, str) else data)
+            elif msg.get('type') == 'file_end':
+                return
+
+    t = threading.Thread(target=receive)
+    t0 = time.perf_counter()
+    t.start()
+    sender.send({'action': 'send_file_start', 'transfer_id': tid, 'filename': 'bench.bin',
+                 'total_size': count * CHUNK_SIZE, 'recipient': 'receiver'})
+    for seq in range(count):
+        data = base64.b64encode(piece).decode('ascii') if v1 else piece
+        sender.send({'action': 'send_file_chunk', 'transfer_id': tid, 'seq': seq,
+                     'data': data, 'recipient': 'receiver'})
+    sender.send({'action': 'send_file_end', 'transfer_id': tid, 'recipient': 'receiver'})
+    t.join()
+    elapsed = time.perf_counter() - t0
+    sender.close(); receiver.close()
+    assert received[0] == count * CHUNK_SIZE
+    return received[0] / elapsed / 1024 / 1024
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--mb', type=int, default=64)
+    ap.add_argument('--engine', default='thread')
+    args = ap.parse_args()
+    rows = []
+    for name, cls in (('v1 json+base64', LineClient), ('v2 binary', V2Client)):
+        server = start_server(engine=args.engine)
+        rows.append((name, f"{transfer(server, cls, args.mb):.1f}"))
+    report(f"{args.mb}MB private file, {args.engine} engine", rows, ('wire', 'MB/s'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Frames/sec: old str-buffer split vs. common.framing.FrameDecoder.
+#   python benchmarks/bench_framing.py
+import argparse
+import base64
+import json
+import os
+import time
+
+from benchlib import ROOT, report  # noqa: F401  (sets sys.path)
+from common.framing import FrameDecoder
+
+
+def old_split(stream, recv_size):
+    # The original handle_client loop: decode each recv, append, split
+    buffer = ""
+    frames = 0
+    for i in range(0, len(stream), recv_size):
+        buffer += stream[i:i + recv_size].decode('utf-8', errors='replace')
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            frames += 1
+    return frames
+
+
+def new_decoder(stream, recv_size):
+    decoder = FrameDecoder()
+    frames = 0
+    i = 0
+    while i < len(stream):
+        n = decoder.recv_size if recv_size is None else recv_size
+        chunk = stream[i:i + n]
+        i += n
+        decoder.adapt(len(chunk))
+        frames += len(decoder.feed(chunk))
+    return frames
+
+
+def timed(fn, *args):
+    t0 = time.perf_counter()
+    frames = fn(*args)
+    return frames / (time.perf_counter() - t0)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--small', type=int, default=200000, help="number of small chat frames")
+    ap.add_argument('--chunks', type=int, default=400, help="number of 64KB file chunk frames")
+    args = ap.parse_args()
+
+    small = (json.dumps({'action': 'send_message', 'recipient': 'bob',
+                         'message': 'Xin chào 👋'}) + "\n").encode('utf-8')
+    chunk = (json.dumps({'action': 'send_file_chunk', 'transfer_id': '1_file.bin', 'seq': 0,
+                         'data': base64.b64encode(os.urandom(48 * 1024)).decode('ascii'),
+                         'recipient': 'bob'}) + "\n").encode('utf-8')
+    rows = []
+    for name, frame, count in (('small chat', small, args.small), ('64KB chunk', chunk, args.chunks)):
+        stream = frame * count
+        rows.append((name, f"{timed(old_split, stream, 4096):,.0f}",
+                      f"{timed(new_decoder, stream, 4096):,.0f}",
+                      f"{timed(new_decoder, stream, None):,.0f}"))
+    report("frames/sec", rows, ('frames', 'str split (4KB)', 'decoder (4KB)', 'decoder (adaptive)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Server CPU per relayed MB of v1 file chunks: full json.loads/json.dumps
+# per chunk vs. the zero-parse relay of registered transfers.
+#   python benchmarks/bench_relay.py --mb 64
+import argparse
+import base64
+import json
+import os
+import time
+
+from benchlib import ChatServer, report
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+
+def setup(server, members):
+    sender = NullConnection()
+    for name in ['sender'] + [f'member{i}' for i in range(members)]:
+        cli = sender if name == 'sender' else NullConnection()
+        server.process_message(cli, {'action': 'register', 'username': name})
+        server.process_message(cli, {'action': 'login', 'username': name})
+    return sender
+
+
+def cpu_per_mb(fn, lines, payload_mb):
+    t0 = time.process_time()
+    for line in lines:
+        fn(line)
+    return (time.process_time() - t0) * 1000 / payload_mb
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--mb', type=int, default=64)
+    args = ap.parse_args()
+
+    server = ChatServer()
+    sender = setup(server, 1)
+    server.process_message(sender, {'action': 'send_file_start', 'transfer_id': 't1', 'filename': 'f.bin',
+                                    'total_size': args.mb << 20, 'recipient': 'member0'})
+    piece = base64.b64encode(os.urandom(48 * 1024)).decode('ascii')
+    count = (args.mb << 20) // (48 * 1024)
+    lines = [json.dumps({'action': 'send_file_chunk', 'transfer_id': 't1', 'seq': seq,
+                         'data': piece, 'recipient': 'member0'}).encode('utf-8') for seq in range(count)]
+
+    parsed = cpu_per_mb(lambda line: server.process_message(sender, json.loads(line)), lines, args.mb)
+    relayed = cpu_per_mb(lambda line: server.handle_frame(sender, line), lines, args.mb)
+    report(f"server CPU per relayed MB ({args.mb}MB private transfer)",
+           [('json.loads + json.dumps', f"{parsed:.2f}"), ('zero-parse relay', f"{relayed:.2f}"),
+            ('ratio', f"{parsed / relayed:.1f}x")], ('path', 'CPU ms/MB'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+# change_username latency with a large user/group population, for a user
+# with no ties and for a heavily connected one. Baselines, each on a copy of
+# the state: the original migration, which rewrote every contact and member
+# list and then scanned them all again for notice targets, and the
+# username-keyed rename with follower/group indexes that preceded uids.
+#   python benchmarks/bench_rename.py --users 100000 --groups 10000
+import argparse
+import random
+import time
+
+from benchlib import ChatServer, report
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def populate(users, groups, members, hot_groups, hot_followers):
+    # Everyone but the two measured users ('cold' and 'hot') is offline,
+    # so the numbers are the rename itself, not notification fanout.
+    server = ChatServer()
+    rng = random.Random(1)
+    cli = NullConnection()
+    for i in range(users):
+        server.register_user(cli, {'username': f'u{i}'})
+    for name in ('cold', 'hot'):
+        server.register_user(cli, {'username': name})
+    for g in range(groups):
+        owner = NullConnection()
+        server.login_user(owner, {'username': 'hot' if g < hot_groups else f'u{rng.randrange(users)}'})
+        server.create_group(owner, {'group_name': f'g{g}'})
+        gid = f'group_{g + 1}'
+        for uid in rng.sample(range(1, users + 1), members):
+            server.groups[gid]['members'].add(uid)
+            server._index_membership(uid, gid)
+        server.disconnect_client(owner)
+    for i in range(hot_followers):
+        follower = NullConnection()
+        server.login_user(follower, {'username': f'u{i}'})
+        server.add_contact(follower, {'username': 'hot'})
+        server.disconnect_client(follower)
+    return server
+
+
+def scan_state(server):
+    # The data as the original server kept it: lists of usernames
+    name = server._name
+    users = {u['username']: {'contacts': [name(c) for c in u['contacts']]} for u in server.users.values()}
+    groups = {gid: {'members': [name(m) for m in g['members']], 'admin': name(g['admin'])}
+              for gid, g in server.groups.items()}
+    return users, groups
+
+
+def scan_rename(state, old, new):
+    # The original change_username, minus sending the notices
+    users, groups = state
+    users[new] = users.pop(old)
+    for ud in users.values():
+        if old in ud['contacts']:
+            ud['contacts'] = [new if c == old else c for c in ud['contacts']]
+    for g in groups.values():
+        if old in g['members']:
+            g['members'] = [new if m == old else m for m in g['members']]
+            if g.get('admin') == old:
+                g['admin'] = new
+    targets = set()
+    for u, ud in users.items():
+        if (old in ud['contacts']) or (new in ud['contacts']):
+            targets.add(u)
+    for g in groups.values():
+        if new in g['members']:
+            for m in g['members']:
+                targets.add(m)
+    return targets
+
+
+def legacy_state(server):
+    # The same data keyed by username, as the server kept it before uids
+    name = server._name
+    users = {u['username']: {'contacts': {name(c) for c in u['contacts']}} for u in server.users.values()}
+    followers = {name(uid): {name(f) for f in fs} for uid, fs in server.followers.items()}
+    groups = {gid: {'members': {name(m) for m in g['members']}, 'admin': name(g['admin'])}
+              for gid, g in server.groups.items()}
+    user_groups = {name(uid): dict(gids) for uid, gids in server.user_groups.items()}
+    return users, followers, groups, user_groups
+
+
+def legacy_rename(state, old, new):
+    users, followers, groups, user_groups = state
+    users[new] = users.pop(old)
+    fs = followers.pop(old, set())
+    for f in fs:
+        contacts = users[new if f == old else f]['contacts']
+        contacts.discard(old)
+        contacts.add(new)
+    for c in users[new]['contacts']:
+        if c in followers:
+            followers[c].discard(old)
+            followers[c].add(new)
+    if fs:
+        followers[new] = {new if f == old else f for f in fs}
+    for gid in user_groups.get(old, ()):
+        g = groups[gid]
+        g['members'].discard(old)
+        g['members'].add(new)
+        if g['admin'] == old:
+            g['admin'] = new
+    if old in user_groups:
+        user_groups[new] = user_groups.pop(old)
+
+
+def per_op_us(fn, ops):
+    t0 = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - t0) / ops * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--users', type=int, default=100000)
+    ap.add_argument('--groups', type=int, default=10000)
+    ap.add_argument('--members', type=int, default=10, help="members per group")
+    ap.add_argument('--hot-groups', type=int, default=1000, help="groups the 'hot' user belongs to")
+    ap.add_argument('--hot-followers', type=int, default=10000, help="users with 'hot' as a contact")
+    ap.add_argument('--ops', type=int, default=200)
+    ap.add_argument('--scan-ops', type=int, default=10, help="renames timed for the full-scan baseline")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+    server = populate(args.users, args.groups, args.members, args.hot_groups, args.hot_followers)
+    print(f"populated {args.users:,} users / {args.groups:,} groups in {time.perf_counter() - t0:.1f}s")
+    scanned = scan_state(server)
+    state = legacy_state(server)
+
+    rows = []
+    for name, groups, followers in (('cold', 0, 0), ('hot', args.hot_groups, args.hot_followers)):
+        names = [name, name + '_']
+        scan = per_op_us(lambda i: scan_rename(scanned, names[i % 2], names[(i + 1) % 2]), args.scan_ops)
+        legacy = per_op_us(lambda i: legacy_rename(state, names[i % 2], names[(i + 1) % 2]), args.ops)
+        cli = NullConnection()
+        server.login_user(cli, {'username': name})
+        uid = per_op_us(lambda i: server.change_username(cli, {'new_username': names[(i + 1) % 2]}), args.ops)
+        # change_username also collects the online audience for its notices
+        audience = 2 * per_op_us(lambda i: server._audience(server.clients[cli]['uid']), args.ops)
+        rows.append((name, f"{groups:,}", f"{followers:,}", f"{scan:,.1f}", f"{legacy:,.1f}", f"{uid:,.1f}",
+                     f"{max(uid - audience, 0):,.1f}"))
+    report(f"microseconds per rename ({args.users:,} users, {args.groups:,} groups)", rows,
+           ('user', 'groups', 'followers', 'full scan', 'username index', 'change_username',
+            'minus audience scans'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+# Upload goodput through a local proxy that cuts the uploader's connection
+# every few MB (randomly, mean --kill-mb), with resume_transfer versus
+# starting the upload over after each cut. Goodput is file size over the
+# time until the receiver holds the complete, verified file.
+#   python benchmarks/bench_resume.py --mb 50 --kill-mb 20
+import argparse
+import base64
+import hashlib
+import os
+import random
+import socket
+import threading
+import time
+
+from benchlib import LineClient, V2Client, free_port, report, start_server
+from common.protocol import raw_bytes
+
+CHUNK = 48 * 1024
+
+
+class LossyProxy(threading.Thread):
+    # Forwards each accepted connection to the server and kills it after a
+    # random number of client->server bytes
+    def __init__(self, target, kill_bytes, seed=1):
+        super().__init__(daemon=True)
+        self.target = target
+        self.kill_bytes = kill_bytes
+        self.rng = random.Random(seed)
+        self.kills = 0
+        self.listener = socket.create_server(('127.0.0.1', free_port()))
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while True:
+            down, _ = self.listener.accept()
+            up = socket.create_connection(self.target)
+            budget = int(self.rng.expovariate(1 / self.kill_bytes)) if self.kill_bytes else None
+            threading.Thread(target=self.pump, args=(down, up, budget), daemon=True).start()
+            threading.Thread(target=self.pump, args=(up, down, None), daemon=True).start()
+
+    def pump(self, src, dst, budget):
+        try:
+            while True:
+                data = src.recv(262144)
+                if not data:
+                    break
+                if budget is not None:
+                    budget -= len(data)
+                    if budget < 0:
+                        self.kills += 1
+                        break
+                dst.sendall(data)
+        except OSError:
+            pass
+        for s in (src, dst):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+
+class Receiver(threading.Thread):
+    # Collects file chunks per transfer; done is set once a file_end arrives
+    # for a transfer whose chunks were contiguous from seq 0
+    def __init__(self, cli):
+        super().__init__(daemon=True)
+        self.cli = cli
+        self.files = {}
+        self.result = None
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            m = self.cli.recv()
+            kind = m.get('type')
+            if kind == 'file_start':
+                self.files[m['transfer_id']] = [0, hashlib.sha256()]
+            elif kind == 'file_chunk' and m['transfer_id'] in self.files:
+                state = self.files[m['transfer_id']]
+                assert m['seq'] == state[0], (m['seq'], state[0])
+                state[0] += 1
+                state[1].update(raw_bytes(m['data']))
+            elif kind == 'file_end' and not m.get('aborted') and m['transfer_id'] in self.files:
+                self.result = self.files[m['transfer_id']][1].digest()
+                self.done.set()
+
+
+def upload(port, payload, resume, wire, keep):
+    client_cls = V2Client if wire == 2 else LineClient
+    chunks = [payload[i:i + CHUNK] for i in range(0, len(payload), CHUNK)]
+    transfer_id = None
+    seq = 0
+    while True:
+        try:
+            cli = client_cls('127.0.0.1', port)
+            cli.send({'action': 'login', 'username': 'alice'})
+            assert cli.recv()['success']
+            if transfer_id is not None and resume:
+                cli.send({'action': 'resume_transfer', 'transfer_id': transfer_id})
+                reply = cli.recv()
+                while 'received_seq' not in reply and 'success' not in reply:
+                    reply = cli.recv()
+                if 'success' in reply:      # unknown: it completed, the final ack was lost
+                    return
+                seq = reply['received_seq'] + 1
+            else:
+                transfer_id = os.urandom(8).hex()
+                seq = 0
+                cli.send({'action': 'send_file_start', 'transfer_id': transfer_id, 'filename': 'f',
+                          'total_size': len(payload), 'recipient': 'bob', 'chunk_size': CHUNK})
+            while seq < len(chunks):
+                data = chunks[seq] if wire == 2 else base64.b64encode(chunks[seq]).decode('ascii')
+                cli.send({'action': 'send_file_chunk', 'transfer_id': transfer_id, 'seq': seq, 'data': data})
+                seq += 1
+            cli.send({'action': 'send_file_end', 'transfer_id': transfer_id, 'recipient': 'bob'})
+            while not cli.recv().get('complete'):
+                pass
+            keep.append(cli)
+            return
+        except (OSError, ConnectionError, AssertionError):
+            time.sleep(0.01)
+
+
+def run(mb, kill_mb, resume, wire, timeout):
+    server = start_server()
+    setup = LineClient(server.host, server.port)
+    setup.send({'action': 'register', 'username': 'alice'})
+    setup.recv()
+    bob = LineClient(server.host, server.port)
+    bob.login('bob')
+    receiver = Receiver(bob)
+    receiver.start()
+    proxy = LossyProxy((server.host, server.port), int(kill_mb * 1024 * 1024))
+    proxy.start()
+    payload = random.Random(2).randbytes(mb * 1024 * 1024)
+
+    t0 = time.perf_counter()
+    keep = []
+    threading.Thread(target=upload, args=(proxy.port, payload, resume, wire, keep), daemon=True).start()
+    finished = receiver.done.wait(timeout)
+    elapsed = time.perf_counter() - t0
+    server.running = False
+    if not finished:
+        return f"> {timeout}s", '-', proxy.kills
+    assert receiver.result == hashlib.sha256(payload).digest()
+    return f"{mb / elapsed:.1f}", f"{elapsed:.2f}", proxy.kills
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--mb', type=int, default=50)
+    ap.add_argument('--kill-mb', type=float, default=20, help="mean MB uploaded between connection kills")
+    ap.add_argument('--wire', type=int, choices=(1, 2), default=1)
+    ap.add_argument('--timeout', type=float, default=60)
+    args = ap.parse_args()
+
+    rows = []
+    for label, kill_mb, resume in (('no kills', 0, True),
+                                   ('kills, resume_transfer', args.kill_mb, True),
+                                   ('kills, restart upload', args.kill_mb, False)):
+        goodput, elapsed, kills = run(args.mb, kill_mb, resume, args.wire, args.timeout)
+        rows.append((label, goodput, elapsed, kills))
+    report(f"upload goodput, {args.mb}MB file over a lossy proxy "
+           f"(mean {args.kill_mb}MB between kills, wire v{args.wire})",
+           rows, ('mode', 'MB/s', 'seconds', 'kills'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# search_users latency: the old scan over every user (reproduced here,
+# unbounded) vs. one page from the search index.
+#   python benchmarks/bench_search.py --users 100000 1000000
+import argparse
+import random
+import time
+
+from benchlib import ChatServer, report
+
+SYLLABLES = ('ka', 'lo', 'mi', 'ra', 'ne', 'to', 'su', 'el', 'an', 'jo', 'vi', 'de', 'ba', 'or')
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+
+def populate(n):
+    server = ChatServer()
+    rng = random.Random(1)
+    cli = NullConnection()
+    for i in range(n):
+        name = ''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + str(i)
+        server.register_user(cli, {'username': name})
+    return server
+
+
+def scan_search(server, query):
+    # What search_users did before the index
+    query = query.lower()
+    results = []
+    for user_data in server.users.values():
+        username = user_data['username']
+        if query in username.lower() or query in user_data['profile']['nickname'].lower():
+            results.append({
+                'username': username,
+                'nickname': user_data['profile']['nickname'],
+                'avatar': user_data['profile']['avatar'],
+                'status': user_data['status']
+            })
+    return results
+
+
+def per_op_ms(fn, ops):
+    t0 = time.perf_counter()
+    for _ in range(ops):
+        fn()
+    return (time.perf_counter() - t0) / ops * 1e3
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--users', type=int, nargs='+', default=[100000, 1000000])
+    ap.add_argument('--limit', type=int, default=50)
+    args = ap.parse_args()
+
+    for n in args.users:
+        t0 = time.perf_counter()
+        server = populate(n)
+        print(f"populated {n:,} users in {time.perf_counter() - t0:.1f}s")
+        exact = server._name(n // 2)
+        queries = (('exact', exact), ('1 char', 'k'), ('1 char, no match', 'q'),
+                   ('2 chars, no match', 'qz'), ('prefix', 'kalo'),
+                   ('substring', 'rajo'), ('rare', 'vijo' + str(n - 1)[-3:]), ('no match', 'qqq'))
+        rows = []
+        for label, query in queries:
+            matches = len(scan_search(server, query))
+            scan = per_op_ms(lambda: scan_search(server, query), 3)
+            page = per_op_ms(lambda: server.search_index.search(query, args.limit), 50)
+            uids, cursor = server.search_index.search(query, args.limit)
+            second = per_op_ms(lambda: server.search_index.search(query, args.limit, cursor), 50) if cursor else 0
+            rows.append((label, repr(query), f"{matches:,}", f"{scan:,.1f}", f"{page:.3f}", f"{second:.3f}"))
+        report(f"milliseconds per query, {n:,} users (page = {args.limit} results)", rows,
+               ('query', 'text', 'matches', 'full scan', 'first page', 'next page'))
+
+
+if __name__ == '__main__':
+    main()
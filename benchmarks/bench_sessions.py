@@ -0,0 +1,72 @@
+# Delivery cost vs. number of online users: the old linear scan over
+# self.clients (reproduced here) vs. the username -> sessions index.
+#   python benchmarks/bench_sessions.py --users 1000 10000 50000
+import argparse
+import time
+
+from benchlib import ChatServer, report
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+
+def populate(n):
+    server = ChatServer()
+    conns = []
+    for i in range(n):
+        cli = NullConnection()
+        server.register_user(cli, {'username': f'u{i}'})
+        server.login_user(cli, {'username': f'u{i}'})
+        conns.append(cli)
+    return server, conns
+
+
+def linear_find(server, username):
+    # What _find_client / send_private_message did before the index
+    for cli, cd in server.clients.items():
+        if cd['username'] == username:
+            return cli
+    return None
+
+
+def per_op_us(fn, ops):
+    t0 = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return (time.perf_counter() - t0) / ops * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 50000])
+    ap.add_argument('--group', type=int, default=100, help="members in the broadcast group")
+    args = ap.parse_args()
+
+    rows = []
+    for n in args.users:
+        server, conns = populate(n)
+        sender = conns[0]
+        server.create_group(sender, {'group_name': 'g'})
+        members = [f'u{i}' for i in range(0, n, max(1, n // args.group))][:args.group]
+        for m in members[1:]:
+            server.join_group(conns[int(m[1:])], {'group_id': 'group_1'})
+        ops = 200
+
+        scan = per_op_us(lambda i: linear_find(server, f'u{n - 1 - i % 50}'), ops)
+        index = per_op_us(lambda i: server._sessions_of([server.user_ids[f'u{n - 1 - i % 50}']]), ops)
+        pm = per_op_us(lambda i: server.send_private_message(
+            sender, {'recipient': f'u{n - 1 - i % 50}', 'message': 'hi'}), ops)
+        scan_group = per_op_us(lambda i: [linear_find(server, m) for m in members], 5)
+        group = per_op_us(lambda i: server.send_group_message(
+            sender, {'group_id': 'group_1', 'message': 'hi'}), ops)
+        rows.append((n, f"{scan:.1f}", f"{index:.2f}", f"{pm:.1f}", f"{scan_group:,.0f}", f"{group:.1f}"))
+    report(f"microseconds per operation ({args.group}-member group)", rows,
+           ('online', 'scan lookup', 'index lookup', 'private msg', 'scan group', 'group msg'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# Registrations/sec and contact updates/sec through the handlers with no
+# persistence, with the write-behind SQLite store, and with a write-through
+# variant that commits every statement before the handler returns.
+#   python benchmarks/bench_storage.py --users 20000 --contacts 100000
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from benchlib import ChatServer, report
+from storage import MemoryStore, SQLiteStore
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class WriteThroughStore(SQLiteStore):
+    # What a naive synchronous store would cost: one fsync'd commit per write
+    def __init__(self, path):
+        super().__init__(path)
+        self.db.execute('PRAGMA synchronous=FULL')
+
+    def _submit(self, sql, params):
+        self.db.execute(sql, params)
+        self.committed += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+
+def run(make_store, users, contacts):
+    store = make_store()
+    server = ChatServer(store=store)
+    rng = random.Random(1)
+    conns = [NullConnection() for _ in range(users)]
+
+    t0 = time.perf_counter()
+    for i, cli in enumerate(conns):
+        server.register_user(cli, {'username': f'u{i}'})
+    reg = time.perf_counter() - t0
+    store.flush()
+    reg_durable = time.perf_counter() - t0
+
+    for i, cli in enumerate(conns):
+        server.login_user(cli, {'username': f'u{i}'})
+    pairs = [(rng.randrange(users), f'u{rng.randrange(users)}') for _ in range(contacts)]
+    t0 = time.perf_counter()
+    for i, (who, other) in enumerate(pairs):
+        action = server.remove_contact if i % 4 == 3 else server.add_contact
+        action(conns[who], {'username': other})
+    upd = time.perf_counter() - t0
+    store.flush()
+    upd_durable = time.perf_counter() - t0
+    store.close()
+    return users / reg, users / reg_durable, contacts / upd, contacts / upd_durable
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--users', type=int, default=20000)
+    ap.add_argument('--contacts', type=int, default=100000, help="add/remove_contact calls")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        variants = (
+            ('memory (no persistence)', MemoryStore),
+            ('sqlite write-behind', lambda: SQLiteStore(os.path.join(tmp, 'behind.db'))),
+            ('sqlite write-through', lambda: WriteThroughStore(os.path.join(tmp, 'through.db'))),
+        )
+        rows = []
+        for label, make in variants:
+            reg, reg_d, upd, upd_d = run(make, args.users, args.contacts)
+            rows.append((label, f"{reg:,.0f}", f"{reg_d:,.0f}", f"{upd:,.0f}", f"{upd_d:,.0f}"))
+    finally:
+        shutil.rmtree(tmp)
+    report(f"operations/sec ({args.users:,} registrations, {args.contacts:,} contact updates)", rows,
+           ('store', 'register', 'register+flush', 'contacts', 'contacts+flush'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# How late the client's UI event loop runs while a file comes in: chunks
+# decoded and written on the network thread (what ChatClient does) versus
+# each chunk posted to the UI thread with root.after (the old dispatch).
+# The UI thread is a stand-in for Tk's after queue, so this runs without a
+# display; a 10ms ticker on it records how late each tick fires. The server
+# and the sender run in a child process, so the client's threads only
+# compete with each other for the GIL, as in the real client.
+#   python benchmarks/bench_ui_latency.py --mb 100 --wire 1
+import argparse
+import base64
+import heapq
+import multiprocessing
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+
+from benchlib import ROOT, LineClient, V2Client, report, start_server
+from common.flow import SendWindow
+
+sys.path.insert(0, os.path.join(ROOT, 'client'))
+import client_final  # noqa: E402
+
+CHUNK = client_final.CHUNK_SIZE
+TICK = 0.010
+
+
+class EventLoop:
+    # root.after() and mainloop() for a thread standing in for Tk
+    def __init__(self):
+        self.queue = []     # heap of (due, order, fn, args)
+        self.order = 0
+        self.cond = threading.Condition()
+        self.running = True
+        self.late = []      # seconds each tick fired after it was due
+        self.callbacks = 0
+
+    def after(self, ms, fn, *args):
+        with self.cond:
+            self.order += 1
+            heapq.heappush(self.queue, (time.perf_counter() + ms / 1000, self.order, fn, args))
+            self.cond.notify()
+
+    def tick(self, due):
+        # Ticks stay on a fixed grid, so one late tick does not shift the rest
+        now = time.perf_counter()
+        self.late.append(now - due)
+        while due <= now:
+            due += TICK
+        self.after((due - now) * 1000, self.tick, due)
+
+    def mainloop(self):
+        self.after(TICK * 1000, self.tick, time.perf_counter() + TICK)
+        while self.running:
+            with self.cond:
+                while self.running and (not self.queue or self.queue[0][0] > time.perf_counter()):
+                    self.cond.wait(self.queue[0][0] - time.perf_counter() if self.queue else None)
+                if not self.running:
+                    return
+                _, _, fn, args = heapq.heappop(self.queue)
+            fn(*args)
+            self.callbacks += 1
+
+
+class HeadlessClient(client_final.ChatClient):
+    # ChatClient's network side without its Tk widgets; transfer rows and
+    # the file button only count what reached the UI thread
+    def __init__(self, root, host, port, on_ui_thread):
+        self.root = root
+        self.on_ui_thread = on_ui_thread
+        self.send_lock = threading.Lock()
+        self.incoming_files = {}
+        self.outgoing_files = {}
+        self.resume_replies = {}
+        self.download_dir = None
+        self.uploader = None
+        self.resuming = False
+        self.current_chat = 'private:alice'
+        self.done = threading.Event()
+        self.progress_events = 0
+        self.client = socket.create_connection((host, port))
+        self.connected = True
+        self.negotiate_protocol()
+        threading.Thread(target=self.listen_for_messages, daemon=True).start()
+        self.send_message({'action': 'login', 'username': 'bob'})
+
+    def process_incoming_message(self, data):
+        kind = data.get('type', '')
+        if self.on_ui_thread and kind.startswith('file_') and kind != 'file_credit':
+            handler = {'file_start': self.handle_file_start, 'file_chunk': self.handle_file_chunk,
+                       'file_end': self.handle_file_end}.get(kind)
+            if handler:
+                self.root.after(0, handler, data)
+            return
+        super().process_incoming_message(data)
+
+    def show_main_interface(self, profile):
+        pass
+
+    def show_incoming(self, info):
+        pass
+
+    def update_incoming_progress(self, info, received):
+        self.progress_events += 1
+
+    def finish_incoming(self, info, error=None, aborted=False):
+        self.done.set()
+
+
+def upload(cli, chunks, window):
+    def listen():
+        try:
+            while True:
+                m = cli.recv()
+                if m.get('type') == 'file_ack':
+                    window.on_ack(m['seq'])
+                elif m.get('type') == 'file_credit':
+                    window.on_credit(m.get('seq'))
+        except (ConnectionError, OSError):
+            pass
+    threading.Thread(target=listen, daemon=True).start()
+    piece = os.urandom(CHUNK)
+    data = piece if isinstance(cli, V2Client) else base64.b64encode(piece).decode('ascii')
+    cli.send({'action': 'send_file_start', 'transfer_id': 't', 'filename': 'f', 'recipient': 'bob',
+              'total_size': chunks * CHUNK, 'chunk_size': CHUNK})
+    for seq in range(chunks):
+        window.wait(seq)
+        cli.send({'action': 'send_file_chunk', 'transfer_id': 't', 'seq': seq, 'data': data})
+    cli.send({'action': 'send_file_end', 'transfer_id': 't', 'recipient': 'bob'})
+
+
+def serve(mb, wire, ports, go):
+    # Child process: the server, and alice's upload once bob is logged in
+    server = start_server()
+    setup = LineClient(server.host, server.port)
+    setup.send({'action': 'register', 'username': 'bob'})
+    setup.recv()
+    alice = (V2Client if wire == 2 else LineClient)(server.host, server.port)
+    alice.login('alice')
+    ports.put(server.port)
+    go.wait()
+    upload(alice, mb * 1024 * 1024 // CHUNK, SendWindow(CHUNK))
+    threading.Event().wait()    # terminated by the parent
+
+
+def run(mb, wire, on_ui_thread):
+    ports, go = multiprocessing.Queue(), multiprocessing.Event()
+    child = multiprocessing.Process(target=serve, args=(mb, wire, ports, go), daemon=True)
+    child.start()
+    port = ports.get()
+    client_final.SUPPORTED_VERSIONS = (1, 2) if wire == 2 else (1,)
+    loop = EventLoop()
+    threading.Thread(target=loop.mainloop, daemon=True).start()
+    bob = HeadlessClient(loop, '127.0.0.1', port, on_ui_thread)
+    time.sleep(0.2)     # logged in
+
+    t0 = time.perf_counter()
+    loop.late.clear()
+    callbacks = loop.callbacks
+    go.set()
+    bob.done.wait()
+    elapsed = time.perf_counter() - t0
+    late = sorted(loop.late) or [0]
+    callbacks = loop.callbacks - callbacks - len(loop.late)
+    loop.running = False
+    with loop.cond:
+        loop.cond.notify()
+    child.terminate()
+    bob.client.close()
+    shutil.rmtree(bob.download_dir, ignore_errors=True)
+    ms = lambda q: f"{late[min(len(late) - 1, int(q * len(late)))] * 1000:.1f}"
+    return (f"{elapsed:.2f}", ms(0.5), ms(0.99), f"{late[-1] * 1000:.1f}", f"{callbacks:,}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--mb', type=int, default=100)
+    ap.add_argument('--wire', type=int, choices=(1, 2), default=1)
+    args = ap.parse_args()
+    rows = [(label,) + run(args.mb, args.wire, on_ui_thread)
+            for label, on_ui_thread in (('chunks on UI thread', True), ('chunks on network thread', False))]
+    report(f"UI event-loop lateness while receiving {args.mb}MB (wire v{args.wire}, {TICK * 1000:.0f}ms ticker)",
+           rows, ('dispatch', 'seconds', 'p50 ms', 'p99 ms', 'max ms', 'UI callbacks'))
+
+
+if __name__ == '__main__':
+    main()
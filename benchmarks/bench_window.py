@@ -0,0 +1,132 @@
+# A fast sender uploading to a receiver that consumes chunks at --rate MB/s
+# (and to one that doesn't throttle), with no flow control, fixed credit
+# windows and the auto-tuned SendWindow (common/flow.py). Reports the
+# upload time, the peak server-side queue for the receiver, and whether
+# the receiver was disconnected for overflowing that queue.
+#   python benchmarks/bench_window.py --mb 20 --rate 4
+import argparse
+import base64
+import threading
+import time
+
+from benchlib import LineClient, report, start_server
+from common.flow import SendWindow
+from common.protocol import raw_bytes
+
+CHUNK = 48 * 1024
+CREDIT_EVERY = 4
+
+
+class Unlimited:
+    # No flow control: every chunk may go at once
+    size = '-'
+
+    def wait(self, seq, timeout=None):
+        return True
+
+    def on_ack(self, seq):
+        pass
+
+    def on_credit(self, seq):
+        pass
+
+
+def receive(cli, chunks, rate, done):
+    # Consume at `rate` bytes/s, granting credit like ChatClient does
+    start = time.perf_counter()
+    consumed = 0
+    try:
+        while consumed < chunks:
+            m = cli.recv()
+            if m.get('type') == 'file_start':
+                cli.send({'action': 'file_credit', 'transfer_id': m['transfer_id'],
+                          'sender': m['sender'], 'seq': -1})
+            if m.get('type') != 'file_chunk':
+                continue
+            raw_bytes(m['data'])
+            consumed += 1
+            if rate:
+                delay = start + consumed * CHUNK / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if (m['seq'] + 1) % CREDIT_EVERY == 0 or consumed == chunks:
+                cli.send({'action': 'file_credit', 'transfer_id': m['transfer_id'],
+                          'sender': m['sender'], 'seq': m['seq']})
+        done.append('ok')
+    except ConnectionError:
+        done.append('disconnected')
+
+
+def listen(cli, window):
+    try:
+        while True:
+            m = cli.recv()
+            if m.get('type') == 'file_ack':
+                window.on_ack(m['seq'])
+            elif m.get('type') == 'file_credit':
+                window.on_credit(m.get('seq'))
+    except (ConnectionError, OSError):
+        pass
+
+
+def run(engine, mb, rate, window):
+    server = start_server(engine=engine)
+    alice = LineClient(server.host, server.port)
+    alice.login('alice')
+    bob = LineClient(server.host, server.port)
+    bob.login('bob')
+    bob_conn = next(iter(server.sessions[server.user_ids['bob']]))
+    chunks = mb * 1024 * 1024 // CHUNK
+    data = base64.b64encode(b'x' * CHUNK).decode('ascii')
+
+    done = []
+    peak = [0]
+    receiver = threading.Thread(target=receive, args=(bob, chunks, rate, done), daemon=True)
+    receiver.start()
+    threading.Thread(target=listen, args=(alice, window), daemon=True).start()
+
+    def sample():
+        while not done:
+            peak[0] = max(peak[0], bob_conn.queue_depth())
+            time.sleep(0.002)
+    threading.Thread(target=sample, daemon=True).start()
+
+    t0 = time.perf_counter()
+    alice.send({'action': 'send_file_start', 'transfer_id': 't', 'filename': 'f',
+                'total_size': chunks * CHUNK, 'recipient': 'bob'})
+    for seq in range(chunks):
+        while not window.wait(seq, 1.0):
+            if done:
+                break
+        alice.send({'action': 'send_file_chunk', 'transfer_id': 't', 'seq': seq, 'data': data})
+    sent = time.perf_counter() - t0
+    receiver.join()
+    elapsed = time.perf_counter() - t0
+    server.running = False
+    alice.close()
+    bob.close()
+    return (f"{sent:.2f}", f"{elapsed:.2f}", f"{peak[0] / 1024:,.0f}", done[0], window.size)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--mb', type=int, default=20)
+    ap.add_argument('--rate', type=float, default=4, help="slow receiver speed, MB/s")
+    ap.add_argument('--engine', choices=('thread', 'asyncio', 'reactor'), default='thread')
+    args = ap.parse_args()
+
+    variants = (
+        ('no flow control', Unlimited),
+        ('fixed window 8', lambda: SendWindow(CHUNK, initial=8, minimum=8, maximum=8)),
+        ('fixed window 128', lambda: SendWindow(CHUNK, initial=128, minimum=128, maximum=128)),
+        ('auto window', lambda: SendWindow(CHUNK)),
+    )
+    headers = ('flow control', 'send s', 'total s', 'peak queue KB', 'receiver', 'final window')
+    for label, rate in ((f"slow receiver ({args.rate:g} MB/s)", args.rate * 1024 * 1024),
+                        ("unthrottled receiver", 0)):
+        rows = [(name,) + run(args.engine, args.mb, rate, make()) for name, make in variants]
+        report(f"{args.mb}MB upload, {label}, {args.engine} engine", rows, headers)
+
+
+if __name__ == '__main__':
+    main()
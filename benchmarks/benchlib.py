@@ -0,0 +1,104 @@
+# Small helpers shared by the benchmark scripts (not used by the app itself)
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+from ChatServer import ChatServer  # noqa: E402
+from common.protocol import V2Decoder, decode_v2, encode_v2  # noqa: E402
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def start_server(**kwargs):
+    """Run a ChatServer on a free local port in a daemon thread."""
+    server = ChatServer('127.0.0.1', free_port(), **kwargs)
+    t = threading.Thread(target=server.start_server, daemon=True)
+    t.start()
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        try:
+            socket.create_connection((server.host, server.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.05)
+    return server
+
+
+class LineClient:
+    """Minimal blocking NDJSON client."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = b''
+
+    def send(self, obj):
+        self.sock.sendall((json.dumps(obj) + "\n").encode('utf-8'))
+
+    def send_raw(self, data):
+        self.sock.sendall(data)
+
+    def recv_line(self):
+        while b'\n' not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('closed')
+            self.buf += chunk
+        line, self.buf = self.buf.split(b'\n', 1)
+        return line
+
+    def recv(self):
+        return json.loads(self.recv_line())
+
+    def login(self, username):
+        self.send({'action': 'register', 'username': username})
+        self.send({'action': 'login', 'username': username})
+        self.recv()
+        return self.recv()
+
+    def close(self):
+        self.sock.close()
+
+
+class V2Client(LineClient):
+    """Blocking client that negotiates wire v2 right after connecting."""
+
+    def __init__(self, host, port):
+        super().__init__(host, port)
+        super().send({'action': 'hello', 'versions': [1, 2]})
+        reply = super().recv()
+        assert reply.get('version') == 2, reply
+        self.decoder = V2Decoder()
+        self.decoder.buffer += self.buf
+        self.frames = []
+
+    def send(self, obj):
+        self.sock.sendall(encode_v2(obj))
+
+    def recv(self):
+        while not self.frames:
+            chunk = self.sock.recv(262144)
+            if not chunk:
+                raise ConnectionError('closed')
+            self.frames = self.decoder.feed(chunk)
+        return decode_v2(self.frames.pop(0))
+
+
+def report(title, rows, headers):
+    print(f"\n{title}")
+    widths = [max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)]
+    print('  '.join(str(h).rjust(w) for h, w in zip(headers, widths)))
+    for r in rows:
+        print('  '.join(str(c).rjust(w) for c, w in zip(r, widths)))
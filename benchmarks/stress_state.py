@@ -0,0 +1,167 @@
+# Concurrency stress test for the server state: hundreds of threads, each
+# acting as one client socket, register/login/join/leave/rename/message/
+# disconnect at random through process_message, the way thread-engine reader
+# threads do. Afterwards every index is checked against the others and the
+# per-action error counts must be zero.
+#   python benchmarks/stress_state.py --threads 300 --ops 2000
+import argparse
+import random
+import sys
+import threading
+import time
+
+from benchlib import ChatServer
+
+
+class NullConnection:
+    wire_version = 1
+
+    def send(self, data, droppable=False):
+        return len(data)
+
+    def queue_depth(self):
+        return 0
+
+    def call_soon(self, fn):
+        fn()
+
+    def close(self):
+        pass
+
+
+def worker(server, index, users, groups, ops, seed, failures):
+    rng = random.Random(seed)
+    process = server.process_message
+    cli = NullConnection()
+    name = f'u{index}'
+    try:
+        process(cli, {'action': 'register', 'username': name})
+        process(cli, {'action': 'login', 'username': name})
+        for i in range(ops):
+            other = f'u{rng.randrange(users)}'
+            gid = f'group_{rng.randrange(1, groups + 1)}'
+            roll = rng.random()
+            if roll < 0.15:
+                process(cli, {'action': 'send_message', 'recipient': other, 'message': 'hi'})
+            elif roll < 0.30:
+                process(cli, {'action': 'send_group_message', 'group_id': gid, 'message': 'hi'})
+            elif roll < 0.40:
+                process(cli, {'action': 'join_group', 'group_id': gid})
+            elif roll < 0.47:
+                process(cli, {'action': 'leave_group', 'group_id': gid})
+            elif roll < 0.55:
+                process(cli, {'action': 'add_contact', 'username': other})
+            elif roll < 0.60:
+                process(cli, {'action': 'remove_contact', 'username': other})
+            elif roll < 0.65:
+                process(cli, {'action': 'add_friend_to_group', 'group_id': gid, 'friend': other})
+            elif roll < 0.70:
+                # rename away and back so other threads keep finding this user
+                process(cli, {'action': 'change_username', 'new_username': f'{name}_{i}'})
+                process(cli, {'action': 'change_username', 'new_username': name})
+            elif roll < 0.75:
+                process(cli, {'action': 'update_profile', 'profile': {'nickname': f'nick{rng.randrange(100)}'}})
+            elif roll < 0.80:
+                process(cli, {'action': 'update_status', 'status': rng.choice(('online', 'away'))})
+            elif roll < 0.85:
+                process(cli, {'action': 'search_users', 'query': f'u{rng.randrange(10)}', 'limit': 10})
+            elif roll < 0.90:
+                process(cli, {'action': rng.choice(('get_contacts', 'get_groups'))})
+            elif roll < 0.95:
+                # drop this socket and come back on a new one
+                server.disconnect_client(cli)
+                cli = NullConnection()
+                process(cli, {'action': 'login', 'username': name})
+            else:
+                # a second session for the same user
+                extra = NullConnection()
+                process(extra, {'action': 'login', 'username': name})
+                process(extra, {'action': 'send_message', 'recipient': other, 'message': 'hi'})
+                server.disconnect_client(extra)
+        server.disconnect_client(cli)
+    except Exception as e:
+        failures.append(f'thread {index}: {e!r}')
+
+
+def check(server):
+    # Every derived index must agree with the data it was derived from
+    problems = []
+    for uid, user in server.users.items():
+        if server.user_ids.get(user['username']) != uid:
+            problems.append(f'user_ids does not map {user["username"]!r} to {uid}')
+        for contact in user['contacts']:
+            if uid not in server.followers.get(contact, ()):
+                problems.append(f'{uid} has contact {contact} but is not among its followers')
+    if len(server.user_ids) != len(server.users):
+        problems.append(f'{len(server.user_ids)} names for {len(server.users)} users')
+    for uid, followers in server.followers.items():
+        for follower in followers:
+            if uid not in server.users[follower]['contacts']:
+                problems.append(f'{follower} follows {uid} without the contact')
+    for uid, user in server.users.items():
+        terms = server.search_index.terms.get(uid, ())
+        if user['username'].lower() not in terms:
+            problems.append(f'search index has stale names for {uid}: {terms}')
+    for gid, group in server.groups.items():
+        for uid in group['members']:
+            if gid not in server.user_groups.get(uid, ()):
+                problems.append(f'{uid} in {gid} members but not in user_groups')
+        online = set()
+        for uid in group['members']:
+            online.update(server.sessions.get(uid, ()))
+        if online != group['online']:
+            problems.append(f'{gid} online set has {len(group["online"])} sockets, members have {len(online)}')
+    for uid, gids in server.user_groups.items():
+        for gid in gids:
+            if uid not in server.groups[gid]['members']:
+                problems.append(f'user_groups lists {gid} for non-member {uid}')
+    if server.clients or server.sessions:
+        problems.append(f'{len(server.clients)} clients / {len(server.sessions)} sessions left after disconnects')
+    for action, stats in server.action_stats.snapshot().items():
+        if stats['errors']:
+            problems.append(f'{action}: {stats["errors"]} errors')
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--threads', type=int, default=300)
+    ap.add_argument('--ops', type=int, default=2000, help="operations per thread")
+    ap.add_argument('--groups', type=int, default=20)
+    ap.add_argument('--seed', type=int, default=1)
+    args = ap.parse_args()
+
+    # Switch threads far more often than the default 5ms to shake out races
+    sys.setswitchinterval(1e-5)
+    server = ChatServer()
+    founder = NullConnection()
+    server.register_user(founder, {'username': 'founder'})
+    server.login_user(founder, {'username': 'founder'})
+    for g in range(args.groups):
+        server.create_group(founder, {'group_name': f'g{g}'})
+    server.disconnect_client(founder)
+
+    failures = []
+    threads = [threading.Thread(target=worker, args=(server, i, args.threads, args.groups,
+                                                     args.ops, args.seed * 100003 + i, failures))
+               for i in range(args.threads)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t0
+
+    problems = failures + check(server)
+    total = sum(s['count'] for s in server.action_stats.snapshot().values())
+    print(f"{args.threads} threads, {total:,} actions in {elapsed:.1f}s ({total / elapsed:,.0f}/s)")
+    for p in problems[:20]:
+        print('  FAIL', p)
+    if problems:
+        print(f"{len(problems)} problems")
+        sys.exit(1)
+    print("state consistent, no handler errors")
+
+
+if __name__ == '__main__':
+    main()
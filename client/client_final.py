@@ -5,17 +5,36 @@ import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog
 import time
 from tkinter import filedialog  # --- added
-import base64, os               # --- added
+import os                       # --- added
+import shutil
+import sys
+import tempfile
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.flow import SendWindow
+from common.framing import FrameDecoder
+from common.protocol import (HELLO, SUPPORTED_VERSIONS, WIRE_V1, WIRE_V2,
+                             V2Decoder, decode_v2, encode, raw_bytes)
 
 # NEW constants
 MAX_FILE_SIZE = 100 * 1024 * 1024   # 100MB
 CHUNK_SIZE = 48 * 1024              # 48KB per chunk (base64 inflates ~33%)
+HELLO_TIMEOUT = 2.0                 # seconds to wait for a v2-capable server to answer hello
+FETCH_WINDOW = 32                   # chunks asked for per fetch_file request when downloading
+RESUME_TIMEOUT = 5.0                # seconds to wait for the server's resume_transfer reply
+RESUME_ATTEMPTS = 3                 # reconnects tried before an upload is given up
+CREDIT_EVERY = 4                    # chunks consumed per file_credit sent back to the sender
+PROGRESS_INTERVAL = 0.1             # seconds between progress updates to the UI, per transfer
 
 class ChatClient:
     def __init__(self):
         self.client = None
         self.username = None
         self.connected = False
+        self.wire_version = WIRE_V1
+        self.decoder = None
+        self.send_lock = threading.Lock()   # the upload worker and the Tk thread share the socket
         
         # Initialize GUI
         self.root = tk.Tk()
@@ -28,7 +47,13 @@ class ChatClient:
         self.typing_users = set()
         
         # --- NEW: incoming file transfers state ---
-        self.incoming_files = {}   # transfer_id -> {'parts':[], 'filename':..., 'is_group':bool,'sender':..., 'total':int, 'received':int, 'timestamp':str}
+        self.incoming_files = {}   # transfer_id -> {'file', 'path', 'filename', 'is_group', 'sender', 'total', 'received', 'timestamp', ...}, see open_incoming
+        self.download_dir = None   # temp directory holding received files until saved, removed on exit
+        self.outgoing_files = {}   # transfer_id -> upload dict, see attach_file
+        self.uploader = None       # UploadWorker, started with the first upload
+        self.resume_replies = {}   # transfer_id -> [threading.Event, received_seq] while resume_transfer is pending
+        self.login_name = None     # username to log in again with after a reconnect
+        self.resuming = False      # the next login reply is from reconnect(): keep the UI as it is
         
         self.show_login_screen()
     
@@ -87,6 +112,7 @@ class ChatClient:
             self.client.connect(('localhost', 12345))
             self.connected = True
             print("Connected to server successfully!")
+            self.negotiate_protocol()
             
             # Start listening for messages
             listen_thread = threading.Thread(target=self.listen_for_messages)
@@ -104,6 +130,31 @@ class ChatClient:
             messagebox.showerror("Connection Error", f"Unexpected error: {e}")
             return False
     
+    def negotiate_protocol(self):
+        # Offer wire v2; an older server ignores the hello and we stay on v1
+        self.wire_version = WIRE_V1
+        self.decoder = FrameDecoder(max_frame=16 * 1024 * 1024)   # trust the server with large lists
+        self.client.sendall(encode({'action': HELLO, 'versions': list(SUPPORTED_VERSIONS)}))
+        self.client.settimeout(HELLO_TIMEOUT)
+        try:
+            while True:
+                frames = self.decoder.recv_frames(self.client)
+                if frames is None:
+                    break
+                if not frames:
+                    continue
+                reply = json.loads(frames[0])
+                if reply.get('type') == HELLO:
+                    if reply.get('version') == WIRE_V2:
+                        self.decoder = V2Decoder.upgrade(self.decoder)
+                        self.wire_version = WIRE_V2
+                    break
+        except (socket.timeout, ValueError):
+            pass
+        finally:
+            self.client.settimeout(None)
+        print(f"Using wire protocol v{self.wire_version}")
+    
     def login(self):
         username = self.username_entry.get().strip()
         if not username:
@@ -114,6 +165,7 @@ class ChatClient:
             return
         
         # Send login request
+        self.login_name = username
         login_data = {'action': 'login', 'username': username}
         self.send_message(login_data)
     
@@ -296,6 +348,10 @@ class ChatClient:
                                     bg='#ecf0f1', fg='#7f8c8d')
         self.typing_label.pack(fill='x', padx=10)
         
+        # File transfers in progress, one row each
+        self.transfers_frame = tk.Frame(chat_container, bg='#ecf0f1')
+        self.transfers_frame.pack(fill='x', padx=10)
+        
         # Message input area
         input_frame = tk.Frame(chat_container, bg='#ecf0f1')
         input_frame.pack(fill='x', padx=10, pady=10)
@@ -314,43 +370,92 @@ class ChatClient:
         
         self.message_entry.config(state='disabled')
     
+    def send_frame(self, frame):
+        # Every write after the handshake goes through here, so an upload
+        # chunk and a chat message never interleave on the socket
+        with self.send_lock:
+            self.client.sendall(frame)
+    
     def send_message(self, data):
         if self.connected:
             try:
-                message = json.dumps(data) + "\n"   # newline-delimited frame
-                self.client.send(message.encode('utf-8'))
+                self.send_frame(encode(data, self.wire_version))   # v1 line or v2 frame
             except:
                 self.connected = False
-                messagebox.showerror("Error", "Connection lost!")
+                # also called from the network and upload threads: Tk only on its own thread
+                self.root.after(0, messagebox.showerror, "Error", "Connection lost!")
+    
+    def reconnect(self):
+        # New connection logged in as the same user, without rebuilding the UI
+        try:
+            self.client.close()
+        except OSError:
+            pass
+        self.connected = False
+        try:
+            self.client = socket.create_connection(('localhost', 12345), timeout=5)
+        except OSError:
+            time.sleep(1)
+            return False
+        self.client.settimeout(None)
+        try:
+            self.negotiate_protocol()
+        except OSError:     # reset during the hello: a failed attempt like a refused connect
+            self.client.close()
+            time.sleep(1)
+            return False
+        self.connected = True
+        self.resuming = True
+        threading.Thread(target=self.listen_for_messages, daemon=True).start()
+        self.send_message({'action': 'login', 'username': self.login_name})
+        return self.connected
     
     def listen_for_messages(self):
-        buffer = ""
-        while self.connected:
+        # Bound to the connection it was started for; reconnect() starts a new one
+        sock, decoder = self.client, self.decoder
+        while self.connected and self.client is sock:
             try:
-                chunk = self.client.recv(4096).decode('utf-8')
-                if not chunk:
+                frames = decoder.recv_frames(sock)
+                if frames is None:
                     break
-                buffer += chunk
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if not line.strip():
-                        continue
+                i = 0
+                while i < len(frames):
+                    frame = frames[i]
+                    i += 1
                     try:
-                        data = json.loads(line)
+                        if self.wire_version == WIRE_V2:
+                            data = decode_v2(frame)
+                        elif frame.strip():
+                            data = json.loads(frame)
+                        else:
+                            continue
                     except:
                         continue
+                    if self.wire_version == WIRE_V1 and data.get('type') == HELLO:
+                        if data.get('version') == WIRE_V2:
+                            # The server got to the hello after HELLO_TIMEOUT and has
+                            # switched anyway: re-read what follows it as v2 frames
+                            decoder.buffer[:0] = b''.join(bytes(f) + b'\n' for f in frames[i:])
+                            decoder = self.decoder = V2Decoder.upgrade(decoder)
+                            self.wire_version = WIRE_V2
+                            frames, i = decoder.feed(b''), 0
+                        continue
                     self.process_incoming_message(data)
             except:
                 break
-        self.connected = False
+        if self.client is sock:
+            self.connected = False
     
     def process_incoming_message(self, data):
         if 'success' in data:
             if data['success']:
-                if 'profile' in data:  # login or profile-related response
+                if 'profile' in data and self.resuming and 'new_username' not in data:
+                    self.resuming = False   # logged in again after reconnect()
+                elif 'profile' in data:  # login or profile-related response
                     if 'new_username' in data:
                         # username changed
                         self.username = data['new_username']
+                        self.login_name = data['new_username']     # reconnect() logs in under it
                         self.nickname_label.config(text=data['profile'].get('nickname', self.username))
                     self.root.after(0, self.show_main_interface, data['profile'])
                 else:
@@ -358,10 +463,33 @@ class ChatClient:
                     if msg_txt.startswith('message sent'): return
                     if msg_txt.startswith('message sent to group'): return
                     messagebox.showinfo("Success", data['message'])
+            elif data.get('transfer_id') in self.outgoing_files:
+                # the server refused an upload's start: the worker ends it with this error
+                self.uploader.fail(self.outgoing_files[data['transfer_id']], data['message'])
             else:
                 messagebox.showerror("Error", data['message'])
             return
         
+        elif 'received_seq' in data:
+            # resume_transfer reply, awaited by resume_upload
+            pending = self.resume_replies.get(data.get('transfer_id'))
+            if pending:
+                pending[1] = data['received_seq']
+                pending[0].set()
+        
+        elif data.get('type') == 'file_ack':
+            upload = self.outgoing_files.get(data.get('transfer_id'))
+            if upload:
+                upload['acked'] = data['seq']
+                upload['window'].on_ack(data['seq'])
+                self.uploader.wake()
+        
+        elif data.get('type') == 'file_credit':
+            upload = self.outgoing_files.get(data.get('transfer_id'))
+            if upload:
+                upload['window'].on_credit(data.get('seq'))
+                self.uploader.wake()
+        
         elif 'results' in data:
             # Search results
             self.show_search_results(data['results'])
@@ -409,12 +537,17 @@ class ChatClient:
         elif data.get('type') == 'group_file_message':
             self.root.after(0, self.display_file_message, data, True)
         # --- NEW chunked file protocol handling ---
+        # Handled right here on the network thread: chunks are decoded and
+        # written to disk without going through the Tk event queue, which
+        # only sees coarse progress (see handle_file_chunk)
         elif data.get('type') in ('file_start','group_file_start'):
-            self.root.after(0, self.handle_file_start, data)
+            self.handle_file_start(data)
         elif data.get('type') in ('file_chunk','group_file_chunk'):
-            self.root.after(0, self.handle_file_chunk, data)
+            self.handle_file_chunk(data)
         elif data.get('type') in ('file_end','group_file_end'):
-            self.root.after(0, self.handle_file_end, data)
+            self.handle_file_end(data)
+        elif data.get('type') == 'file_available':
+            self.root.after(0, self.handle_file_available, data)
     
     # --- NEW handlers for profile & username events ---
     def handle_profile_update_event(self, data):
@@ -683,7 +816,8 @@ class ChatClient:
         self.root.after(600, self.refresh_contacts)
     
     def attach_file(self):
-        # REPLACED: now supports up to 100MB with chunked protocol
+        # REPLACED: now supports up to 100MB with chunked protocol; the chunks
+        # go out from the UploadWorker, so the UI keeps running meanwhile
         if not self.current_chat:
             messagebox.showinfo("Info", "Open a chat first.")
             return
@@ -696,56 +830,87 @@ class ChatClient:
         filename = os.path.basename(path)
         ctype, cid = self.current_chat.split(':',1)
         is_group = (ctype == 'group')
-        transfer_id = f"{int(time.time()*1000)}_{filename}"
+        transfer_id = uuid.uuid4().hex    # stays the same across reconnects, see resume_upload
         start_payload = {
             'action': 'send_group_file_start' if is_group else 'send_file_start',
             'transfer_id': transfer_id,
             'filename': filename,
-            'total_size': size
+            'total_size': size,
+            'chunk_size': CHUNK_SIZE
         }
         if is_group:
             start_payload['group_id'] = cid
         else:
             start_payload['recipient'] = cid
-        self.send_message(start_payload)
-        # send chunks
         try:
-            with open(path, 'rb') as f:
-                seq = 0
-                while True:
-                    chunk = f.read(CHUNK_SIZE)
-                    if not chunk: break
-                    b64 = base64.b64encode(chunk).decode('utf-8')
-                    chunk_payload = {
-                        'action': 'send_group_file_chunk' if is_group else 'send_file_chunk',
-                        'transfer_id': transfer_id,
-                        'seq': seq,
-                        'data': b64
-                    }
-                    if is_group:
-                        chunk_payload['group_id'] = cid
-                    else:
-                        chunk_payload['recipient'] = cid
-                    self.send_message(chunk_payload)
-                    seq += 1
-            end_payload = {
-                'action': 'send_group_file_end' if is_group else 'send_file_end',
-                'transfer_id': transfer_id
-            }
-            if is_group:
-                end_payload['group_id'] = cid
-            else:
-                end_payload['recipient'] = cid
-            self.send_message(end_payload)
+            f = open(path, 'rb', buffering=0)
+        except OSError as e:
+            messagebox.showerror("Error", f"Send failed: {e}")
+            return
+        upload = {
+            'transfer_id': transfer_id,
+            'file': f,
+            'filename': filename,
+            'size': size,
+            'chat': self.current_chat,
+            'is_group': is_group,
+            'cid': cid,
+            'seq': 0,                           # next chunk to send
+            'chunks': -(-size // CHUNK_SIZE),
+            'acked': -1,                        # highest seq the server confirmed
+            'window': SendWindow(CHUNK_SIZE),
+            'cancelled': False,
+            'error': None,                      # set when the server refuses the upload
+            'reported': 0.0                     # time of the last progress update
+        }
+        self.show_upload(upload)
+        self.outgoing_files[transfer_id] = upload
+        if self.uploader is None:
+            self.uploader = UploadWorker(self)
+            self.uploader.start()
+        with self.uploader.cond:    # a refusal of the start waits until the worker has the upload
+            self.send_message(start_payload)
+            self.uploader.add(upload)
+
+    def show_upload(self, upload):
+        row = tk.Frame(self.transfers_frame, bg='#ecf0f1')
+        row.pack(fill='x')
+        upload['label'] = tk.Label(row, text=f"Sending {upload['filename']}: 0%", font=('Arial', 9),
+                                   bg='#ecf0f1', fg='#7f8c8d', anchor='w')
+        upload['label'].pack(side='left', fill='x', expand=True)
+        tk.Button(row, text="Cancel", font=('Arial', 8), relief='flat',
+                  command=lambda: self.uploader.cancel(upload)).pack(side='right')
+        upload['row'] = row
+
+    def update_upload_progress(self, upload, sent):
+        if upload.get('row') is None: return
+        percent = 100 * sent // upload['size'] if upload['size'] else 100
+        upload['label'].config(text=f"Sending {upload['filename']}: {percent}%")
+
+    def finish_upload(self, upload, error=None):
+        # On the Tk thread, once the worker is done with `upload`
+        self.outgoing_files.pop(upload['transfer_id'], None)
+        upload['row'].destroy()
+        upload['row'] = None
+        if error:
+            messagebox.showerror("Error", f"Send failed: {error}")
+        elif not upload['cancelled'] and self.current_chat == upload['chat']:
             # local echo
             self.messages_text.config(state='normal')
-            self.messages_text.insert(tk.END, f"You ({time.strftime('%H:%M')}): [Sent file: {filename} ({size//1024}KB)]\n", 'own_message')
+            self.messages_text.insert(tk.END, f"You ({time.strftime('%H:%M')}): [Sent file: {upload['filename']} ({upload['size']//1024}KB)]\n", 'own_message')
             self.messages_text.config(state='disabled')
             self.messages_text.see(tk.END)
-        except Exception as e:
-            messagebox.showerror("Error", f"Send failed: {e}")
 
-    # --- NEW incoming chunked handlers ---
+    def resume_upload(self, transfer_id):
+        # Ask the server, on a connection reconnect() just set up, for the
+        # highest contiguous chunk it received; the seq to continue from, or None
+        pending = self.resume_replies[transfer_id] = [threading.Event(), None]
+        self.send_message({'action': 'resume_transfer', 'transfer_id': transfer_id})
+        answered = pending[0].wait(RESUME_TIMEOUT)
+        self.resume_replies.pop(transfer_id, None)
+        return pending[1] + 1 if answered else None
+
+    # --- NEW incoming chunked handlers (network thread, UI updates via root.after) ---
     def handle_file_start(self, data):
         is_group = data['type'].startswith('group_')
         # Filter by current chat
@@ -759,48 +924,156 @@ class ChatClient:
             if self.current_chat != f"private:{sender}":
                 return
         tid = data['transfer_id']
-        self.incoming_files[tid] = {
-            'parts': [],
+        if self.open_incoming(tid, data, is_group) is None: return
+        # from now on the sender waits for our credit
+        self.send_message({'action': 'file_credit', 'transfer_id': tid, 'sender': data['sender'], 'seq': -1})
+
+    def open_incoming(self, tid, data, is_group):
+        # Received chunks go straight into a temp file preallocated to the
+        # full size, each at its seq's offset, so memory use does not grow
+        # with the file; the save button moves it where the user wants it
+        if self.download_dir is None:
+            self.download_dir = tempfile.mkdtemp(prefix='chat-downloads-')
+        total = data.get('total_size', 0)
+        try:
+            fd, path = tempfile.mkstemp(dir=self.download_dir)
+            f = os.fdopen(fd, 'r+b')
+            f.truncate(total)
+        except OSError as e:
+            self.root.after(0, messagebox.showerror, "Error", f"Cannot receive {data['filename']}: {e}")
+            return None
+        info = {
+            'file': f,
+            'path': path,
+            'chunk_size': data.get('chunk_size') or CHUNK_SIZE,
             'filename': data['filename'],
             'is_group': is_group,
             'sender': data['sender'],
-            'total': data.get('total_size', 0),
-            'received': 0,
-            'timestamp': data.get('timestamp', time.strftime('%H:%M'))
+            'total': total,
+            'received': 0,          # bytes
+            'count': 0,             # chunks
+            'timestamp': data.get('timestamp', time.strftime('%H:%M')),
+            'reported': 0.0         # time of the last progress update
         }
+        self.root.after(0, self.show_incoming, info)
+        self.incoming_files[tid] = info
+        return info
+
+    def close_incoming(self, info, keep):
+        info['file'].close()
+        if not keep:
+            os.remove(info['path'])
 
     def handle_file_chunk(self, data):
         tid = data['transfer_id']
         info = self.incoming_files.get(tid)
         if not info: return
         try:
-            raw = base64.b64decode(data['data'].encode('utf-8'))
+            raw = raw_bytes(data['data'])   # base64 on v1, already raw on v2
         except:
             return
-        info['parts'].append(raw)
+        offset = data.get('seq', 0) * info['chunk_size']
+        if offset + len(raw) > info['total']: return
+        try:
+            info['file'].seek(offset)
+            info['file'].write(raw)
+        except OSError as e:
+            self.incoming_files.pop(tid, None)
+            self.close_incoming(info, keep=False)
+            self.root.after(0, self.finish_incoming, info, f"Cannot receive {info['filename']}: {e}")
+            return
         info['received'] += len(raw)
+        info['count'] += 1
+        now = time.monotonic()
+        if now - info['reported'] >= PROGRESS_INTERVAL:
+            info['reported'] = now
+            self.root.after(0, self.update_incoming_progress, info, info['received'])
+        if 'chunks' in info:    # a download from the server's spool
+            self.continue_download(tid, info)
+        elif (data.get('seq', 0) + 1) % CREDIT_EVERY == 0 or info['received'] >= info['total']:
+            # let the sender's window move on (common/flow.py)
+            self.send_message({'action': 'file_credit', 'transfer_id': tid,
+                               'sender': info['sender'], 'seq': data.get('seq', 0)})
+
+    # --- downloads of files the server kept for us (spool mode) ---
+    def handle_file_available(self, data):
+        where = f" in {data['group_name']}" if data.get('group_id') else ""
+        self.messages_text.config(state='normal')
+        self.messages_text.insert(tk.END, f"{data['sender']}{where} ({data.get('timestamp', '')}): ")
+        btn = tk.Button(self.messages_text, text=f"[Download: {data['filename']} ({data['total_size']//1024}KB)]",
+                        fg='blue', relief='flat', cursor='hand2',
+                        command=lambda: self.download_file(data))
+        self.messages_text.window_create(tk.END, window=btn)
+        self.messages_text.insert(tk.END, "\n")
+        self.messages_text.config(state='disabled')
+        self.messages_text.see(tk.END)
+
+    def download_file(self, data):
+        tid = data['file_id']
+        if tid in self.incoming_files: return     # already downloading
+        info = self.open_incoming(tid, data, bool(data.get('group_id')))
+        if info is None: return
+        info['chunks'] = -(-info['total'] // info['chunk_size'])
+        info['requested'] = 0
+        self.continue_download(tid, info)
+
+    def continue_download(self, tid, info):
+        # Ask for the next window once the previous one has fully arrived
+        got = info['count']
+        if got == info['chunks']:
+            self.handle_file_end({'transfer_id': tid})
+        elif got == info['requested']:
+            info['requested'] = min(got + FETCH_WINDOW, info['chunks'])
+            self.send_message({'action': 'fetch_file', 'file_id': tid, 'seq': got, 'count': FETCH_WINDOW})
 
     def handle_file_end(self, data):
         tid = data['transfer_id']
         info = self.incoming_files.pop(tid, None)
         if not info: return
-        # Reconstruct
-        full = b''.join(info['parts'])
+        aborted = bool(data.get('aborted'))     # the sender gave up; drop what arrived
+        self.close_incoming(info, keep=not aborted)
+        self.root.after(0, self.finish_incoming, info, None, aborted)
+
+    def show_incoming(self, info):
+        row = tk.Frame(self.transfers_frame, bg='#ecf0f1')
+        row.pack(fill='x')
+        info['label'] = tk.Label(row, text=f"Receiving {info['filename']}: 0%", font=('Arial', 9),
+                                 bg='#ecf0f1', fg='#7f8c8d', anchor='w')
+        info['label'].pack(side='left', fill='x', expand=True)
+        info['row'] = row
+
+    def update_incoming_progress(self, info, received):
+        if info.get('row') is None: return
+        percent = 100 * received // info['total'] if info['total'] else 100
+        info['label'].config(text=f"Receiving {info['filename']}: {percent}%")
+
+    def finish_incoming(self, info, error=None, aborted=False):
+        # On the Tk thread, once the network thread is done with `info`
+        info['row'].destroy()
+        info['row'] = None
+        if error:
+            messagebox.showerror("Error", error)
+        if error or aborted:
+            return
         filename = info['filename']
         sender = info['sender']; ts = info['timestamp']
+        stored = [info['path']]     # the temp file until the first save, then the saved copy
         # Display save button
         def save_file():
             save_path = filedialog.asksaveasfilename(initialfile=filename, title="Save file")
             if not save_path: return
             try:
-                with open(save_path,'wb') as f:
-                    f.write(full)
+                if stored[0] == info['path']:
+                    shutil.move(stored[0], save_path)
+                    stored[0] = save_path
+                else:
+                    shutil.copyfile(stored[0], save_path)
                 messagebox.showinfo("Saved","File saved.")
             except Exception as e:
                 messagebox.showerror("Error", f"Save failed: {e}")
         self.messages_text.config(state='normal')
         self.messages_text.insert(tk.END, f"{sender} ({ts}): ")
-        btn = tk.Button(self.messages_text, text=f"[File: {filename} ({len(full)//1024}KB)]",
+        btn = tk.Button(self.messages_text, text=f"[File: {filename} ({info['received']//1024}KB)]",
                         fg='blue', relief='flat', cursor='hand2', command=save_file)
         self.messages_text.window_create(tk.END, window=btn)
         self.messages_text.insert(tk.END, "\n")
@@ -813,6 +1086,138 @@ class ChatClient:
         finally:
             if self.connected:
                 self.client.close()
+            if self.download_dir is not None:
+                shutil.rmtree(self.download_dir, ignore_errors=True)   # received files never saved
+
+
+class UploadWorker(threading.Thread):
+    # Sends the chunks of every upload in progress, one chunk per upload in
+    # turn so a small file is not stuck behind a large one, each within its
+    # SendWindow. Chunks are read into one reused buffer and written through
+    # ChatClient.send_frame; UI updates are posted to the Tk thread.
+    def __init__(self, app):
+        super().__init__(daemon=True)
+        self.app = app
+        self.uploads = []       # upload dicts (see ChatClient.attach_file), in turn order
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.cond = threading.Condition()
+        self.woken = False
+
+    def add(self, upload):
+        with self.cond:
+            self.uploads.append(upload)
+            self.wake()
+
+    def cancel(self, upload):
+        upload['cancelled'] = True
+        self.wake()
+
+    def fail(self, upload, error):
+        with self.cond:
+            if upload not in self.uploads:    # a small file may be fully sent already
+                self.app.root.after(0, messagebox.showerror, "Error", f"Send failed: {error}")
+                return
+            upload['error'] = error
+            self.wake()
+
+    def wake(self):
+        # A window may have moved (file_ack/file_credit) or there is new work
+        with self.cond:
+            self.woken = True
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.uploads:
+                    self.cond.wait()
+                self.woken = False
+                uploads = list(self.uploads)
+            try:
+                sent = sum([self.step(upload) for upload in uploads])
+            except OSError:
+                self.resume()
+                continue
+            if not sent:
+                if not self.app.connected:
+                    self.resume()
+                    continue
+                with self.cond:
+                    if not self.woken:
+                        self.cond.wait(1.0)
+
+    def step(self, upload):
+        # Send the next chunk of `upload` if its window allows; True if sent
+        if upload['error']:
+            self.end(upload, error=upload['error'])
+            return False
+        if upload['cancelled']:
+            self.end(upload, aborted=True)
+            return False
+        seq = upload['seq']
+        if seq >= upload['chunks']:
+            self.end(upload)
+            return False
+        if not upload['window'].wait(seq, 0):
+            return False
+        n = upload['file'].readinto(self.buffer)
+        chunk = memoryview(self.buffer)[:n]
+        # v1 base64-encodes the chunk, v2 sends the raw bytes in a binary chunk frame
+        chunk_payload = {
+            'action': 'send_group_file_chunk' if upload['is_group'] else 'send_file_chunk',
+            'transfer_id': upload['transfer_id'],
+            'seq': seq,
+            'data': chunk
+        }
+        if upload['is_group']:
+            chunk_payload['group_id'] = upload['cid']
+        else:
+            chunk_payload['recipient'] = upload['cid']
+        self.app.send_frame(encode(chunk_payload, self.app.wire_version))
+        upload['seq'] = seq + 1
+        now = time.monotonic()
+        if now - upload['reported'] >= PROGRESS_INTERVAL:
+            upload['reported'] = now
+            self.app.root.after(0, self.app.update_upload_progress, upload, min(upload['seq'] * CHUNK_SIZE, upload['size']))
+        return True
+
+    def end(self, upload, aborted=False, error=None):
+        # Last message of an upload (an aborted one tells recipients to drop it)
+        if error is None:
+            end_payload = {
+                'action': 'send_group_file_end' if upload['is_group'] else 'send_file_end',
+                'transfer_id': upload['transfer_id']
+            }
+            if upload['is_group']:
+                end_payload['group_id'] = upload['cid']
+            else:
+                end_payload['recipient'] = upload['cid']
+            if aborted:
+                end_payload['aborted'] = True
+            self.app.send_frame(encode(end_payload, self.app.wire_version))
+        with self.cond:
+            self.uploads.remove(upload)
+        upload['file'].close()
+        self.app.root.after(0, self.app.finish_upload, upload, error)
+
+    def resume(self):
+        # The connection dropped: reconnect and go on with every upload from
+        # the last chunk the server has
+        for _ in range(RESUME_ATTEMPTS):
+            if self.app.reconnect():
+                break
+        else:
+            for upload in list(self.uploads):
+                self.end(upload, error="connection lost")
+            return
+        for upload in list(self.uploads):
+            seq = self.app.resume_upload(upload['transfer_id'])
+            if seq is None:
+                self.end(upload, error="connection lost")
+                continue
+            upload['seq'] = seq
+            upload['file'].seek(seq * CHUNK_SIZE)
+            upload['window'].restart(seq - 1)
 
 
 class ProfileDialog:
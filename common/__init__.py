@@ -0,0 +1 @@
+# Code shared by the chat server and the chat client
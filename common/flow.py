@@ -0,0 +1,107 @@
+# Sender side of chunk flow control, shared by the client and the benchmarks.
+#
+# The server answers every chunk with a file_ack (it has the chunk) and
+# relays file_credit from the receivers (they have consumed the chunk; the
+# slowest receiver that grants credit counts). Receivers grant -1 on
+# file_start, so the first chunks already wait for them. A sender keeps at most
+# `size` chunks past the confirmed seq: the credited one while any receiver
+# grants, the acked one otherwise (no live receivers, or only old clients).
+#
+# The window is sized to twice the bandwidth-delay product: the delivery
+# rate measured from confirmations (the best of the last few samples, so
+# the window can grow into spare capacity) times the smallest round trip
+# seen. A slow receiver lowers the rate and so the window, instead of
+# letting the chunks pile up in server queues.
+import collections
+import math
+import threading
+import time
+
+MIN_WINDOW = 8          # chunks; receivers grant credit every few chunks
+MAX_WINDOW = 128        # a v1 window stays well under the server's 16MB per-client queue
+INITIAL_WINDOW = 16
+MIN_SAMPLE = 0.005      # seconds; shortest interval a rate sample covers
+RATE_SAMPLES = 8        # the rate is the best of this many recent samples
+
+
+class SendWindow:
+    def __init__(self, chunk_size, initial=INITIAL_WINDOW, minimum=MIN_WINDOW, maximum=MAX_WINDOW):
+        self.chunk_size = chunk_size
+        self.size = initial
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.acked = -1         # highest contiguous seq the server has
+        self.credited = None    # highest seq every granting receiver consumed; None: nobody grants
+        self.confirmed = -1
+        self.rate = 0.0         # bytes/s, best recent sample
+        self._samples = collections.deque(maxlen=RATE_SAMPLES)
+        self.min_rtt = None
+        self._sent = {}         # {seq: send time} for chunks in flight
+        self._mark = None       # (time, confirmed) of the last rate sample
+        self._cond = threading.Condition()
+
+    def wait(self, seq, timeout=None):
+        """Block until chunk `seq` may be sent; False on timeout."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: seq <= self.confirmed + self.size, timeout):
+                return False
+            self._sent[seq] = time.monotonic()
+            return True
+
+    def on_ack(self, seq):
+        with self._cond:
+            self.acked = max(self.acked, seq)
+            self._update()
+
+    def on_credit(self, seq):
+        # seq None: no receiver grants credit any more, pace by acks alone
+        with self._cond:
+            self.credited = None if seq is None else max(self.credited if self.credited is not None else -1, seq)
+            self._update()
+
+    def restart(self, seq):
+        """After a resume: the server holds chunks up to `seq`, nothing is in flight."""
+        with self._cond:
+            self.acked = seq
+            self.credited = None
+            self.confirmed = seq
+            self._sent.clear()
+            self._mark = None
+            self._cond.notify_all()
+
+    def _update(self):
+        confirmed = self.acked if self.credited is None else min(self.acked, self.credited)
+        if confirmed < self.confirmed:
+            # A receiver started granting: what the acks measured no longer
+            # says how fast chunks are consumed, start measuring again
+            self.confirmed = confirmed
+            self.rate = 0.0
+            self._samples.clear()
+            self.min_rtt = None
+            self._mark = None
+            self.size = min(self.size, self.initial)
+            return
+        if confirmed == self.confirmed:
+            return
+        now = time.monotonic()
+        sent = self._sent.get(confirmed)
+        if sent is not None:
+            rtt = now - sent
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        for seq in [s for s in self._sent if s <= confirmed]:
+            del self._sent[seq]
+        # Rate samples span at least a round trip: credits arrive in bursts,
+        # and two of them a few microseconds apart say nothing about the rate
+        if self._mark is None:
+            self._mark = (now, confirmed)
+        elif now - self._mark[0] >= max(self.min_rtt or 0, MIN_SAMPLE):
+            sample = (confirmed - self._mark[1]) * self.chunk_size / (now - self._mark[0])
+            self._samples.append(sample)
+            self.rate = max(self._samples)
+            self._mark = (now, confirmed)
+        self.confirmed = confirmed
+        if self.rate and self.min_rtt:
+            bdp = math.ceil(2 * self.rate * self.min_rtt / self.chunk_size)
+            self.size = max(self.minimum, min(self.maximum, bdp))
+        self._cond.notify_all()
@@ -0,0 +1,63 @@
+# Incremental NDJSON frame decoder shared by the server engines and the client.
+#
+# Works on raw bytes so a multi-byte UTF-8 character split across two recv()
+# calls is only decoded once the whole frame has arrived, and never rescans
+# bytes it has already searched for the newline delimiter.
+
+MIN_RECV_SIZE = 4096
+MAX_RECV_SIZE = 256 * 1024
+MAX_FRAME_SIZE = 1024 * 1024      # 64KB base64 chunks + JSON fit comfortably
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameDecoder:
+    def __init__(self, max_frame=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.scan = 0                   # bytes before this offset hold no b'\n'
+        self.max_frame = max_frame
+        self.recv_size = MIN_RECV_SIZE
+
+    def feed(self, data):
+        """Append received bytes and return the complete frames (bytes, without b'\\n')."""
+        buf = self.buffer
+        buf += data
+        # Only the bytes appended since the last call can hold a new delimiter
+        last = buf.rfind(b'\n', self.scan)
+        if last < 0:
+            frames = []
+        else:
+            with memoryview(buf) as view:
+                if buf.count(b'\n', self.scan, last) < 4:
+                    # Few (large) frames: copy each slice exactly once
+                    frames = []
+                    start = 0
+                    while start <= last:
+                        end = buf.find(b'\n', max(start, self.scan))
+                        frames.append(bytes(view[start:end]))
+                        start = end + 1
+                else:
+                    # Many small frames: one copy, split in C
+                    frames = bytes(view[:last]).split(b'\n')
+            del buf[:last + 1]
+        self.scan = len(buf)
+        if self.scan > self.max_frame:
+            raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+        return frames
+
+    def adapt(self, received):
+        # Grow the read size while reads fill it (bulk transfer), shrink when idle chat
+        if received >= self.recv_size:
+            self.recv_size = min(self.recv_size * 2, MAX_RECV_SIZE)
+        elif received < self.recv_size // 4:
+            self.recv_size = max(self.recv_size // 2, MIN_RECV_SIZE)
+
+    def recv_frames(self, sock):
+        """One recv() from a blocking socket; returns a list of frames, or None on EOF."""
+        chunk = sock.recv(self.recv_size)
+        if not chunk:
+            return None
+        self.adapt(len(chunk))
+        return self.feed(chunk)
@@ -0,0 +1,189 @@
+# Wire formats.
+#
+# v1: one JSON object per line (NDJSON), the original protocol.
+# v2: length-prefixed frames, negotiated right after connecting:
+#       client -> {"action": "hello", "versions": [1, 2]}   (v1 line)
+#       server -> {"type": "hello", "version": 2}           (v1 line)
+#     after which both sides switch to v2 in both directions. A v1-only
+#     server ignores the hello, so the client falls back to v1 on timeout;
+#     a v2 server that answers after the timeout still switches it to v2.
+#
+# v2 frame: HEADER (body length u32, frame type u8, action code u8) + body.
+# For FRAME_JSON the body is the JSON object without its 'action'/'type'
+# key when that name has a code in the tables below.
+# For FRAME_CHUNK (file chunks) the body is seq (u32), then the string
+# fields listed in CHUNK_FIELDS as u16 length + UTF-8, then the raw bytes:
+# no base64 and no JSON. Decoded, a chunk frame is the same dict as its v1
+# line except that 'data' holds the raw bytes instead of base64 text.
+import base64
+import json
+import struct
+from collections import namedtuple
+
+from common.framing import FrameDecoder, FrameTooLarge
+
+WIRE_V1 = 1
+WIRE_V2 = 2
+SUPPORTED_VERSIONS = (WIRE_V1, WIRE_V2)
+HELLO = 'hello'
+
+HEADER = struct.Struct('>IBB')
+FRAME_JSON = 1
+FRAME_CHUNK = 2
+SEQ = struct.Struct('>I')
+STRLEN = struct.Struct('>H')
+
+# Append-only: a name's position is its code on the wire.
+ACTIONS = (
+    'hello', 'register', 'login', 'update_profile', 'search_users', 'add_contact',
+    'remove_contact', 'get_contacts', 'send_message', 'create_group', 'join_group',
+    'leave_group', 'send_group_message', 'get_groups', 'typing', 'update_status',
+    'add_friend_to_group', 'change_username', 'send_file', 'send_group_file',
+    'send_file_start', 'send_file_chunk', 'send_file_end', 'send_group_file_start',
+    'send_group_file_chunk', 'send_group_file_end', 'get_stats', 'fetch_history', 'fetch_file',
+    'resume_transfer', 'file_credit',
+)
+TYPES = (
+    'hello', 'private_message', 'group_message', 'group_notification', 'typing_indicator',
+    'status_update', 'group_added', 'profile_update', 'username_changed', 'file_message',
+    'group_file_message', 'file_start', 'file_chunk', 'file_end', 'group_file_start',
+    'group_file_chunk', 'group_file_end', 'file_available', 'file_ack',
+    'file_credit',
+)
+TYPE_BASE = 128     # codes 1..127 name an 'action', 128..255 a 'type'
+
+ACTION_CODES = {name: i + 1 for i, name in enumerate(ACTIONS)}
+TYPE_CODES = {name: TYPE_BASE + i for i, name in enumerate(TYPES)}
+
+# String fields carried in a chunk frame, in wire order, per action/type name
+CHUNK_FIELDS = {
+    'send_file_chunk': ('transfer_id', 'recipient'),
+    'send_group_file_chunk': ('transfer_id', 'group_id'),
+    'file_chunk': ('transfer_id', 'sender'),
+    'group_file_chunk': ('transfer_id', 'group_id', 'sender'),
+}
+
+Frame = namedtuple('Frame', 'ftype code body')
+
+
+def raw_bytes(data):
+    """A chunk's payload as bytes-like, whichever wire version it arrived on."""
+    if isinstance(data, str):
+        return base64.b64decode(data.encode('ascii'))
+    return data
+
+
+def encode_v1(obj):
+    data = obj.get('data')
+    if data is not None and not isinstance(data, str):
+        obj = dict(obj, data=base64.b64encode(data).decode('ascii'))
+    return (json.dumps(obj) + "\n").encode('utf-8')
+
+
+def action_code(obj):
+    """(code, key) for the obj's 'action' or 'type' name, or (0, None) if it has none."""
+    name = obj.get('action')
+    if name is not None:
+        code = ACTION_CODES.get(name, 0)
+        return code, ('action' if code else None)
+    code = TYPE_CODES.get(obj.get('type'), 0)
+    return code, ('type' if code else None)
+
+
+def encode_chunk(obj, code, fields):
+    parts = [b'', SEQ.pack(obj.get('seq', 0))]
+    for field in fields:
+        value = str(obj.get(field, '')).encode('utf-8')
+        parts.append(STRLEN.pack(len(value)))
+        parts.append(value)
+    parts.append(raw_bytes(obj.get('data', b'')))
+    parts[0] = HEADER.pack(sum(len(p) for p in parts), FRAME_CHUNK, code)
+    return b''.join(parts)
+
+
+def decode_chunk(frame, name):
+    body = memoryview(frame.body)
+    data = {'seq': SEQ.unpack_from(body, 0)[0]}
+    pos = SEQ.size
+    for field in CHUNK_FIELDS[name]:
+        (n,) = STRLEN.unpack_from(body, pos)
+        pos += STRLEN.size
+        data[field] = str(body[pos:pos + n], 'utf-8')
+        pos += n
+    data['data'] = body[pos:]
+    return data
+
+
+def encode_v2(obj):
+    code, key = action_code(obj)
+    fields = CHUNK_FIELDS.get(obj.get(key)) if key else None
+    if fields:
+        return encode_chunk(obj, code, fields)
+    if key:
+        obj = {k: v for k, v in obj.items() if k != key}
+    body = json.dumps(obj).encode('utf-8')
+    return HEADER.pack(len(body), FRAME_JSON, code) + body
+
+
+def wrap_json_v2(body, code=0):
+    """v2 JSON frame around an already serialized body (no trailing newline)."""
+    return HEADER.pack(len(body), FRAME_JSON, code) + body
+
+
+def encode(obj, version=WIRE_V1):
+    return encode_v2(obj) if version == WIRE_V2 else encode_v1(obj)
+
+
+def decode_v2(frame):
+    """Frame -> the same dict a v1 peer would have sent."""
+    if frame.code >= TYPE_BASE:
+        key, name = 'type', TYPES[frame.code - TYPE_BASE]
+    elif frame.code:
+        key, name = 'action', ACTIONS[frame.code - 1]
+    else:
+        key = name = None
+    if frame.ftype == FRAME_CHUNK and name in CHUNK_FIELDS:
+        data = decode_chunk(frame, name)
+    elif frame.ftype == FRAME_JSON:
+        data = json.loads(frame.body)
+    else:
+        raise ValueError(f"Unknown frame type {frame.ftype}")
+    if key:
+        data[key] = name
+    return data
+
+
+def choose_version(offered):
+    common = [v for v in offered or () if v in SUPPORTED_VERSIONS]
+    return max(common) if common else WIRE_V1
+
+
+class V2Decoder(FrameDecoder):
+    # Same interface as FrameDecoder, but yields Frame tuples instead of lines
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        frames = []
+        pos = 0
+        size = HEADER.size
+        with memoryview(buf) as view:
+            while len(buf) - pos >= size:
+                length, ftype, code = HEADER.unpack_from(buf, pos)
+                if length > self.max_frame:
+                    raise FrameTooLarge(f"Frame exceeds {self.max_frame} bytes")
+                end = pos + size + length
+                if end > len(buf):
+                    break
+                frames.append(Frame(ftype, code, bytes(view[pos + size:end])))
+                pos = end
+        if pos:
+            del buf[:pos]
+        return frames
+
+    @classmethod
+    def upgrade(cls, decoder):
+        """Switch a v1 FrameDecoder to v2, keeping any bytes it has already buffered."""
+        v2 = cls(decoder.max_frame)
+        v2.recv_size = decoder.recv_size
+        v2.buffer += decoder.buffer
+        return v2
@@ -1,22 +1,169 @@
+import os
+import sys
 import socket
 import threading
 import json
 import time
 from datetime import datetime
 import base64  # --- added
+import argparse
+import re
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.protocol import HELLO, WIRE_V1, WIRE_V2, choose_version, decode_v2, encode, raw_bytes, wrap_json_v2
+from outbound import DEFAULT_LIMITS, DROPPABLE_TYPES, OutboundLimits, ThreadedConnection
+from history import MessageLog
+from locks import LockStripes
+from mailbox import Mailbox, MailboxDrainer
+from metrics import ActionStats
+from search import UserIndex
+from spool import FileSpool
+from storage import MemoryStore, SQLiteStore
 
 MAX_FILE_SIZE = 100 * 1024 * 1024    # 100MB
+ENGINES = ('thread', 'asyncio', 'reactor')
+# action -> name of the ChatServer method handling it, called as handler(client, data).
+# ChatServer.register_action adds or replaces entries per server.
+HANDLERS = {
+    HELLO: 'negotiate',
+    'register': 'register_user',
+    'login': 'login_user',
+    'update_profile': 'update_profile',
+    'search_users': 'search_users',
+    'add_contact': 'add_contact',
+    'remove_contact': 'remove_contact',
+    'get_contacts': 'get_contacts',
+    'send_message': 'send_private_message',
+    'create_group': 'create_group',
+    'join_group': 'join_group',
+    'leave_group': 'leave_group',
+    'send_group_message': 'send_group_message',
+    'get_groups': 'get_user_groups',
+    'typing': 'handle_typing',
+    'update_status': 'update_status',
+    'add_friend_to_group': 'add_friend_to_group',
+    'change_username': 'change_username',
+    'send_file': 'send_file',
+    'send_group_file': 'send_group_file',
+    'send_file_start': 'send_file_start',
+    'send_file_chunk': 'send_file_chunk',
+    'send_file_end': 'send_file_end',
+    'send_group_file_start': 'send_group_file_start',
+    'send_group_file_chunk': 'send_group_file_chunk',
+    'send_group_file_end': 'send_group_file_end',
+    'get_stats': 'send_stats',
+    'fetch_history': 'fetch_history',
+    'fetch_file': 'fetch_file',
+    'resume_transfer': 'resume_transfer',
+    'file_credit': 'file_credit',
+}
+SEARCH_LIMIT = 50         # search_users results per page unless the request asks for fewer
+HISTORY_LIMIT = 100       # fetch_history messages per page unless the request asks for fewer
+SPOOL_CHUNK_SIZE = 48 * 1024    # chunk size assumed when send_*file_start doesn't give one
+MAX_CHUNK_SIZE = 1024 * 1024
+FETCH_WINDOW = 64         # most chunks sent for one fetch_file request
+RESUME_TIMEOUT = 600      # seconds an interrupted upload waits for resume_transfer
+SWEEP_INTERVAL = 30       # seconds between sweeps for interrupted uploads past RESUME_TIMEOUT
+
+# Head of a v1 chunk line as ChatClient.attach_file serializes it; lets the
+# server route a chunk without parsing its (large) base64 payload.
+CHUNK_HEAD = re.compile(rb'\{"action": "(send_file_chunk|send_group_file_chunk)", '
+                        rb'"transfer_id": ("(?:[^"\\]|\\.)*"), "seq": (\d+)')
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=12345):
+    def __init__(self, host='0.0.0.0', port=12345, engine='thread', reactors=None, balance='round_robin',
+                 outbound_limits=DEFAULT_LIMITS, store=None, history=None, mailbox=None, spool=None,
+                 stats_admins=()):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine: {engine}")
         self.host = host
         self.port = port
-        self.clients = {}  # {socket: {'username': str, 'profile': dict}}
-        self.users = {}    # {username: {'profile': dict, 'contacts': list, 'status': str}}
-        self.groups = {}   # {group_id: {'name': str, 'members': list, 'messages': list}}
+        self.engine = engine    # 'thread': one thread per connection, 'asyncio': single event loop,
+                                # 'reactor': N selector loops each owning a shard of connections
+        self.reactors = reactors    # reactor count (default: CPU count)
+        self.balance = balance      # 'round_robin' or 'least_loaded' reactor assignment
+        self.outbound_limits = outbound_limits  # per-connection queue watermarks (outbound.py)
+        self.loop = None        # set by the asyncio engine
+        # Users are keyed by a stable numeric uid; usernames appear only in
+        # self.user_ids and in each user record, so a rename touches two entries.
+        self.clients = {}  # {socket: {'uid': int, 'username': str, 'profile': dict}}
+        self.sessions = {} # {uid: set(socket)} reverse of self.clients, for delivery
+        self.users = {}    # {uid: {'username': str, 'profile': dict, 'contacts': set(uid), 'status': str}}
+        self.user_ids = {} # {username: uid}
+        self.next_uid = 1  # above every uid ever handed out, even one the store lost
+        self.search_index = UserIndex()  # usernames and nicknames, for search_users
+        self.followers = {}  # {uid: set(uids that have this user in 'contacts')}
+        self.groups = {}   # {group_id: {'name': str, 'members': set(uid), 'online': set(socket), 'admin': uid}}
+        self.user_groups = {}  # {uid: {group_id: None}} groups of each user, in join order
+        self.transfers = {}  # {socket: {transfer_id: route}} chunked transfers announced by *_start
+        self.routes = {}     # {(sender uid, transfer_id): route} every open transfer, for file_credit
+        # Uploads whose sender disconnected, until resume_transfer picks them up
+        self.parked = {}     # {(uid, transfer_id): route}
+        self.parked_lock = threading.Lock()
+        # Handlers run concurrently (thread and reactor engines). directory_lock
+        # guards user_ids, the search index and uid/group id allocation; the
+        # striped locks guard one user's (uid) or group's (group_id) entries.
+        # directory_lock is always taken before any stripe. Fanout iterates
+        # snapshots, so it needs no lock.
+        self.directory_lock = threading.Lock()
+        self.locks = LockStripes()
+        # Users, contacts and groups are written through to the store, which
+        # queues the writes (see storage.py); MemoryStore keeps nothing.
+        self.store = store if store is not None else MemoryStore()
+        # History logs and spooled files name users by uid and groups by
+        # group id; a store that forgets them hands the same ids to new
+        # users after a restart, who would then read the old files.
+        if not self.store.persistent and ((history is not None and history.root is not None)
+                                          or spool is not None):
+            raise ValueError("On-disk history and spool need a persistent store")
+        self.load_state()
+        # Private and group messages, one log per conversation (history.py);
+        # the default MessageLog keeps only each conversation's recent tail.
+        self.history = history if history is not None else MessageLog()
+        # Private messages to offline users wait in the mailbox (mailbox.py)
+        # and are streamed to the user after login by the drainer thread.
+        self.mailbox = mailbox if mailbox is not None else Mailbox()
+        self.drainer = MailboxDrainer(self.mailbox, self._mail_ready, self._deliver_mail)
+        self.drainer.start()
+        # With a FileSpool (spool.py) chunked transfers are also written to
+        # disk; recipients who were offline get a file_available notice and
+        # download with fetch_file. None relays chunks to online users only.
+        self.spool = spool
+        self.handlers = {action: getattr(self, name) for action, name in HANDLERS.items()}
+        self.action_stats = ActionStats()  # per-action counts/errors/latency, see get_stats
+        # get_stats lists every online user: only these logged-in usernames may ask
+        self.stats_admins = frozenset(stats_admins)
         self.running = True
+        self.sweeper = threading.Thread(target=self._sweep_parked, daemon=True)
+        self.sweeper.start()
         
+    def load_state(self):
+        # Rebuild users, contacts and groups (and every index over them) from the store
+        users, contacts, groups, members = self.store.load()
+        for uid, username, profile in users:
+            self.users[uid] = {'username': username, 'profile': json.loads(profile),
+                               'contacts': set(), 'status': 'offline'}
+            self.user_ids[username] = uid
+            self._index_user(uid)
+        self.next_uid = max(self.users, default=0) + 1
+        for uid, contact in contacts:
+            self.users[uid]['contacts'].add(contact)
+            self.followers.setdefault(contact, set()).add(uid)
+        for group_id, name, admin in groups:
+            self.groups[group_id] = {'name': name, 'members': set(), 'online': set(), 'admin': admin}
+        for group_id, uid in members:
+            self.groups[group_id]['members'].add(uid)
+            self._index_membership(uid, group_id)
+
     def start_server(self):
+        if self.engine == 'asyncio':
+            import async_engine
+            async_engine.run(self)
+            return
+        if self.engine == 'reactor':
+            import reactor_engine
+            reactor_engine.run(self, self.reactors, self.balance)
+            return
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.bind((self.host, self.port))
@@ -26,8 +173,10 @@ class ChatServer:
         
         while self.running:
             try:
-                client, address = server.accept()
+                sock, address = server.accept()
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)    # acks and credits go out at once
                 print(f"Connected with {str(address)}")
+                client = ThreadedConnection(sock, address, self.outbound_limits)
                 
                 thread = threading.Thread(target=self.handle_client, args=(client,))
                 thread.start()
@@ -37,159 +186,211 @@ class ChatServer:
         server.close()
     
     def send_json(self, client, obj):
+        # Queues the frame on the client's outbound queue; never blocks on the socket
         try:
-            client.send((json.dumps(obj) + "\n").encode('utf-8'))
+            data = encode(obj, client.wire_version)
+        except:
+            return
+        self.send_raw(client, data, obj.get('type') in DROPPABLE_TYPES)
+
+    def send_raw(self, client, data, droppable=False):
+        try:
+            client.send(data, droppable)
         except:
             pass
 
+    def fanout(self, recipients, obj):
+        # Serialize once per wire version and hand the same immutable bytes to every recipient
+        encoded = {}
+        droppable = obj.get('type') in DROPPABLE_TYPES
+        for cli in recipients:
+            version = cli.wire_version
+            data = encoded.get(version)
+            if data is None:
+                try:
+                    data = encoded[version] = encode(obj, version)
+                except:
+                    return
+            self.send_raw(cli, data, droppable)
+
+    def get_stats(self):
+        connections = []
+        for cli, cd in list(self.clients.items()):
+            connections.append({
+                'username': cd['username'],
+                'queue_depth': cli.queue_depth(),
+                'dropped': cli.flow.dropped,
+                'paused': cli.flow.paused
+            })
+        return {'engine': self.engine, 'online': len(connections), 'connections': connections,
+                'actions': self.action_stats.snapshot()}
+
+    def send_stats(self, client, data):
+        if client not in self.clients:
+            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
+        if self.clients[client]['username'] not in self.stats_admins:
+            self.send_json(client, {'success': False, 'message': 'Not allowed'}); return
+        self.send_json(client, {'stats': self.get_stats()})
+
     def handle_client(self, client):
-        buffer = ""
         while True:
             try:
-                chunk = client.recv(4096).decode('utf-8')
-                if not chunk:
+                # client.decoder changes once the client negotiates wire v2
+                frames = client.decoder.recv_frames(client)
+                if frames is None:
                     break
-                buffer += chunk
-                while '\n' in buffer:
-                    line, buffer = buffer.split('\n', 1)
-                    if not line.strip():
-                        continue
-                    try:
-                        data = json.loads(line)
-                    except:
-                        continue
-                    self.process_message(client, data)
+                for frame in frames:
+                    self.handle_frame(client, frame)
             except:
                 break
         self.disconnect_client(client)
+
+    def handle_frame(self, client, frame):
+        # One v1 line (bytes) or v2 Frame -> process_message; shared by all engines
+        try:
+            if isinstance(frame, bytes):
+                if client in self.transfers:
+                    start = time.perf_counter()
+                    if self.relay_chunk_line(client, frame):
+                        # relayed v1 chunks never reach a handler; count them apart
+                        self.action_stats.record('relay_chunk', time.perf_counter() - start)
+                        return
+                if not frame.strip():
+                    return
+                data = json.loads(frame)
+            else:
+                data = decode_v2(frame)
+        except:
+            return
+        self.process_message(client, data)
+
+    def negotiate(self, client, data):
+        # Reply in the current (v1) format, then switch both directions
+        version = choose_version(data.get('versions'))
+        self.send_json(client, {'type': HELLO, 'version': version})
+        client.upgrade(version)
     
+    def register_action(self, action, handler):
+        """Route `action` to handler(client, data), replacing any existing handler."""
+        self.handlers[action] = handler
+
     def process_message(self, client, data):
         action = data.get('action')
-        
-        if action == 'register':
-            self.register_user(client, data)
-        elif action == 'login':
-            self.login_user(client, data)
-        elif action == 'update_profile':
-            self.update_profile(client, data)
-        elif action == 'search_users':
-            self.search_users(client, data)
-        elif action == 'add_contact':
-            self.add_contact(client, data)
-        elif action == 'remove_contact':
-            self.remove_contact(client, data)
-        elif action == 'get_contacts':
-            self.get_contacts(client)
-        elif action == 'send_message':
-            self.send_private_message(client, data)
-        elif action == 'create_group':
-            self.create_group(client, data)
-        elif action == 'join_group':
-            self.join_group(client, data)
-        elif action == 'leave_group':
-            self.leave_group(client, data)
-        elif action == 'send_group_message':
-            self.send_group_message(client, data)
-        elif action == 'get_groups':
-            self.get_user_groups(client)
-        elif action == 'typing':
-            self.handle_typing(client, data)
-        elif action == 'update_status':
-            self.update_status(client, data)
-        elif action == 'add_friend_to_group':
-            self.add_friend_to_group(client, data)
-        elif action == 'change_username':
-            self.change_username(client, data)
-        elif action == 'send_file':
-            self.send_file(client, data)          # --- added
-        elif action == 'send_group_file':
-            self.send_group_file(client, data)
-        # --- NEW chunked actions ---
-        elif action == 'send_file_start':
-            self.send_file_start(client, data)
-        elif action == 'send_file_chunk':
-            self.send_file_chunk(client, data)
-        elif action == 'send_file_end':
-            self.send_file_end(client, data)
-        elif action == 'send_group_file_start':
-            self.send_group_file_start(client, data)
-        elif action == 'send_group_file_chunk':
-            self.send_group_file_chunk(client, data)
-        elif action == 'send_group_file_end':
-            self.send_group_file_end(client, data)
+        handler = self.handlers.get(action)
+        if handler is None:
+            return
+        start = time.perf_counter()
+        try:
+            handler(client, data)
+        except BaseException:
+            self.action_stats.record(action, time.perf_counter() - start, failed=True)
+            raise
+        self.action_stats.record(action, time.perf_counter() - start)
 
     def register_user(self, client, data):
         username = data.get('username')
         
-        if username in self.users:
-            response = {'success': False, 'message': 'Username already exists'}
-        else:
-            self.users[username] = {
-                'profile': {
-                    'nickname': username,
-                    'avatar': '👤',
+        with self.directory_lock:
+            if username in self.user_ids:
+                response = {'success': False, 'message': 'Username already exists'}
+            else:
+                uid = self.next_uid
+                self.next_uid += 1
+                self.users[uid] = {
+                    'username': username,
+                    'profile': {
+                        'nickname': username,
+                        'avatar': '👤',
+                        'status': 'online'
+                    },
+                    'contacts': set(),
                     'status': 'online'
-                },
-                'contacts': [],
-                'status': 'online'
-            }
-            response = {'success': True, 'message': 'Registration successful'}
+                }
+                self.user_ids[username] = uid
+                self._index_user(uid)
+                self.store.put_user(uid, username, self.users[uid]['profile'])
+                response = {'success': True, 'message': 'Registration successful'}
         
         self.send_json(client, response)
     
     def login_user(self, client, data):
-        username = data.get('username')
+        uid = self.user_ids.get(data.get('username'))
         
-        if username not in self.users:
+        if uid is None:
             response = {'success': False, 'message': 'User not found'}
         else:
-            self.clients[client] = {'username': username, 'profile': self.users[username]['profile']}
-            self.users[username]['status'] = 'online'
-            response = {'success': True, 'message': 'Login successful', 'profile': self.users[username]['profile']}
+            previous = self.clients.get(client, {}).get('uid')
+            with self.locks.hold(uid, previous):
+                self._add_session(client, uid)
+                self.users[uid]['status'] = 'online'
+            response = {'success': True, 'message': 'Login successful', 'profile': self.users[uid]['profile']}
             
             # Notify contacts that user is online
-            self.notify_status_change(username, 'online')
+            self.notify_status_change(uid, 'online')
         
         self.send_json(client, response)
+        if uid is not None:
+            self.drainer.add(uid)
     
     def update_profile(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             profile_updates = data.get('profile', {})
             
-            self.users[username]['profile'].update(profile_updates)
-            self.clients[client]['profile'].update(profile_updates)
+            with self.directory_lock:
+                self.users[uid]['profile'].update(profile_updates)
+                self._index_user(uid)
+                self.store.put_profile(uid, self.users[uid]['profile'])
             response = {'success': True, 'message': 'Profile updated'}
             # NEW: broadcast profile update (avatar / nickname) to contacts & group members
-            self.broadcast_profile_update(username)
+            self.broadcast_profile_update(uid)
         else:
             response = {'success': False, 'message': 'Not logged in'}
         
         self.send_json(client, response)
     
     def search_users(self, client, data):
-        query = data.get('query', '').lower()
+        # Exact matches first, then prefix, then substring; pages of at most
+        # SEARCH_LIMIT results, continued by passing back 'next_cursor'
+        query = str(data.get('query', ''))
+        try:
+            limit = min(max(int(data.get('limit', SEARCH_LIMIT)), 1), SEARCH_LIMIT)
+        except (TypeError, ValueError):
+            limit = SEARCH_LIMIT
+        try:
+            tier, after = data['cursor']
+            cursor = (int(tier), int(after))
+        except (KeyError, TypeError, ValueError):
+            cursor = None
+        # No directory_lock: the index locks itself, in short holds (search.py)
+        uids, next_cursor = self.search_index.search(query, limit, cursor)
         results = []
         
-        for username, user_data in self.users.items():
-            if query in username.lower() or query in user_data['profile']['nickname'].lower():
-                results.append({
-                    'username': username,
-                    'nickname': user_data['profile']['nickname'],
-                    'avatar': user_data['profile']['avatar'],
-                    'status': user_data['status']
-                })
+        for uid in uids:
+            user_data = self.users[uid]
+            results.append({
+                'username': user_data['username'],
+                'nickname': user_data['profile']['nickname'],
+                'avatar': user_data['profile']['avatar'],
+                'status': user_data['status']
+            })
         
-        response = {'results': results}
+        response = {'results': results, 'next_cursor': next_cursor}
         self.send_json(client, response)
     
     def add_contact(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             contact_username = data.get('username')
+            contact = self.user_ids.get(contact_username)
             
-            if contact_username in self.users and contact_username not in self.users[username]['contacts']:
-                self.users[username]['contacts'].append(contact_username)
+            with self.locks.hold(uid, contact):
+                added = contact is not None and contact not in self.users[uid]['contacts']
+                if added:
+                    self.users[uid]['contacts'].add(contact)
+                    self.followers.setdefault(contact, set()).add(uid)
+                    self.store.add_contact(uid, contact)
+            if added:
                 response = {'success': True, 'message': f'Added {contact_username} to contacts'}
             else:
                 response = {'success': False, 'message': 'User not found or already in contacts'}
@@ -200,11 +401,17 @@ class ChatServer:
     
     def remove_contact(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             contact_username = data.get('username')
+            contact = self.user_ids.get(contact_username)
             
-            if contact_username in self.users[username]['contacts']:
-                self.users[username]['contacts'].remove(contact_username)
+            with self.locks.hold(uid, contact):
+                removed = contact in self.users[uid]['contacts']
+                if removed:
+                    self.users[uid]['contacts'].discard(contact)
+                    self.followers.get(contact, set()).discard(uid)
+                    self.store.remove_contact(uid, contact)
+            if removed:
                 response = {'success': True, 'message': f'Removed {contact_username} from contacts'}
             else:
                 response = {'success': False, 'message': 'Contact not found'}
@@ -213,19 +420,19 @@ class ChatServer:
         
         self.send_json(client, response)
     
-    def get_contacts(self, client):
+    def get_contacts(self, client, data=None):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             contacts = []
             
-            for contact_username in self.users[username]['contacts']:
-                if contact_username in self.users:
-                    contacts.append({
-                        'username': contact_username,
-                        'nickname': self.users[contact_username]['profile']['nickname'],
-                        'avatar': self.users[contact_username]['profile']['avatar'],
-                        'status': self.users[contact_username]['status']
-                    })
+            for contact in sorted(tuple(self.users[uid]['contacts']), key=self._name):
+                contact_data = self.users[contact]
+                contacts.append({
+                    'username': contact_data['username'],
+                    'nickname': contact_data['profile']['nickname'],
+                    'avatar': contact_data['profile']['avatar'],
+                    'status': contact_data['status']
+                })
             
             response = {'contacts': contacts}
         else:
@@ -235,45 +442,56 @@ class ChatServer:
     
     def send_private_message(self, client, data):
         if client in self.clients:
-            sender = self.clients[client]['username']
-            recipient = data.get('recipient')
+            session = self.clients[client]
+            recipient = self.user_ids.get(data.get('recipient'))
             message = data.get('message')
-            
-            # Find recipient's client
-            recipient_client = None
-            for cli, client_data in self.clients.items():
-                if client_data['username'] == recipient:
-                    recipient_client = cli
-                    break
-            
-            if recipient_client:
+            if recipient is not None:
+                record = self.history.append(self._conversation_key(session['uid'], recipient),
+                                             session['uid'], message)
                 message_data = {
                     'type': 'private_message',
-                    'sender': sender,
+                    'sender': session['username'],
                     'message': message,
+                    'seq': record['seq'],
                     'timestamp': datetime.now().strftime('%H:%M'),
-                    'avatar': self.users[sender]['profile']['avatar']
+                    'avatar': session['profile']['avatar']
                 }
-                self.send_json(recipient_client, message_data)   # CHANGED (framed)
-                response = {'success': True, 'message': 'Message sent'}
+                body = json.dumps(message_data).encode('utf-8')
+                
+                # Find recipient's sessions
+                recipient_clients = self._sessions_of([recipient])
+                
+                if not recipient_clients:
+                    self.mailbox.put(recipient, body)
+                    response = {'success': True, 'message': 'Message sent, delivered when recipient logs in'}
+                elif self.mailbox.offer(recipient, body):
+                    # Older mail is still being drained; queue behind it to keep order
+                    response = {'success': True, 'message': 'Message sent'}
+                else:
+                    self.fanout(recipient_clients, message_data)   # CHANGED (framed)
+                    response = {'success': True, 'message': 'Message sent'}
             else:
-                response = {'success': False, 'message': 'Recipient not online'}
+                response = {'success': False, 'message': 'Recipient not found'}
         else:
             response = {'success': False, 'message': 'Not logged in'}
         self.send_json(client, response)
     
     def create_group(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             group_name = data.get('group_name')
-            group_id = f"group_{len(self.groups) + 1}"
-            
-            self.groups[group_id] = {
-                'name': group_name,
-                'members': [username],
-                'messages': [],
-                'admin': username
-            }
+            with self.directory_lock:
+                group_id = f"group_{len(self.groups) + 1}"
+                with self.locks.hold(uid, group_id):
+                    self.groups[group_id] = {
+                        'name': group_name,
+                        'members': {uid},
+                        'online': set(),    # connected sessions of members, kept by the session registry
+                        'admin': uid
+                    }
+                    self._index_membership(uid, group_id)
+                    self.store.put_group(group_id, group_name, uid)
+                    self.store.add_member(group_id, uid)
             
             response = {'success': True, 'message': f'Group "{group_name}" created', 'group_id': group_id}
         else:
@@ -283,11 +501,16 @@ class ChatServer:
     
     def join_group(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid, username = self.clients[client]['uid'], self.clients[client]['username']
             group_id = data.get('group_id')
             
-            if group_id in self.groups and username not in self.groups[group_id]['members']:
-                self.groups[group_id]['members'].append(username)
+            with self.locks.hold(uid, group_id):
+                joined = group_id in self.groups and uid not in self.groups[group_id]['members']
+                if joined:
+                    self.groups[group_id]['members'].add(uid)
+                    self._index_membership(uid, group_id)
+                    self.store.add_member(group_id, uid)
+            if joined:
                 response = {'success': True, 'message': f'Joined group "{self.groups[group_id]["name"]}"'}
                 
                 # Notify other group members
@@ -295,7 +518,7 @@ class ChatServer:
                     'type': 'group_notification',
                     'message': f'{username} joined the group',
                     'timestamp': datetime.now().strftime('%H:%M')
-                }, exclude=username)
+                }, exclude=uid)
             else:
                 response = {'success': False, 'message': 'Group not found or already a member'}
         else:
@@ -305,11 +528,16 @@ class ChatServer:
     
     def leave_group(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid, username = self.clients[client]['uid'], self.clients[client]['username']
             group_id = data.get('group_id')
             
-            if group_id in self.groups and username in self.groups[group_id]['members']:
-                self.groups[group_id]['members'].remove(username)
+            with self.locks.hold(uid, group_id):
+                left = group_id in self.groups and uid in self.groups[group_id]['members']
+                if left:
+                    self.groups[group_id]['members'].discard(uid)
+                    self._unindex_membership(uid, group_id)
+                    self.store.remove_member(group_id, uid)
+            if left:
                 response = {'success': True, 'message': f'Left group "{self.groups[group_id]["name"]}"'}
                 
                 # Notify other group members
@@ -318,6 +546,7 @@ class ChatServer:
                     'message': f'{username} left the group',
                     'timestamp': datetime.now().strftime('%H:%M')
                 })
+                self._drop_credits(uid)
             else:
                 response = {'success': False, 'message': 'Group not found or not a member'}
         else:
@@ -327,22 +556,25 @@ class ChatServer:
     
     def send_group_message(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            session = self.clients[client]
+            uid = session['uid']
             group_id = data.get('group_id')
             message = data.get('message')
             
-            if group_id in self.groups and username in self.groups[group_id]['members']:
+            if group_id in self.groups and uid in self.groups[group_id]['members']:
+                record = self.history.append(self._conversation_key(group_id=group_id), uid, message)
                 message_data = {
                     'type': 'group_message',
                     'group_id': group_id,
                     'group_name': self.groups[group_id]['name'],
-                    'sender': username,
+                    'sender': session['username'],
                     'message': message,
+                    'seq': record['seq'],
                     'timestamp': datetime.now().strftime('%H:%M'),
-                    'avatar': self.users[username]['profile']['avatar']
+                    'avatar': session['profile']['avatar']
                 }
                 
-                self.notify_group_members(group_id, message_data, exclude=username)
+                self.notify_group_members(group_id, message_data, exclude=uid)
                 response = {'success': True, 'message': 'Message sent to group'}
             else:
                 response = {'success': False, 'message': 'Group not found or not a member'}
@@ -351,18 +583,60 @@ class ChatServer:
         
         self.send_json(client, response)
     
-    def get_user_groups(self, client):
+    def fetch_history(self, client, data):
+        # One page of a private ('with': username) or group ('group_id')
+        # conversation, oldest first. Pass 'next_cursor' back as 'before' for
+        # the page before it; 'before_time' (epoch seconds) starts at a time.
+        if client not in self.clients:
+            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
+        uid = self.clients[client]['uid']
+        group_id = data.get('group_id')
+        if group_id is not None:
+            if group_id not in self.groups or uid not in self.groups[group_id]['members']:
+                self.send_json(client, {'success': False, 'message': 'Group not found or not a member'}); return
+            key = self._conversation_key(group_id=group_id)
+            scope = {'group_id': group_id}
+        else:
+            peer = self.user_ids.get(data.get('with'))
+            if peer is None:
+                self.send_json(client, {'success': False, 'message': 'User not found'}); return
+            key = self._conversation_key(uid, peer)
+            scope = {'with': data.get('with')}
+        try:
+            limit = min(max(int(data.get('limit', HISTORY_LIMIT)), 1), HISTORY_LIMIT)
+            before = data.get('before')
+            if before is not None:
+                before = int(before)
+            elif data.get('before_time') is not None:
+                before = self.history.seq_at(key, float(data['before_time']))
+        except (TypeError, ValueError):
+            self.send_json(client, {'success': False, 'message': 'Invalid cursor'}); return
+        records, cursor = self.history.fetch(key, before, limit)
+        messages = []
+        for record in records:
+            sender = self.users.get(record['sender'])
+            messages.append({
+                'seq': record['seq'],
+                'sender': sender['username'] if sender else None,
+                'message': record['message'],
+                'time': record['ts'],
+                'timestamp': datetime.fromtimestamp(record['ts']).strftime('%H:%M')
+            })
+        self.send_json(client, dict(scope, history=messages, next_cursor=cursor))
+    
+    def get_user_groups(self, client, data=None):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             user_groups = []
             
-            for group_id, group_data in self.groups.items():
-                if username in group_data['members']:
-                    user_groups.append({
-                        'group_id': group_id,
-                        'name': group_data['name'],
-                        'member_count': len(group_data['members'])
-                    })
+            for group_id in tuple(self.user_groups.get(uid, ())):
+                group_data = self.groups[group_id]
+                user_groups.append({
+                    'group_id': group_id,
+                    'name': group_data['name'],
+                    'member_count': len(group_data['members']),
+                    'online_count': len(group_data['online'])
+                })
             
             response = {'groups': user_groups}
         else:
@@ -373,25 +647,22 @@ class ChatServer:
     def handle_typing(self, client, data):
         if client in self.clients:
             username = self.clients[client]['username']
-            recipient = data.get('recipient')
+            recipient = self.user_ids.get(data.get('recipient'))
             is_typing = data.get('is_typing', False)
-            for cli, client_data in self.clients.items():
-                if client_data['username'] == recipient:
-                    typing_data = {
-                        'type': 'typing_indicator',
-                        'sender': username,
-                        'is_typing': is_typing
-                    }
-                    self.send_json(cli, typing_data)  # CHANGED
-                    break
+            typing_data = {
+                'type': 'typing_indicator',
+                'sender': username,
+                'is_typing': is_typing
+            }
+            self.fanout(self._sessions_of([recipient]), typing_data)
     
     def update_status(self, client, data):
         if client in self.clients:
-            username = self.clients[client]['username']
+            uid = self.clients[client]['uid']
             status = data.get('status')
             
-            self.users[username]['status'] = status
-            self.notify_status_change(username, status)
+            self.users[uid]['status'] = status
+            self.notify_status_change(uid, status)
             
             response = {'success': True, 'message': 'Status updated'}
         else:
@@ -402,7 +673,7 @@ class ChatServer:
     def add_friend_to_group(self, client, data):
         if client not in self.clients:
             self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
-        username = self.clients[client]['username']
+        uid, username = self.clients[client]['uid'], self.clients[client]['username']
         group_id = data.get('group_id')
         friend = data.get('friend')
         if not group_id or not friend:
@@ -410,127 +681,135 @@ class ChatServer:
         if group_id not in self.groups:
             self.send_json(client, {'success': False, 'message': 'Group not found'}); return
         group = self.groups[group_id]
-        if username not in group['members']:
+        if uid not in group['members']:
             self.send_json(client, {'success': False, 'message': 'You are not a member of this group'}); return
-        if friend not in self.users:
+        friend_uid = self.user_ids.get(friend)
+        if friend_uid is None:
             self.send_json(client, {'success': False, 'message': 'Friend user not found'}); return
-        if friend not in self.users[username]['contacts']:
+        if friend_uid not in self.users[uid]['contacts']:
             self.send_json(client, {'success': False, 'message': 'User is not in your contacts'}); return
-        if friend in group['members']:
+        with self.locks.hold(friend_uid, group_id):
+            added = friend_uid not in group['members']
+            if added:
+                group['members'].add(friend_uid)
+                self._index_membership(friend_uid, group_id)
+                self.store.add_member(group_id, friend_uid)
+        if not added:
             self.send_json(client, {'success': False, 'message': 'User already in group'}); return
-        group['members'].append(friend)
         self.notify_group_members(group_id, {
             'type': 'group_notification',
             'message': f'{friend} was added to the group by {username}',
             'timestamp': datetime.now().strftime('%H:%M')
         })
-        added_client = None
-        for cli, cd in self.clients.items():
-            if cd['username'] == friend:
-                added_client = cli; break
-        if added_client:
-            self.send_json(added_client, {
-                'type': 'group_added',
-                'group_id': group_id,
-                'name': group['name'],
-                'member_count': len(group['members'])
-            })
+        self.fanout(self._sessions_of([friend_uid]), {
+            'type': 'group_added',
+            'group_id': group_id,
+            'name': group['name'],
+            'member_count': len(group['members'])
+        })
         self.send_json(client, {'success': True, 'message': f'Added {friend} to group "{group["name"]}"', 'action': 'add_friend_to_group'})
     
-    def broadcast_profile_update(self, username):
-        prof = self.users[username]['profile']
+    def broadcast_profile_update(self, uid):
+        user = self.users[uid]
+        prof = user['profile']
         payload = {
             'type': 'profile_update',
-            'username': username,
+            'username': user['username'],
             'nickname': prof['nickname'],
             'avatar': prof['avatar'],
-            'status': self.users[username]['status']
+            'status': user['status']
         }
-        targets = set()
-        # contacts who have this user
-        for u, ud in self.users.items():
-            if username in ud['contacts']:
-                targets.add(u)
-        # group members
-        for g in self.groups.values():
-            if username in g['members']:
-                for m in g['members']:
-                    targets.add(m)
-        for cli, cdata in self.clients.items():
-            if cdata['username'] in targets:
-                self.send_json(cli, payload)
+        self.fanout(self._audience(uid), payload)
 
     # --- NEW: change username action ---
     def change_username(self, client, data):
         if client not in self.clients:
             self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
-        old = self.clients[client]['username']
+        uid = self.clients[client]['uid']
         new = data.get('new_username', '').strip()
         if not new:
             self.send_json(client, {'success': False, 'message': 'New username required'}); return
-        if new in self.users:
+        # contacts, followers, groups and sessions refer to the uid, so only
+        # the name index, the user record and the session caches change
+        with self.directory_lock:
+            old = self.users[uid]['username']
+            taken = new in self.user_ids
+            if not taken:
+                del self.user_ids[old]
+                self.user_ids[new] = uid
+                self.users[uid]['username'] = new
+                self._index_user(uid)
+                self.store.rename_user(uid, new)
+                with self.locks.hold(uid):
+                    for cli in self.sessions.get(uid, ()):
+                        self.clients[cli]['username'] = new
+        if taken:
             self.send_json(client, {'success': False, 'message': 'Username already taken'}); return
-        # migrate user record
-        self.users[new] = self.users.pop(old)
-        # update contacts lists
-        for u, ud in self.users.items():
-            if old in ud['contacts']:
-                ud['contacts'] = [new if c == old else c for c in ud['contacts']]
-        # update groups
-        for gid, g in self.groups.items():
-            if old in g['members']:
-                g['members'] = [new if m == old else m for m in g['members']]
-                if g.get('admin') == old:
-                    g['admin'] = new
-        # update client mapping
-        self.clients[client]['username'] = new
         # notify contacts & group members
         notice = {
             'type': 'username_changed',
             'old_username': old,
             'new_username': new
         }
-        targets = set()
-        for u, ud in self.users.items():
-            if (old in ud['contacts']) or (new in ud['contacts']):
-                targets.add(u)
-        for g in self.groups.values():
-            if new in g['members']:
-                for m in g['members']:
-                    targets.add(m)
-        for cli, cd in self.clients.items():
-            if cd['username'] in targets and cli != client:
-                self.send_json(cli, notice)
+        self.fanout(self._audience(uid) - {client}, notice)
         self.send_json(client, {'success': True,
                                 'message': 'Username changed',
-                                'profile': self.users[new]['profile'],
+                                'profile': self.users[uid]['profile'],
                                 'new_username': new})
         # also broadcast profile (with new username context)
-        self.broadcast_profile_update(new)
-
-    def notify_status_change(self, username, status):
-        # Notify all contacts about status change
-        for cli, client_data in self.clients.items():
-            other_username = client_data['username']
-            if username in self.users[other_username]['contacts']:
-                status_data = {'type': 'status_update','username': username,'status': status}
-                self.send_json(cli, status_data)  # CHANGED
+        self.broadcast_profile_update(uid)
+
+    def notify_status_change(self, uid, status):
+        # Notify every online user that has this user as a contact
+        status_data = {'type': 'status_update','username': self._name(uid),'status': status}
+        self.fanout(self._sessions_of(self.followers.get(uid, ())), status_data)
+
+    def _audience(self, uid):
+        # Online sessions that see this user's profile: followers and fellow
+        # group members, from the groups' online sets rather than their members
+        targets = set(self._sessions_of(self.followers.get(uid, ())))
+        for gid in tuple(self.user_groups.get(uid, ())):
+            targets.update(self.groups[gid]['online'])
+        return targets
     
+    # Membership and session helpers expect the caller to hold the stripes of
+    # the uid (and group_id) involved.
+    def _index_membership(self, uid, group_id):
+        self.user_groups.setdefault(uid, {})[group_id] = None
+        self.groups[group_id]['online'].update(self.sessions.get(uid, ()))
+
+    def _unindex_membership(self, uid, group_id):
+        self.user_groups.get(uid, {}).pop(group_id, None)
+        self.groups[group_id]['online'].difference_update(self.sessions.get(uid, ()))
+
+    def _online_members(self, group_id, exclude=None):
+        # Connected sessions of the group, skipping every session of uid `exclude`
+        online = self.groups[group_id]['online']
+        skip = self.sessions.get(exclude) if exclude is not None else None
+        if not skip:
+            return list(online)
+        return list(online.difference(skip))
+
     def notify_group_members(self, group_id, message_data, exclude=None):
         if group_id in self.groups:
-            for member in self.groups[group_id]['members']:
-                if member != exclude:
-                    for cli, client_data in self.clients.items():
-                        if client_data['username'] == member:
-                            self.send_json(cli, message_data)  # CHANGED
-                            break
+            self.fanout(self._online_members(group_id, exclude=exclude), message_data)
     
     def disconnect_client(self, client):
-        if client in self.clients:
-            username = self.clients[client]['username']
-            self.users[username]['status'] = 'offline'
-            self.notify_status_change(username, 'offline')
-            del self.clients[client]
+        routes = self.transfers.pop(client, None)
+        session = self.clients.get(client)
+        if routes and session is not None:
+            self._park_transfers(session['uid'], routes)
+        if session is not None:
+            uid = session['uid']
+            with self.locks.hold(uid):
+                self._remove_session(client)
+                last = not self.sessions.get(uid)
+                if last:
+                    self.users[uid]['status'] = 'offline'
+            if last:     # last session of this user
+                self.notify_status_change(uid, 'offline')
+                self._drop_credits(uid)
+                self._miss_spooled(uid)
         
         client.close()
 
@@ -538,7 +817,7 @@ class ChatServer:
     def send_file(self, client, data):
         if client not in self.clients:
             self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
-        sender = self.clients[client]['username']
+        session = self.clients[client]
         recipient = data.get('recipient')
         filename = data.get('filename')
         b64 = data.get('data')
@@ -550,35 +829,32 @@ class ChatServer:
             self.send_json(client, {'success': False, 'message': 'Corrupted file data'}); return
         if len(raw) > 200*1024:
             self.send_json(client, {'success': False, 'message': 'File too large (max 200KB)'}); return
-        target = None
-        for cli, cd in self.clients.items():
-            if cd['username'] == recipient:
-                target = cli
-                break
-        if not target:
+        targets = self._sessions_of([self.user_ids.get(recipient)])
+        if not targets:
             self.send_json(client, {'success': False, 'message': 'Recipient not online'}); return
         msg = {
             'type': 'file_message',
-            'sender': sender,
+            'sender': session['username'],
             'filename': filename,
             'data': b64,
             'timestamp': datetime.now().strftime('%H:%M'),
-            'avatar': self.users[sender]['profile']['avatar']
+            'avatar': session['profile']['avatar']
         }
-        self.send_json(target, msg)
+        self.fanout(targets, msg)
         self.send_json(client, {'success': True, 'message': 'File sent'})  # CHANGED
 
     # --- NEW (test server): group file send ---
     def send_group_file(self, client, data):
         if client not in self.clients:
             self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
-        sender = self.clients[client]['username']
+        session = self.clients[client]
+        uid = session['uid']
         gid = data.get('group_id')
         filename = data.get('filename')
         b64 = data.get('data')
         if not all([gid, filename, b64]):
             self.send_json(client, {'success': False, 'message': 'Missing file data'}); return
-        if gid not in self.groups or sender not in self.groups[gid]['members']:
+        if gid not in self.groups or uid not in self.groups[gid]['members']:
             self.send_json(client, {'success': False, 'message': 'Not in group'}); return
         try:
             raw = base64.b64decode(b64.encode('utf-8'))
@@ -590,33 +866,35 @@ class ChatServer:
             'type': 'group_file_message',
             'group_id': gid,
             'group_name': self.groups[gid]['name'],
-            'sender': sender,
+            'sender': session['username'],
             'filename': filename,
             'data': b64,
             'timestamp': datetime.now().strftime('%H:%M'),
-            'avatar': self.users[sender]['profile']['avatar']
+            'avatar': session['profile']['avatar']
         }
-        for member in self.groups[gid]['members']:
-            if member == sender: continue
-            for cli, cd in self.clients.items():
-                if cd['username'] == member:
-                    self.send_json(cli, payload)  # CHANGED
-                    break
+        self.fanout(self._online_members(gid, exclude=uid), payload)
         self.send_json(client, {'success': True, 'message': 'File sent to group'})  # CHANGED
 
     # --- NEW chunked private file forwarding (stateless) ---
     def send_file_start(self, client, data):
         if client not in self.clients:
-            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
+            self._refuse_start(client, data, 'Not logged in'); return
         sender = self.clients[client]['username']
         recipient = data.get('recipient'); filename = data.get('filename'); total = data.get('total_size', 0)
         if not recipient or not filename:
-            self.send_json(client, {'success': False, 'message': 'Missing fields'}); return
+            self._refuse_start(client, data, 'Missing fields'); return
         if total > MAX_FILE_SIZE:
-            self.send_json(client, {'success': False, 'message': 'File too large'}); return
-        target = self._find_client(recipient)
-        if not target:
-            self.send_json(client, {'success': False, 'message': 'Recipient not online'}); return
+            self._refuse_start(client, data, 'File too large'); return
+        recipient = self.user_ids.get(recipient)
+        targets = self._sessions_of([recipient])
+        route = {'type': 'file_chunk', 'recipient': recipient}
+        if self.spool is not None and recipient is not None:
+            spooled = self._spool_upload(client, data, total, recipient=recipient)
+            if spooled is None: return
+            route['spool'] = spooled
+            route['absent'] = set() if targets else {recipient}
+        elif not targets:
+            self._refuse_start(client, data, 'Recipient not online'); return
         payload = {
             'type': 'file_start',
             'transfer_id': data['transfer_id'],
@@ -625,14 +903,25 @@ class ChatServer:
             'sender': sender,
             'timestamp': datetime.now().strftime('%H:%M')
         }
-        self.send_json(target, payload)
+        if 'chunk_size' in data:
+            payload['chunk_size'] = data['chunk_size']     # lets receivers place chunks by seq
+        self._register_transfer(client, data['transfer_id'], route)
+        if targets:
+            self.fanout(targets, payload)
 
     def send_file_chunk(self, client, data):
+        # 'data' is base64 text from v1 senders and raw bytes from v2 binary
+        # chunk frames; encode() converts per recipient wire version.
+        # v1 chunks of a registered transfer normally never get here: see relay_chunk_line.
         if client not in self.clients: return
         sender = self.clients[client]['username']
-        recipient = data.get('recipient')
-        target = self._find_client(recipient)
-        if not target: return
+        route = self.transfers.get(client, {}).get(data.get('transfer_id'))
+        if not route or route['type'] != 'file_chunk': return
+        if not self._accept_chunk(client, route, data.get('seq', 0)): return
+        if 'spool' in route:
+            self._spool_chunk(route, data)
+        recipients = self._transfer_recipients(client, route)
+        if not recipients: return
         payload = {
             'type': 'file_chunk',
             'transfer_id': data['transfer_id'],
@@ -640,31 +929,43 @@ class ChatServer:
             'data': data.get('data',''),
             'sender': sender
         }
-        self.send_json(target, payload)
+        self.fanout(recipients, payload)
 
     def send_file_end(self, client, data):
         if client not in self.clients: return
         sender = self.clients[client]['username']
-        recipient = data.get('recipient')
-        target = self._find_client(recipient)
-        if not target: return
+        route = self.transfers.get(client, {}).pop(data.get('transfer_id'), None)
+        if route and data.get('aborted'):
+            # cancelled by the sender
+            self._abort_transfer(self.clients[client]['uid'], route); return
+        if route:
+            self._complete_transfer(client, route)
+        targets = self._sessions_of([self.user_ids.get(data.get('recipient'))])
+        if not targets: return
         payload = {
             'type': 'file_end',
             'transfer_id': data['transfer_id'],
             'sender': sender
         }
-        self.send_json(target, payload)
+        self.fanout(targets, payload)
 
     # --- NEW chunked group file forwarding ---
     def send_group_file_start(self, client, data):
         if client not in self.clients:
-            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
-        sender = self.clients[client]['username']
+            self._refuse_start(client, data, 'Not logged in'); return
+        uid, sender = self.clients[client]['uid'], self.clients[client]['username']
         gid = data.get('group_id'); filename = data.get('filename'); total = data.get('total_size',0)
-        if not gid or gid not in self.groups or sender not in self.groups[gid]['members']:
-            self.send_json(client, {'success': False, 'message': 'Not in group'}); return
+        if not gid or gid not in self.groups or uid not in self.groups[gid]['members']:
+            self._refuse_start(client, data, 'Not in group'); return
         if total > MAX_FILE_SIZE:
-            self.send_json(client, {'success': False, 'message': 'File too large'}); return
+            self._refuse_start(client, data, 'File too large'); return
+        route = {'type': 'group_file_chunk', 'group_id': gid}
+        if self.spool is not None:
+            spooled = self._spool_upload(client, data, total, group_id=gid)
+            if spooled is None: return
+            route['spool'] = spooled
+            route['absent'] = {m for m in tuple(self.groups[gid]['members'])
+                               if m != uid and m not in self.sessions}
         payload = {
             'type': 'group_file_start',
             'transfer_id': data['transfer_id'],
@@ -674,14 +975,22 @@ class ChatServer:
             'sender': sender,
             'timestamp': datetime.now().strftime('%H:%M')
         }
-        self._broadcast_group(gid, sender, payload)
+        if 'chunk_size' in data:
+            payload['chunk_size'] = data['chunk_size']
+        self._register_transfer(client, data['transfer_id'], route)
+        self._broadcast_group(gid, uid, payload)
 
     def send_group_file_chunk(self, client, data):
         if client not in self.clients: return
         sender = self.clients[client]['username']
-        gid = data.get('group_id')
-        if not gid or gid not in self.groups or sender not in self.groups[gid]['members']:
-            return
+        route = self.transfers.get(client, {}).get(data.get('transfer_id'))
+        if not route or route['type'] != 'group_file_chunk': return
+        if not self._accept_chunk(client, route, data.get('seq', 0)): return
+        if 'spool' in route:
+            self._spool_chunk(route, data)
+        gid = route['group_id']
+        recipients = self._transfer_recipients(client, route)
+        if not recipients: return
         payload = {
             'type': 'group_file_chunk',
             'transfer_id': data['transfer_id'],
@@ -690,13 +999,18 @@ class ChatServer:
             'data': data.get('data',''),
             'sender': sender
         }
-        self._broadcast_group(gid, sender, payload)
+        self.fanout(recipients, payload)
 
     def send_group_file_end(self, client, data):
         if client not in self.clients: return
-        sender = self.clients[client]['username']
+        uid, sender = self.clients[client]['uid'], self.clients[client]['username']
+        route = self.transfers.get(client, {}).pop(data.get('transfer_id'), None)
+        if route and data.get('aborted'):
+            self._abort_transfer(uid, route); return
+        if route:
+            self._complete_transfer(client, route)
         gid = data.get('group_id')
-        if not gid or gid not in self.groups or sender not in self.groups[gid]['members']:
+        if not gid or gid not in self.groups or uid not in self.groups[gid]['members']:
             return
         payload = {
             'type': 'group_file_end',
@@ -704,27 +1018,446 @@ class ChatServer:
             'group_id': gid,
             'sender': sender
         }
-        self._broadcast_group(gid, sender, payload)
+        self._broadcast_group(gid, uid, payload)
+
+    # --- spooled transfers (spool mode only) ---
+    def _refuse_start(self, client, data, message):
+        # With the transfer_id the sender can end that upload instead of
+        # sending chunks that will never be acked
+        self.send_json(client, {'success': False, 'message': message, 'transfer_id': data.get('transfer_id')})
+
+    def _spool_upload(self, client, data, total, recipient=None, group_id=None):
+        # Open the spool file for a *_start request; None (after replying) if refused
+        try:
+            chunk_size = int(data.get('chunk_size', SPOOL_CHUNK_SIZE))
+            total = int(total)
+        except (TypeError, ValueError):
+            chunk_size = 0
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE or total < 0:
+            self._refuse_start(client, data, 'Invalid file size')
+            return None
+        return self.spool.create(data.get('filename'), total, chunk_size, self.clients[client]['uid'],
+                                 recipient=recipient, group_id=group_id)
+
+    def _spool_chunk(self, route, data):
+        try:
+            chunk = raw_bytes(data.get('data', b''))
+            self.spool.write(route['spool'], int(data.get('seq', 0)), chunk)
+        except (TypeError, ValueError):
+            pass
+
+    def _finish_upload(self, client, route):
+        # Make the file downloadable and tell whoever missed the live transfer:
+        # the recipient or group members offline at the start or now
+        spooled = route['spool']
+        self.spool.finish(spooled)
+        notice = {
+            'type': 'file_available',
+            'file_id': spooled.file_id,
+            'filename': spooled.filename,
+            'total_size': spooled.total_size,
+            'chunk_size': spooled.chunk_size,
+            'sender': self.clients[client]['username'],
+            'timestamp': datetime.now().strftime('%H:%M')
+        }
+        missed = route['absent']
+        gid = spooled.group_id
+        if gid is not None:
+            if gid not in self.groups: return
+            notice['group_id'] = gid
+            notice['group_name'] = self.groups[gid]['name']
+            members = tuple(self.groups[gid]['members'])
+            missed = (missed & set(members)) | {m for m in members if m not in self.sessions}
+            missed.discard(spooled.sender)
+        elif spooled.recipient not in self.sessions:
+            missed = missed | {spooled.recipient}      # went offline during the upload
+        body = json.dumps(notice).encode('utf-8')
+        for uid in missed:
+            online = self._sessions_of([uid])
+            if not online:
+                self.mailbox.put(uid, body)
+            elif not self.mailbox.offer(uid, body):
+                self.fanout(online, notice)
+
+    def _miss_spooled(self, uid):
+        # uid went offline: the live chunks of spooled uploads it receives
+        # stop reaching it, so it gets file_available when they finish
+        for route in tuple(self.routes.values()):
+            if 'spool' in route and uid != route['sender'] and self._receives(uid, route):
+                route['absent'].add(uid)
+
+    def fetch_file(self, client, data):
+        # Up to FETCH_WINDOW chunks of a spooled file, from 'seq' on, each a
+        # file_chunk push read straight from the spool's mapping
+        if client not in self.clients:
+            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
+        uid = self.clients[client]['uid']
+        spooled = self.spool.get(data.get('file_id')) if self.spool is not None else None
+        if spooled is None:
+            self.send_json(client, {'success': False, 'message': 'File not found'}); return
+        gid = spooled.group_id
+        if gid is not None:
+            allowed = gid in self.groups and uid in self.groups[gid]['members']
+        else:
+            allowed = uid in (spooled.recipient, spooled.sender)
+        if not allowed:
+            self.send_json(client, {'success': False, 'message': 'File not found'}); return
+        try:
+            seq = max(int(data.get('seq', 0)), 0)
+            count = min(max(int(data.get('count', FETCH_WINDOW)), 1), FETCH_WINDOW)
+        except (TypeError, ValueError):
+            self.send_json(client, {'success': False, 'message': 'Invalid range'}); return
+        sender = self._name(spooled.sender) if spooled.sender in self.users else ''
+        for i in range(seq, min(seq + count, spooled.chunks)):
+            self.send_json(client, {
+                'type': 'file_chunk',
+                'transfer_id': spooled.file_id,
+                'seq': i,
+                'data': self.spool.read(spooled, i),
+                'sender': sender
+            })
+
+    # --- zero-parse chunk relay ---
+    def _register_transfer(self, client, transfer_id, route):
+        uid = self.clients[client]['uid']
+        route['transfer_id'] = transfer_id
+        route['sender'] = uid
+        route['client'] = client  # the sender's current connection, None while parked
+        route['next_seq'] = 0     # chunks 0..next_seq-1 have arrived
+        self.transfers.setdefault(client, {})[transfer_id] = route
+        self.routes[(uid, transfer_id)] = route
+
+    def _accept_chunk(self, client, route, seq):
+        # Chunks are taken strictly in order: one resent after a resume (seq
+        # below next_seq) or past a gap is dropped. Every chunk is answered
+        # with a file_ack carrying the highest contiguous seq received.
+        try:
+            accepted = int(seq) == route['next_seq']
+        except (TypeError, ValueError):
+            accepted = False
+        if accepted:
+            route['next_seq'] += 1
+        head = route.get('ack_head')
+        if head is None:
+            head = route['ack_head'] = b'{"type": "file_ack", "transfer_id": %s, "seq": ' % (
+                json.dumps(route['transfer_id']).encode('utf-8'))
+        body = head + b'%d}' % (route['next_seq'] - 1)
+        self.send_raw(client, body + b'\n' if client.wire_version == WIRE_V1 else wrap_json_v2(body))
+        return accepted
+
+    def _complete_transfer(self, client, route):
+        # The final ack tells the sender the upload is done and needs no resume
+        self.routes.pop((route['sender'], route['transfer_id']), None)
+        if 'spool' in route:
+            self._finish_upload(client, route)
+        self.send_json(client, {'type': 'file_ack', 'transfer_id': route['transfer_id'],
+                                'seq': route['next_seq'] - 1, 'complete': True})
+
+    # --- credit flow control (common/flow.py has the sender side) ---
+    def file_credit(self, client, data):
+        # A receiver has consumed chunks up to 'seq' of 'sender''s transfer
+        # (-1 on file_start: it will grant); the sender hears the lowest
+        # credit of the receivers still granting
+        if client not in self.clients: return
+        uid = self.clients[client]['uid']
+        route = self.routes.get((self.user_ids.get(data.get('sender')), data.get('transfer_id')))
+        if route is None or not self._receives(uid, route): return
+        try:
+            seq = int(data.get('seq'))
+        except (TypeError, ValueError):
+            return
+        credits = route.setdefault('credits', {})    # {receiver uid: seq}
+        if uid not in credits or seq > credits[uid]:
+            credits[uid] = seq
+            self._relay_credit(route)
+
+    def _receives(self, uid, route):
+        if route['type'] == 'file_chunk':
+            return uid == route['recipient']
+        gid = route['group_id']
+        return gid in self.groups and uid in self.groups[gid]['members']
+
+    def _relay_credit(self, route):
+        # Receivers that went offline or left the group stop counting; with
+        # none left the sender is told (seq None) to pace by file_ack alone
+        credits = route['credits']
+        for uid in [u for u in tuple(credits) if u not in self.sessions or not self._receives(u, route)]:
+            credits.pop(uid, None)
+        granted = min(credits.values(), default=None)
+        if granted == route.get('granted') or route['client'] is None:
+            return
+        route['granted'] = granted
+        self.send_json(route['client'], {'type': 'file_credit', 'transfer_id': route['transfer_id'], 'seq': granted})
+
+    def _drop_credits(self, uid):
+        # uid went offline or left a group: it no longer holds back any sender
+        for route in tuple(self.routes.values()):
+            if uid in route.get('credits', ()):
+                self._relay_credit(route)
+
+    # --- interrupted uploads ---
+    def resume_transfer(self, client, data):
+        # Continue an upload after reconnecting: the transfer is re-attached
+        # to this connection and the reply says which chunk to send next
+        if client not in self.clients:
+            self.send_json(client, {'success': False, 'message': 'Not logged in'}); return
+        uid = self.clients[client]['uid']
+        transfer_id = data.get('transfer_id')
+        with self.parked_lock:
+            route = self.parked.pop((uid, transfer_id), None)
+        if route is None:
+            # The old connection may not have been noticed as closed yet
+            for sock in tuple(self.sessions.get(uid, ())):
+                if sock is not client and transfer_id in self.transfers.get(sock, {}):
+                    route = self.transfers[sock].pop(transfer_id, None)
+                    break
+        if route is None:
+            self.send_json(client, {'success': False, 'message': 'Unknown transfer'}); return
+        route.pop('parked_at', None)
+        route['client'] = client
+        self.transfers.setdefault(client, {})[transfer_id] = route
+        self.send_json(client, {'transfer_id': transfer_id, 'received_seq': route['next_seq'] - 1})
+
+    def _park_transfers(self, uid, routes):
+        now = time.time()
+        with self.parked_lock:
+            for transfer_id, route in routes.items():
+                route['parked_at'] = now
+                route['client'] = None
+                self.parked[(uid, transfer_id)] = route
+        self._expire_parked()
+
+    def _expire_parked(self):
+        cutoff = time.time() - RESUME_TIMEOUT
+        with self.parked_lock:
+            expired = [(key, route) for key, route in self.parked.items() if route['parked_at'] < cutoff]
+            for key, _ in expired:
+                del self.parked[key]
+        for (sender, _), route in expired:
+            self._abort_transfer(sender, route)
+
+    def _sweep_parked(self):
+        # Expired uploads are aborted within SWEEP_INTERVAL even if no other
+        # disconnect comes along to park (and so sweep) a transfer
+        while self.running:
+            time.sleep(SWEEP_INTERVAL)
+            if self.loop is None:
+                self._expire_parked()
+                continue
+            try:    # asyncio: sends belong on the event loop thread
+                self.loop.call_soon_threadsafe(self._expire_parked)
+            except RuntimeError:    # event loop already closed
+                return
+
+    def _abort_transfer(self, uid, route):
+        # Tell recipients an upload will not finish so they drop what they have
+        self.routes.pop((uid, route['transfer_id']), None)
+        if 'spool' in route:
+            self.spool.discard(route['spool'])
+        payload = {'transfer_id': route['transfer_id'], 'sender': self._name(uid), 'aborted': True}
+        if route['type'] == 'file_chunk':
+            self.fanout(self._sessions_of([route['recipient']]), dict(payload, type='file_end'))
+        elif route['group_id'] in self.groups:
+            self._broadcast_group(route['group_id'], uid,
+                                  dict(payload, type='group_file_end', group_id=route['group_id']))
+
+    def _transfer_recipients(self, client, route):
+        # Online sockets a chunk of this transfer goes to, or None if the route is no longer valid
+        uid = self.clients[client]['uid']
+        if route['type'] == 'file_chunk':
+            return self._sessions_of([route['recipient']])
+        gid = route['group_id']
+        if gid not in self.groups or uid not in self.groups[gid]['members']:
+            return None
+        return self._online_members(gid, exclude=uid)
+
+    def _chunk_splice(self, route, sender):
+        # JSON members appended to a relayed chunk line; later keys win, so these
+        # override any 'type'/'sender'/'group_id' the sender put in the line
+        if route.get('splice_for') != sender:
+            extra = {'sender': sender, 'type': route['type']}
+            if 'group_id' in route:
+                extra['group_id'] = route['group_id']
+            route['splice'] = (', ' + json.dumps(extra)[1:]).encode('utf-8')
+            route['splice_for'] = sender
+        return route['splice']
+
+    def relay_chunk_line(self, client, line):
+        # Forward a v1 chunk line of a registered transfer without decoding the
+        # payload: match the routing head, append sender/type, pass the bytes on.
+        # Returns False when the line must take the normal json.loads path.
+        m = CHUNK_HEAD.match(line)
+        if not m or client not in self.clients:
+            return False
+        try:
+            transfer_id = json.loads(m.group(2))
+        except ValueError:
+            return False
+        route = self.transfers[client].get(transfer_id)
+        if not route or route['type'] != m.group(1).decode()[len('send_'):] or 'spool' in route:
+            return False
+        end = len(line)
+        while end and line[end - 1] in b' \t\r':
+            end -= 1
+        if not end or line[end - 1] != ord('}'):
+            return False
+        if not self._accept_chunk(client, route, int(m.group(3))):
+            return True
+        recipients = self._transfer_recipients(client, route)
+        if not recipients:
+            return True
+        splice = self._chunk_splice(route, self.clients[client]['username'])
+        with memoryview(line) as view:
+            body = b''.join((view[:end - 1], splice))
+        encoded = {}
+        for cli in recipients:
+            version = cli.wire_version
+            data = encoded.get(version)
+            if data is None:
+                data = encoded[version] = body + b'\n' if version == WIRE_V1 else wrap_json_v2(body)
+            self.send_raw(cli, data)
+        return True
+
+    # --- offline mailbox delivery, called on the drainer thread ---
+    def _mail_ready(self, uid):
+        # None once uid is offline; False while any session is still sending
+        # the previous batch, so queued mail never piles up in server memory
+        sessions = self._sessions_of([uid])
+        if not sessions:
+            return None
+        low = self.outbound_limits.low
+        return all(cli.queue_depth() < low for cli in sessions)
+
+    def _deliver_mail(self, uid, bodies):
+        # One batch as a single write per session: newline-joined on v1,
+        # back-to-back frames on v2. Each send runs on the session's owner
+        # thread and is waited for, so the next _mail_ready sees its bytes.
+        sessions = self._sessions_of([uid])
+        done = threading.Semaphore(0)
+        encoded = {}
+        for cli in sessions:
+            version = cli.wire_version
+            data = encoded.get(version)
+            if data is None:
+                if version == WIRE_V2:
+                    data = b''.join(wrap_json_v2(body) for body in bodies)
+                else:
+                    data = b''.join(body + b'\n' for body in bodies)
+                encoded[version] = data
+
+            def send(cli=cli, data=data):
+                self.send_raw(cli, data)
+                done.release()
+            try:
+                cli.call_soon(send)
+            except RuntimeError:    # event loop already closed
+                done.release()
+        for _ in sessions:
+            done.acquire(timeout=5)
+
+    # --- session registry: self.clients (socket -> session) and self.sessions (uid -> sockets) ---
+    def _add_session(self, client, uid):
+        if client in self.clients:      # re-login on the same socket
+            self._remove_session(client)
+        user = self.users[uid]
+        self.clients[client] = {'uid': uid, 'username': user['username'], 'profile': user['profile']}
+        self.sessions.setdefault(uid, set()).add(client)
+        for gid in self.user_groups.get(uid, ()):
+            self.groups[gid]['online'].add(client)
+
+    def _remove_session(self, client):
+        uid = self.clients.pop(client)['uid']
+        for gid in self.user_groups.get(uid, ()):
+            self.groups[gid]['online'].discard(client)
+        sockets = self.sessions.get(uid)
+        if sockets is not None:
+            sockets.discard(client)
+            if not sockets:
+                del self.sessions[uid]
+        return uid
 
     # --- helpers ---
-    def _find_client(self, username):
-        for cli, cd in self.clients.items():
-            if cd['username'] == username:
-                return cli
-        return None
-
-    def _broadcast_group(self, group_id, sender, payload):
-        for member in self.groups.get(group_id, {}).get('members', []):
-            if member == sender: continue
-            cli = self._find_client(member)
-            if cli:
-                self.send_json(cli, payload)
+    def _name(self, uid):
+        return self.users[uid]['username']
+
+    def _conversation_key(self, uid=None, peer=None, group_id=None):
+        # History log name of a group, or of the private conversation of two users
+        if group_id is not None:
+            return f'g-{group_id}'
+        return f'p-{min(uid, peer)}-{max(uid, peer)}'
+
+    def _index_user(self, uid):
+        user = self.users[uid]
+        self.search_index.set(uid, user['username'], user['profile'].get('nickname', ''))
+
+    def _sessions_of(self, uids, exclude=None):
+        # Every online socket of the given users, skipping uid `exclude`;
+        # iterates a snapshot since `uids` may be a live followers/members set
+        recipients = []
+        for uid in tuple(uids):
+            if uid != exclude:
+                recipients.extend(self.sessions.get(uid, ()))
+        return recipients
+
+    def _broadcast_group(self, group_id, sender_uid, payload):
+        if group_id in self.groups:
+            self.fanout(self._online_members(group_id, exclude=sender_uid), payload)
 
 # --- ADDED main entry point (was missing) ---
 if __name__ == "__main__":
-    server = ChatServer()
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=12345)
+    parser.add_argument('--engine', choices=ENGINES, default='thread',
+                        help="thread: one thread per client, asyncio: single event loop, "
+                             "reactor: N selector loops")
+    parser.add_argument('--reactors', type=int, default=None,
+                        help="number of reactor threads for --engine reactor (default: CPU count)")
+    parser.add_argument('--balance', choices=('round_robin', 'least_loaded'), default='round_robin')
+    parser.add_argument('--high-watermark', type=int, default=DEFAULT_LIMITS.high,
+                        help="outbound bytes per client above which typing/status events are dropped")
+    parser.add_argument('--low-watermark', type=int, default=DEFAULT_LIMITS.low)
+    parser.add_argument('--queue-limit', type=int, default=DEFAULT_LIMITS.limit,
+                        help="outbound bytes per client above which the client is disconnected")
+    parser.add_argument('--store', choices=('sqlite', 'memory'), default='sqlite',
+                        help="sqlite: keep users/contacts/groups in --db across restarts, memory: keep nothing")
+    parser.add_argument('--db', default='chat.db', help="SQLite database file for --store sqlite")
+    parser.add_argument('--history-dir', default=None,
+                        help="directory for message history logs ('' keeps only recent messages in memory; "
+                             "default: 'history' with --store sqlite, '' with --store memory)")
+    parser.add_argument('--mailbox-dir', default='',
+                        help="directory where queued offline messages spill past --mailbox-memory "
+                             "(default: a temporary directory)")
+    parser.add_argument('--mailbox-memory', type=int, default=64 * 1024 * 1024,
+                        help="bytes of queued offline messages kept in memory, across all users")
+    parser.add_argument('--spool-dir', default='',
+                        help="keep chunked file transfers in this directory so offline recipients "
+                             "can download them later (default: relay to online recipients only; "
+                             "needs --store sqlite)")
+    parser.add_argument('--stats-admin', action='append', default=[], metavar='USERNAME',
+                        help="user allowed to call get_stats (repeatable; default: nobody)")
+    args = parser.parse_args()
+    if args.history_dir is None:
+        args.history_dir = 'history' if args.store == 'sqlite' else ''
+    if args.store == 'memory' and (args.history_dir or args.spool_dir):
+        # uids are reused after a restart, so old logs would reach new users
+        parser.error("--history-dir and --spool-dir need --store sqlite")
+    store = SQLiteStore(args.db) if args.store == 'sqlite' else MemoryStore()
+    history = MessageLog(args.history_dir or None)
+    mailbox = Mailbox(args.mailbox_dir or None, args.mailbox_memory)
+    spool = FileSpool(args.spool_dir) if args.spool_dir else None
+    server = ChatServer(args.host, args.port, engine=args.engine,
+                        reactors=args.reactors, balance=args.balance,
+                        outbound_limits=OutboundLimits(args.high_watermark, args.low_watermark, args.queue_limit),
+                        store=store, history=history, mailbox=mailbox, spool=spool,
+                        stats_admins=args.stats_admin)
     try:
         server.start_server()
     except KeyboardInterrupt:
         print("\nServer shutting down...")
-        server.running = False
\ No newline at end of file
+        server.running = False
+    store.close()
+    history.close()
+    mailbox.close()
+    if spool is not None:
+        spool.close()
\ No newline at end of file
@@ -0,0 +1,76 @@
+import asyncio
+
+from common.framing import FrameDecoder, FrameTooLarge
+from outbound import ADMIT, OVERFLOW, Connection, FlowState
+
+
+class AsyncConnection(Connection):
+    # Socket-like handle for an asyncio transport, so ChatServer handlers
+    # (send_json / disconnect_client) work unchanged on either engine.
+    # The transport's write buffer is the outbound queue.
+    def __init__(self, transport, limits):
+        self.transport = transport
+        self.loop = asyncio.get_running_loop()
+        self.address = transport.get_extra_info('peername')
+        self.flow = FlowState(limits)
+        self.decoder = FrameDecoder()
+        transport.set_write_buffer_limits(high=limits.high, low=limits.low)
+
+    def queue_depth(self):
+        return self.transport.get_write_buffer_size()
+
+    def send(self, data, droppable=False):
+        if self.transport.is_closing():
+            raise OSError('Connection closed')
+        verdict = self.flow.admit(self.queue_depth(), len(data), droppable)
+        if verdict == OVERFLOW:
+            self.transport.abort()      # connection_lost() runs disconnect_client
+            raise OSError('Outbound queue overflow')
+        if verdict == ADMIT:
+            self.transport.write(data)
+            return len(data)
+        return 0
+
+    def call_soon(self, fn):
+        self.loop.call_soon_threadsafe(fn)
+
+    def close(self):
+        self.transport.close()
+
+
+class ChatProtocol(asyncio.Protocol):
+    # One instance per connection; no thread, just a buffer and a handle.
+    def __init__(self, server):
+        self.server = server
+        self.conn = None
+
+    def connection_made(self, transport):
+        self.conn = AsyncConnection(transport, self.server.outbound_limits)
+        print(f"Connected with {str(self.conn.address)}")
+
+    def data_received(self, data):
+        try:
+            frames = self.conn.decoder.feed(data)
+        except FrameTooLarge:
+            self.conn.transport.abort()
+            return
+        for line in frames:
+            self.server.handle_frame(self.conn, line)
+
+    def connection_lost(self, exc):
+        self.server.disconnect_client(self.conn)
+
+
+async def serve(server):
+    loop = asyncio.get_running_loop()
+    srv = await loop.create_server(lambda: ChatProtocol(server),
+                                   server.host, server.port,
+                                   reuse_address=True, backlog=1024)
+    server.loop = loop
+    print(f"Server listening on {server.host}:{server.port} (asyncio)")
+    async with srv:
+        await srv.serve_forever()
+
+
+def run(server):
+    asyncio.run(serve(server))
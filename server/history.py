@@ -0,0 +1,223 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+
+from locks import LockStripes
+
+SEGMENT_SUFFIX = '.log'
+
+
+class _Conversation:
+    # One conversation's log: segment files named by their first seq, each
+    # holding up to segment_size JSON lines, plus the newest records in memory.
+    def __init__(self, path, tail_size):
+        self.path = path
+        self.lock = threading.Lock()
+        self.starts = []        # first seq of each segment, ascending
+        self.times = []         # first timestamp of each segment
+        self.next_seq = 1
+        self.active_count = 0   # records in the last segment
+        self.tail = deque(maxlen=tail_size)
+        self.file = None        # append handle on the last segment, see MessageLog._handles
+        self.evicted = False    # dropped from the cache; holders must look it up again
+
+
+class MessageLog:
+    # Append-only message history, one segmented log per conversation under
+    # `root`. Sequence numbers start at 1 per conversation. Pages are read
+    # from the in-memory tail when it covers them, from disk otherwise.
+    # With root=None nothing is written and only the tail is kept.
+    def __init__(self, root=None, segment_size=1000, tail_size=200, max_cached=4096, max_open=128):
+        self.root = root
+        self.segment_size = segment_size
+        self.tail_size = tail_size
+        self.max_cached = max_cached    # conversations kept in memory (with their tail)
+        self.max_open = max_open        # segment files kept open for appending
+        self._lock = threading.Lock()   # guards the two LRUs below, never held during I/O
+        self._convs = OrderedDict()     # {key: _Conversation}
+        self._handles = OrderedDict()   # {key: _Conversation} with an open file
+        self._opening = LockStripes()   # one loader per key, so a load never races an eviction
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+
+    def append(self, key, sender, message, ts=None):
+        """Add a message to conversation `key`; returns the stored record."""
+        conv = self._acquire(key)
+        try:
+            record = {'seq': conv.next_seq, 'ts': ts if ts is not None else time.time(),
+                      'sender': sender, 'message': message}
+            conv.next_seq += 1
+            if self.root is not None:
+                self._write(key, conv, record)
+            conv.tail.append(record)
+        finally:
+            conv.lock.release()
+        return record
+
+    def fetch(self, key, before=None, limit=50):
+        """Up to `limit` records with seq < before (newest when before is
+        None), oldest first, and the cursor for the page before them (None
+        once the start of the conversation is reached)."""
+        conv = self._acquire(key)
+        try:
+            end = conv.next_seq if before is None else min(before, conv.next_seq)
+            # Without a disk log nothing older than the tail is left
+            floor = 1 if self.root is not None else (conv.tail[0]['seq'] if conv.tail else conv.next_seq)
+            start = max(floor, end - limit)
+            if conv.tail and conv.tail[0]['seq'] <= start:
+                first = conv.tail[0]['seq']
+                records = [conv.tail[i - first] for i in range(start, end)]
+            else:
+                records = self._read_range(conv, start, end)
+        finally:
+            conv.lock.release()
+        return records, (start if start > floor else None)
+
+    def seq_at(self, key, ts):
+        """First seq whose record is at or after time `ts` (a fetch cursor)."""
+        conv = self._acquire(key)
+        try:
+            if conv.tail and conv.tail[0]['ts'] <= ts:
+                for record in conv.tail:
+                    if record['ts'] >= ts:
+                        return record['seq']
+                return conv.next_seq
+            i = bisect_right(conv.times, ts) - 1
+            if i < 0:
+                return 1
+            for record in self._read_segment(conv, i):
+                if record['ts'] >= ts:
+                    return record['seq']
+            return conv.starts[i + 1] if i + 1 < len(conv.starts) else conv.next_seq
+        finally:
+            conv.lock.release()
+
+    def close(self):
+        with self._lock:
+            convs = list(self._handles.values())
+            self._handles.clear()
+        for conv in convs:
+            with conv.lock:
+                if conv.file is not None:
+                    conv.file.close()
+                    conv.file = None
+
+    # --- conversations and file handles ---
+    def _acquire(self, key):
+        # The conversation for `key`, locked by the caller's thread
+        while True:
+            conv = self._conversation(key)
+            conv.lock.acquire()
+            if not conv.evicted:
+                return conv
+            conv.lock.release()
+
+    def _conversation(self, key):
+        with self._lock:
+            conv = self._convs.get(key)
+            if conv is not None:
+                self._convs.move_to_end(key)
+                return conv
+        with self._opening.hold(key):
+            with self._lock:
+                conv = self._convs.get(key)
+                if conv is not None:    # another thread loaded it meanwhile
+                    return conv
+            conv = self._open(key)
+            with self._lock:
+                self._convs[key] = conv
+                if len(self._convs) > self.max_cached:
+                    self._evict(self._convs, _retire)
+        return conv
+
+    def _evict(self, lru, release):
+        # Drop the least recently used entry that nobody is using right now
+        for key, conv in lru.items():
+            if conv.lock.acquire(blocking=False):
+                try:
+                    release(conv)
+                finally:
+                    conv.lock.release()
+                del lru[key]
+                return
+
+    def _open(self, key):
+        conv = _Conversation(os.path.join(self.root, key) if self.root is not None else None, self.tail_size)
+        if conv.path is None or not os.path.isdir(conv.path):
+            return conv
+        names = sorted(n for n in os.listdir(conv.path) if n.endswith(SEGMENT_SUFFIX))
+        conv.starts = [int(n[:-len(SEGMENT_SUFFIX)]) for n in names]
+        for i in range(len(conv.starts)):
+            first = self._read_segment(conv, i, limit=1)
+            conv.times.append(first[0]['ts'] if first else 0)
+        if conv.starts:
+            last = self._read_segment(conv, len(conv.starts) - 1)
+            conv.active_count = len(last)
+            conv.next_seq = last[-1]['seq'] + 1 if last else conv.starts[-1]
+            older = self._read_range(conv, max(1, conv.next_seq - self.tail_size), conv.starts[-1])
+            conv.tail.extend(older + last)
+        return conv
+
+    def _write(self, key, conv, record):
+        if conv.file is None or conv.active_count >= self.segment_size:
+            if conv.file is not None:
+                conv.file.close()
+                conv.file = None
+            if not conv.starts or conv.active_count >= self.segment_size:
+                os.makedirs(conv.path, exist_ok=True)
+                conv.starts.append(record['seq'])
+                conv.times.append(record['ts'])
+                conv.active_count = 0
+            conv.file = open(self._segment_path(conv, len(conv.starts) - 1), 'ab')
+            self._track_handle(key, conv)
+        conv.file.write((json.dumps(record) + '\n').encode('utf-8'))
+        conv.file.flush()
+        conv.active_count += 1
+
+    def _track_handle(self, key, conv):
+        with self._lock:
+            self._handles[key] = conv
+            self._handles.move_to_end(key)
+            if len(self._handles) > self.max_open:
+                self._evict(self._handles, _close_file)
+
+    # --- reading segments ---
+    def _segment_path(self, conv, i):
+        return os.path.join(conv.path, f'{conv.starts[i]:012d}{SEGMENT_SUFFIX}')
+
+    def _read_segment(self, conv, i, limit=None):
+        records = []
+        with open(self._segment_path(conv, i), 'rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:      # torn last line after a crash
+                    continue
+                if len(records) == limit:
+                    break
+        return records
+
+    def _read_range(self, conv, start, end):
+        # Records with start <= seq < end, read from the segments covering them
+        records = []
+        if conv.path is None or start >= end:
+            return records
+        first = max(bisect_right(conv.starts, start) - 1, 0)
+        last = bisect_left(conv.starts, end)
+        for i in range(first, last):
+            records.extend(r for r in self._read_segment(conv, i) if start <= r['seq'] < end)
+        return records
+
+
+def _close_file(conv):
+    if conv.file is not None:
+        conv.file.close()
+        conv.file = None
+
+
+def _retire(conv):
+    _close_file(conv)
+    conv.evicted = True
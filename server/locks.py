@@ -0,0 +1,38 @@
+import threading
+from zlib import crc32
+
+DEFAULT_STRIPES = 64
+
+
+class LockStripes:
+    # A fixed pool of locks shared by many keys: each key (a uid, a group id)
+    # maps to one stripe. hold() takes the stripes of all its keys in stripe
+    # order, so two threads locking overlapping key sets cannot deadlock, and
+    # threads working on unrelated keys rarely wait for each other.
+    def __init__(self, count=DEFAULT_STRIPES):
+        self._locks = [threading.Lock() for _ in range(count)]
+
+    def _index(self, key):
+        if isinstance(key, int):
+            return key % len(self._locks)
+        return crc32(str(key).encode('utf-8')) % len(self._locks)
+
+    def hold(self, *keys):
+        """Context manager holding the stripes of every key (None keys are skipped)."""
+        return _Held([self._locks[i] for i in sorted({self._index(k) for k in keys if k is not None})])
+
+
+class _Held:
+    __slots__ = ('locks',)
+
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        for lock in reversed(self.locks):
+            lock.release()
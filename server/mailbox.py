@@ -0,0 +1,181 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+SPOOL_SUFFIX = '.spool'
+
+
+class Mailbox:
+    # Per-user queue of undelivered messages, each an encoded JSON object
+    # (bytes, no newline). Queues live in memory until all of them together
+    # pass memory_limit bytes; then the least recently written queues are
+    # appended to per-user spool files. A user's spooled messages are always
+    # older than the ones in memory, so take() reads the file first.
+    # Spool files are scratch space: they are cleared when the mailbox starts.
+    # With root=None they go to a temporary directory, removed by close().
+    def __init__(self, root=None, memory_limit=64 * 1024 * 1024):
+        self.root = root
+        self._temporary = False
+        self.memory_limit = memory_limit
+        self.memory = 0                 # bytes queued in memory, all users
+        self._lock = threading.Lock()
+        self._queues = OrderedDict()    # {uid: deque of bodies}, least recently written first
+        self._spooled = {}              # {uid: read offset into its spool file}
+        self._draining = set()          # uids whose queue is being delivered
+        if root is not None:
+            os.makedirs(root, exist_ok=True)
+            for name in os.listdir(root):
+                if name.endswith(SPOOL_SUFFIX):
+                    os.remove(os.path.join(root, name))
+
+    def put(self, uid, body):
+        with self._lock:
+            self._append(uid, body)
+
+    def offer(self, uid, body):
+        """Queue `body` if uid already has queued or draining messages, so it is
+        delivered after them; returns False when the caller may deliver it directly."""
+        with self._lock:
+            if uid not in self._draining and uid not in self._queues and uid not in self._spooled:
+                return False
+            self._append(uid, body)
+            return True
+
+    def start_drain(self, uid):
+        """Mark uid as draining; False if it has nothing queued."""
+        with self._lock:
+            if uid not in self._queues and uid not in self._spooled:
+                return False
+            self._draining.add(uid)
+            return True
+
+    def stop_drain(self, uid):
+        with self._lock:
+            self._draining.discard(uid)
+
+    def take(self, uid, max_bytes):
+        """Remove and return the oldest queued bodies, about max_bytes of them.
+        An empty result also ends the drain, atomically with respect to offer()."""
+        with self._lock:
+            if uid in self._spooled:
+                bodies = self._read_spool(uid, max_bytes)
+                if bodies:
+                    return bodies
+            queue = self._queues.get(uid)
+            bodies = []
+            size = 0
+            while queue and size < max_bytes:
+                body = queue.popleft()
+                bodies.append(body)
+                size += len(body)
+            self.memory -= size
+            if queue is not None and not queue:
+                del self._queues[uid]
+            if not bodies:
+                self._draining.discard(uid)
+            return bodies
+
+    def pending(self, uid):
+        with self._lock:
+            return uid in self._queues or uid in self._spooled
+
+    def close(self):
+        with self._lock:
+            self._queues.clear()
+            self._spooled.clear()
+            self.memory = 0
+            if self._temporary:
+                shutil.rmtree(self.root, ignore_errors=True)
+
+    # --- lock held ---
+    def _append(self, uid, body):
+        queue = self._queues.get(uid)
+        if queue is None:
+            queue = self._queues[uid] = deque()
+        else:
+            self._queues.move_to_end(uid)
+        queue.append(body)
+        self.memory += len(body)
+        while self.memory > self.memory_limit and self._queues:
+            self._spill(next(iter(self._queues)))
+
+    def _spill(self, uid):
+        if self.root is None:
+            self.root = tempfile.mkdtemp(prefix='chat-mailbox-')
+            self._temporary = True
+        queue = self._queues.pop(uid)
+        with open(self._spool_path(uid), 'ab') as f:
+            f.write(b''.join(body + b'\n' for body in queue))
+        self.memory -= sum(len(body) for body in queue)
+        self._spooled.setdefault(uid, 0)
+
+    def _read_spool(self, uid, max_bytes):
+        path = self._spool_path(uid)
+        with open(path, 'rb') as f:
+            f.seek(self._spooled[uid])
+            data = f.read(max_bytes)
+            if data and not data.endswith(b'\n'):
+                data += f.readline()    # finish the last message
+        if not data:
+            os.remove(path)
+            del self._spooled[uid]
+            return []
+        self._spooled[uid] += len(data)
+        return data.rstrip(b'\n').split(b'\n')
+
+    def _spool_path(self, uid):
+        return os.path.join(self.root, f'{uid}{SPOOL_SUFFIX}')
+
+
+class MailboxDrainer(threading.Thread):
+    # Delivers queued mail after login, one batch per user at a time and only
+    # while that user's connections have room, so a large mailbox neither
+    # fills server memory nor holds up the login handler or other users.
+    #   ready(uid)  -> True to send now, False to wait, None if uid went offline
+    #   deliver(uid, bodies) sends one batch
+    def __init__(self, mailbox, ready, deliver, batch_bytes=64 * 1024, idle=0.005):
+        super().__init__(name='mailbox-drainer', daemon=True)
+        self.mailbox = mailbox
+        self.ready = ready
+        self.deliver = deliver
+        self.batch_bytes = batch_bytes
+        self.idle = idle
+        self._active = deque()
+        self._cond = threading.Condition()
+
+    def add(self, uid):
+        """Start delivering uid's mail, if it has any."""
+        # Starting and ending a drain both happen under _cond, so a login
+        # racing the end of the previous drain can't leave mail stranded.
+        with self._cond:
+            if self.mailbox.start_drain(uid) and uid not in self._active:
+                self._active.append(uid)
+                self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                users = list(self._active)
+            progressed = False
+            for uid in users:
+                with self._cond:
+                    ready = self.ready(uid)
+                    if ready is None:
+                        self.mailbox.stop_drain(uid)
+                        self._active.remove(uid)
+                        continue
+                    if not ready:
+                        continue
+                    bodies = self.mailbox.take(uid, self.batch_bytes)
+                    if not bodies:
+                        self._active.remove(uid)
+                        continue
+                self.deliver(uid, bodies)
+                progressed = True
+            if not progressed:
+                time.sleep(self.idle)
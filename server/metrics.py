@@ -0,0 +1,64 @@
+import threading
+
+# Latency histogram buckets: bucket i counts calls that took fewer than 2**i
+# microseconds (bucket 0: under 1us); the last bucket takes everything slower.
+BUCKETS = 24    # 2**23 us ~ 8.4s
+
+
+class ActionStats:
+    # Per-action call counts, error counts and latency histograms, updated
+    # by the dispatcher on every message and read by get_stats.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._actions = {}  # {action: [count, errors, total_us, max_us, histogram]}
+
+    def record(self, action, seconds, failed=False):
+        us = int(seconds * 1e6)
+        bucket = min(us.bit_length(), BUCKETS - 1)
+        with self._lock:
+            entry = self._actions.get(action)
+            if entry is None:
+                entry = self._actions[action] = [0, 0, 0, 0, [0] * BUCKETS]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += us
+            if us > entry[3]:
+                entry[3] = us
+            entry[4][bucket] += 1
+
+    def snapshot(self):
+        """{action: summary}, most total time first. Percentiles are bucket
+        upper bounds, so they overstate by at most a factor of two."""
+        with self._lock:
+            entries = [(a, e[0], e[1], e[2], e[3], list(e[4])) for a, e in self._actions.items()]
+        summary = {}
+        for action, count, errors, total, peak, hist in sorted(entries, key=lambda e: -e[3]):
+            summary[action] = {
+                'count': count,
+                'errors': errors,
+                'total_ms': round(total / 1000, 3),
+                'mean_us': round(total / count, 1),
+                'p50_us': _percentile(hist, count, 0.50),
+                'p99_us': _percentile(hist, count, 0.99),
+                'max_us': peak,
+                'histogram': {_bucket_label(i): n for i, n in enumerate(hist) if n},
+            }
+        return summary
+
+    def reset(self):
+        with self._lock:
+            self._actions.clear()
+
+
+def _bucket_label(i):
+    return f'<{2 ** i}us' if i < BUCKETS - 1 else f'>={2 ** (i - 1)}us'
+
+
+def _percentile(hist, count, q):
+    rank = q * count
+    seen = 0
+    for i, n in enumerate(hist):
+        seen += n
+        if seen >= rank:
+            return 2 ** i
+    return 2 ** (BUCKETS - 1)
@@ -0,0 +1,122 @@
+import socket
+import threading
+from collections import deque, namedtuple
+
+from common.framing import FrameDecoder
+from common.protocol import WIRE_V1, WIRE_V2, V2Decoder
+
+# Events that may be dropped for a slow receiver instead of queuing them
+DROPPABLE_TYPES = ('typing_indicator', 'status_update')
+
+# Per-connection outbound limits in bytes:
+#   high  - above this, droppable events are discarded
+#   low   - droppable events are accepted again once the queue drains below this
+#   limit - a frame that would push the queue past this disconnects the client
+OutboundLimits = namedtuple('OutboundLimits', 'high low limit')
+DEFAULT_LIMITS = OutboundLimits(high=1024 * 1024, low=256 * 1024, limit=16 * 1024 * 1024)
+
+ADMIT, DROP, OVERFLOW = 'admit', 'drop', 'overflow'
+
+
+class FlowState:
+    # Watermark bookkeeping shared by every engine's connection type
+    def __init__(self, limits=DEFAULT_LIMITS):
+        self.limits = limits
+        self.paused = False
+        self.dropped = 0
+
+    def admit(self, depth, nbytes, droppable):
+        high, low, limit = self.limits
+        if self.paused and depth <= low:
+            self.paused = False
+        elif not self.paused and depth >= high:
+            self.paused = True
+        if droppable and self.paused:
+            self.dropped += 1
+            return DROP
+        if depth + nbytes > limit:
+            return OVERFLOW
+        return ADMIT
+
+
+class Connection:
+    # Base for every engine's connection type: the frame decoder and the
+    # negotiated wire version live on the connection.
+    wire_version = WIRE_V1
+
+    def upgrade(self, version):
+        if version == WIRE_V2 and self.wire_version != WIRE_V2:
+            self.decoder = V2Decoder.upgrade(self.decoder)
+        self.wire_version = version
+
+    def call_soon(self, fn):
+        # Run fn() on the thread that owns the socket; any thread may send on
+        # a ThreadedConnection, so here that is the caller's.
+        fn()
+
+
+class ThreadedConnection(Connection):
+    # Thread-engine connection: the reader thread calls recv(), any handler
+    # thread calls send() which only enqueues; a dedicated writer thread
+    # drains the queue so a slow receiver never blocks the sender.
+    def __init__(self, sock, address=None, limits=DEFAULT_LIMITS):
+        self.sock = sock
+        self.address = address
+        self.flow = FlowState(limits)
+        self.decoder = FrameDecoder()
+        self.closed = False
+        self._queue = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def recv(self, n):
+        return self.sock.recv(n)
+
+    def queue_depth(self):
+        return self._size
+
+    def send(self, data, droppable=False):
+        with self._cond:
+            if self.closed:
+                raise OSError('Connection closed')
+            verdict = self.flow.admit(self._size, len(data), droppable)
+            if verdict == ADMIT:
+                self._queue.append(data)
+                self._size += len(data)
+                self._cond.notify()
+                return len(data)
+        if verdict == OVERFLOW:
+            self.close()
+            raise OSError('Outbound queue overflow')
+        return 0
+
+    def close(self):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    break
+                batch = list(self._queue)
+                self._queue.clear()
+            try:
+                self.sock.sendall(b''.join(batch) if len(batch) > 1 else batch[0])
+            except OSError:
+                self.close()
+                break
+            with self._cond:
+                self._size -= sum(len(b) for b in batch)
+        self.sock.close()
@@ -0,0 +1,208 @@
+import os
+import selectors
+import socket
+import threading
+from collections import deque
+
+from common.framing import FrameDecoder
+from outbound import ADMIT, OVERFLOW, Connection, FlowState
+
+class ReactorConnection(Connection):
+    # Socket-like handle owned by exactly one Reactor. Only the owning reactor
+    # thread touches the socket; other threads go through its wakeup queue.
+    # outbuf is the outbound queue; its watermarks are checked on the owner thread.
+    def __init__(self, reactor, sock, address):
+        self.reactor = reactor
+        self.sock = sock
+        self.address = address
+        self.decoder = FrameDecoder()
+        self.outbuf = bytearray()
+        self.flow = FlowState(reactor.server.outbound_limits)
+        self.closed = False
+
+    def queue_depth(self):
+        return len(self.outbuf)
+
+    def send(self, data, droppable=False):
+        if self.closed:
+            raise OSError('Connection closed')
+        if threading.current_thread() is self.reactor:
+            self.reactor.write(self, data, droppable)
+        else:
+            self.reactor.post(('send', self, (data, droppable)))
+        return len(data)
+
+    def call_soon(self, fn):
+        if threading.current_thread() is self.reactor:
+            fn()
+        else:
+            self.reactor.post(('call', fn, None))
+
+    def close(self):
+        if threading.current_thread() is self.reactor:
+            self.reactor.drop(self)
+        else:
+            self.reactor.post(('close', self, None))
+
+
+class Reactor(threading.Thread):
+    def __init__(self, server, index):
+        super().__init__(name=f'reactor-{index}', daemon=True)
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        self.queue = deque()            # cross-thread commands, drained on wakeup
+        self.conns = set()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._woken = False
+        self.selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    @property
+    def load(self):
+        return len(self.conns)
+
+    # --- called from other threads ---
+    def post(self, cmd):
+        self.queue.append(cmd)
+        if not self._woken:
+            self._woken = True
+            try:
+                self._wake_w.send(b'\0')
+            except BlockingIOError:
+                pass
+
+    def adopt(self, sock, address):
+        sock.setblocking(False)
+        self.post(('add', sock, address))
+
+    # --- reactor thread only ---
+    def run(self):
+        while self.server.running:
+            for key, events in self.selector.select():
+                conn = key.data
+                if conn is None:
+                    self._drain_queue()
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._on_readable(conn)
+                if events & selectors.EVENT_WRITE and not conn.closed:
+                    self._flush(conn)
+
+    def _drain_queue(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        self._woken = False
+        while self.queue:
+            op, target, arg = self.queue.popleft()
+            if op == 'add':
+                conn = ReactorConnection(self, target, arg)
+                self.conns.add(conn)
+                self.selector.register(target, selectors.EVENT_READ, conn)
+            elif op == 'send':
+                if not target.closed:
+                    self.write(target, *arg)
+            elif op == 'close':
+                self.drop(target)
+            elif op == 'disconnect':
+                self.server.disconnect_client(target)
+            elif op == 'call':
+                target()
+
+    def _on_readable(self, conn):
+        try:
+            chunk = conn.sock.recv(conn.decoder.recv_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self.server.disconnect_client(conn)
+            self.drop(conn)
+            return
+        conn.decoder.adapt(len(chunk))
+        try:
+            for line in conn.decoder.feed(chunk):
+                if conn.closed:
+                    break
+                self.server.handle_frame(conn, line)
+        except Exception:
+            self.server.disconnect_client(conn)
+
+    def write(self, conn, data, droppable=False):
+        verdict = conn.flow.admit(len(conn.outbuf), len(data), droppable)
+        if verdict != ADMIT:
+            if verdict == OVERFLOW:
+                # Close now, but unregister the user after the current handler
+                # has finished iterating server state.
+                self.drop(conn)
+                self.post(('disconnect', conn, None))
+            return
+        if conn.outbuf:
+            conn.outbuf += data
+            return
+        try:
+            sent = conn.sock.send(data)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.drop(conn)
+            return
+        if sent < len(data):
+            conn.outbuf += memoryview(data)[sent:]
+            self.selector.modify(conn.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, conn)
+
+    def _flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(conn)
+            return
+        del conn.outbuf[:sent]
+        if not conn.outbuf:
+            self.selector.modify(conn.sock, selectors.EVENT_READ, conn)
+
+    def drop(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.conns.discard(conn)
+        try:
+            self.selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+
+def run(server, reactors=None, balance='round_robin'):
+    count = reactors or os.cpu_count() or 1
+    pool = [Reactor(server, i) for i in range(count)]
+    for r in pool:
+        r.start()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((server.host, server.port))
+    listener.listen(1024)
+    print(f"Server listening on {server.host}:{server.port} ({count} reactors, {balance})")
+
+    turn = 0
+    while server.running:
+        try:
+            client, address = listener.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            break
+        print(f"Connected with {str(address)}")
+        if balance == 'least_loaded':
+            target = min(pool, key=lambda r: r.load)
+        else:
+            target = pool[turn % count]
+            turn += 1
+        target.adopt(client, address)
+    listener.close()
@@ -0,0 +1,144 @@
+import threading
+from array import array
+from bisect import bisect_right
+
+# Result tiers, best first: a term equal to the query, a term starting with
+# it, a term containing it.
+EXACT, PREFIX, SUBSTRING = 0, 1, 2
+PREFIX_LEN = 3      # longest indexed prefix; also the longest gram length
+SCAN_BATCH = 1024   # candidates copied per lock hold while searching
+
+
+def _grams(term, n=PREFIX_LEN):
+    return {term[i:i + n] for i in range(len(term) - n + 1)}
+
+
+def _all_grams(term):
+    # 1-, 2- and 3-grams, so queries shorter than a trigram have postings too
+    return set().union(*(_grams(term, n) for n in range(1, PREFIX_LEN + 1)))
+
+
+def _prefixes(term):
+    return {term[:n] for n in range(1, min(len(term), PREFIX_LEN) + 1)}
+
+
+class UserIndex:
+    # Search index over each user's lowercased username and nickname.
+    # Postings are arrays of uids appended in registration order, so they are
+    # normally sorted; a re-indexed user is appended out of order and the
+    # array is re-sorted on its next use. Entries are never removed from
+    # postings: every candidate is checked against its current terms, so a
+    # stale entry costs a lookup, never a wrong result.
+    # `lock` guards the tables; a search holds it only while it copies a
+    # batch of candidates, so writers are never held up for a whole search.
+    def __init__(self):
+        self.terms = {}     # {uid: tuple of distinct lowercase terms}
+        self.exact = {}     # {term: set(uid)}
+        self.prefixes = {}  # {1-3 char prefix: array of uids}
+        self.grams = {}     # {1-3 char gram: array of uids}
+        self._unsorted = set()  # (table name, key) of postings that need a sort
+        self._last = 0      # highest uid seen
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.terms)
+
+    def set(self, uid, *names):
+        """Index (or re-index) a user under the given names."""
+        terms = tuple(dict.fromkeys(str(n).lower() for n in names))
+        with self.lock:
+            self._set(uid, terms)
+
+    def _set(self, uid, terms):
+        old = self.terms.get(uid, ())
+        if terms == old:
+            return
+        for term in old:
+            if term not in terms:
+                holders = self.exact[term]
+                holders.discard(uid)
+                if not holders:
+                    del self.exact[term]
+        for term in terms:
+            self.exact.setdefault(term, set()).add(uid)
+        self._post('prefixes', uid, _prefixes, terms, old)
+        self._post('grams', uid, _all_grams, terms, old)
+        self.terms[uid] = terms
+        self._last = max(self._last, uid)
+
+    def _post(self, name, uid, keys_of, terms, old):
+        table = getattr(self, name)
+        had = set().union(*(keys_of(t) for t in old))
+        for key in set().union(*(keys_of(t) for t in terms)) - had:
+            postings = table.get(key)
+            if postings is None:
+                postings = table[key] = array('I')
+            if postings and postings[-1] > uid:
+                self._unsorted.add((name, key))
+            postings.append(uid)
+
+    def _postings(self, name, key):
+        table = getattr(self, name)
+        postings = table.get(key)
+        if postings is None:
+            return ()
+        if (name, key) in self._unsorted:
+            self._unsorted.discard((name, key))
+            postings = table[key] = array('I', sorted(set(postings)))
+        return postings
+
+    def _candidates(self, tier, query, after):
+        # Ascending uids above `after` that may fall in `tier`, copied out
+        # SCAN_BATCH at a time under the lock
+        if tier == EXACT:
+            with self.lock:
+                batch = sorted(uid for uid in self.exact.get(query, ()) if uid > after)
+            yield from batch
+            return
+        while True:
+            with self.lock:
+                # A prefix match also contains every gram of the query, so the
+                # shortest of those postings is the candidate list for both tiers
+                options = [self._postings('grams', g) for g in _grams(query, min(len(query), PREFIX_LEN))] if query else []
+                if tier == PREFIX and query:
+                    options.append(self._postings('prefixes', query[:PREFIX_LEN]))
+                if options:
+                    postings = min(options, key=len)
+                    start = bisect_right(postings, after)
+                    batch = postings[start:start + SCAN_BATCH]
+                else:   # empty query: every uid
+                    batch = range(after + 1, min(after + SCAN_BATCH, self._last) + 1)
+            if not batch:
+                return
+            yield from batch
+            after = batch[-1]
+
+    def _tier(self, uid, query):
+        terms = self.terms.get(uid)
+        if terms is None:
+            return None
+        if query in terms:
+            return EXACT
+        if any(t.startswith(query) for t in terms):
+            return PREFIX
+        if any(query in t for t in terms):
+            return SUBSTRING
+        return None
+
+    def search(self, query, limit, cursor=None):
+        """Up to `limit` uids matching `query`, best tier first and by uid
+        within a tier, plus the cursor for the next page (None when done).
+        A cursor is (tier, last uid returned)."""
+        query = query.lower()
+        tier, after = cursor or (EXACT, 0)
+        found = []
+        for t in range(tier, SUBSTRING + 1):
+            previous = None
+            for uid in self._candidates(t, query, after if t == tier else 0):
+                if uid == previous or self._tier(uid, query) != t:
+                    continue
+                previous = uid
+                found.append(uid)
+                if len(found) == limit:
+                    return found, (t, uid)
+        return found, None
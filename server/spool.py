@@ -0,0 +1,155 @@
+import json
+import mmap
+import os
+import threading
+import time
+import uuid
+
+DATA_SUFFIX = '.data'
+META_SUFFIX = '.json'
+
+
+class SpooledFile:
+    # One file in the spool: its bytes in <file_id>.data, preallocated to
+    # total_size, and once complete its metadata in <file_id>.json.
+    # Chunk `seq` covers bytes [seq * chunk_size, (seq + 1) * chunk_size).
+    def __init__(self, file_id, filename, total_size, chunk_size, sender,
+                 recipient=None, group_id=None, created=None):
+        self.file_id = file_id
+        self.filename = filename
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.sender = sender            # uid
+        self.recipient = recipient      # uid, for a private file
+        self.group_id = group_id        # for a group file
+        self.created = created if created is not None else time.time()
+        self.complete = False
+        self.fd = None                  # write handle while uploading
+        self.map = None                 # read-only mapping once complete, see FileSpool.read
+
+    @property
+    def chunks(self):
+        return -(-self.total_size // self.chunk_size)
+
+    def meta(self):
+        return {'file_id': self.file_id, 'filename': self.filename, 'total_size': self.total_size,
+                'chunk_size': self.chunk_size, 'sender': self.sender, 'recipient': self.recipient,
+                'group_id': self.group_id, 'created': self.created}
+
+
+class FileSpool:
+    # Content store for chunked transfers that recipients download later.
+    # Uploads are written at their chunk offsets as they arrive; complete
+    # files are served from a memory mapping one chunk at a time, so a
+    # download never holds more than a chunk of the file in Python memory.
+    # Complete files survive restarts; they, and unfinished uploads, are
+    # deleted after `ttl` seconds.
+    def __init__(self, root='spool', ttl=7 * 24 * 3600):
+        self.root = root
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._files = {}    # {file_id: SpooledFile}
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def create(self, filename, total_size, chunk_size, sender, recipient=None, group_id=None):
+        """Start an upload; returns its SpooledFile with a fresh file_id."""
+        f = SpooledFile(uuid.uuid4().hex, filename, total_size, chunk_size, sender, recipient, group_id)
+        f.fd = os.open(self._path(f.file_id, DATA_SUFFIX), os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.ftruncate(f.fd, total_size)
+        with self._lock:
+            self._expire()
+            self._files[f.file_id] = f
+        return f
+
+    def write(self, f, seq, data):
+        """Store chunk `seq` of an upload; False if it falls outside the file."""
+        offset = seq * f.chunk_size
+        if f.fd is None or seq < 0 or len(data) > f.chunk_size or offset + len(data) > f.total_size:
+            return False
+        os.pwrite(f.fd, data, offset)
+        return True
+
+    def finish(self, f):
+        """Mark an upload complete and make it downloadable."""
+        os.close(f.fd)
+        f.fd = None
+        tmp = self._path(f.file_id, META_SUFFIX + '.tmp')
+        with open(tmp, 'w') as out:
+            json.dump(f.meta(), out)
+        os.replace(tmp, self._path(f.file_id, META_SUFFIX))
+        f.complete = True
+
+    def discard(self, f):
+        with self._lock:
+            self._files.pop(f.file_id, None)
+        self._delete(f)
+
+    def get(self, file_id):
+        """The complete file `file_id`, or None."""
+        with self._lock:
+            f = self._files.get(file_id)
+        return f if f is not None and f.complete else None
+
+    def read(self, f, seq):
+        """Bytes of chunk `seq` of a complete file."""
+        if f.map is None:
+            with self._lock:
+                if f.map is None and f.total_size:
+                    with open(self._path(f.file_id, DATA_SUFFIX), 'rb') as data:
+                        f.map = mmap.mmap(data.fileno(), 0, access=mmap.ACCESS_READ)
+        if f.map is None:
+            return b''
+        start = seq * f.chunk_size
+        return f.map[start:start + f.chunk_size]
+
+    def close(self):
+        with self._lock:
+            files = list(self._files.values())
+            self._files.clear()
+        for f in files:
+            self._release(f)
+
+    # --- internals ---
+    def _path(self, file_id, suffix):
+        return os.path.join(self.root, file_id + suffix)
+
+    def _release(self, f):
+        if f.fd is not None:
+            os.close(f.fd)
+            f.fd = None
+        if f.map is not None:
+            f.map.close()
+            f.map = None
+
+    def _delete(self, f):
+        self._release(f)
+        for suffix in (DATA_SUFFIX, META_SUFFIX):
+            try:
+                os.remove(self._path(f.file_id, suffix))
+            except FileNotFoundError:
+                pass
+
+    def _load(self):
+        # Complete files from a previous run; data without metadata is an
+        # upload that never finished
+        names = os.listdir(self.root)
+        for name in names:
+            if name.endswith(META_SUFFIX):
+                with open(os.path.join(self.root, name)) as meta:
+                    f = SpooledFile(**json.load(meta))
+                f.complete = True
+                self._files[f.file_id] = f
+        for name in names:
+            file_id, suffix = os.path.splitext(name)
+            if file_id not in self._files and suffix in (DATA_SUFFIX, '.tmp'):
+                os.remove(os.path.join(self.root, name))
+        self._expire()
+
+    def _expire(self):
+        # Lock held (or startup); runs on each create, which is rare next to
+        # chunk traffic. Files being written or read are left for a later pass.
+        cutoff = time.time() - self.ttl
+        for f in [f for f in self._files.values() if f.created < cutoff and f.fd is None and f.map is None]:
+            del self._files[f.file_id]
+            self._delete(f)
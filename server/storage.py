@@ -0,0 +1,169 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (uid INTEGER PRIMARY KEY, username TEXT NOT NULL UNIQUE, profile TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS contacts (uid INTEGER NOT NULL, contact INTEGER NOT NULL, PRIMARY KEY (uid, contact));
+CREATE TABLE IF NOT EXISTS groups (group_id TEXT PRIMARY KEY, name TEXT, admin INTEGER);
+CREATE TABLE IF NOT EXISTS members (group_id TEXT NOT NULL, uid INTEGER NOT NULL, PRIMARY KEY (group_id, uid));
+'''
+
+
+class MemoryStore:
+    # The storage interface; this implementation keeps nothing, so state
+    # lives only in ChatServer's dicts. Write methods are called with the
+    # server's locks held and must not block.
+    persistent = False      # whether users and groups (and so their ids) survive a restart
+
+    def load(self):
+        """(users, contacts, groups, members) rows saved by a previous run."""
+        return [], [], [], []
+
+    def put_user(self, uid, username, profile):
+        pass
+
+    def put_profile(self, uid, profile):
+        pass
+
+    def rename_user(self, uid, username):
+        pass
+
+    def add_contact(self, uid, contact):
+        pass
+
+    def remove_contact(self, uid, contact):
+        pass
+
+    def put_group(self, group_id, name, admin):
+        pass
+
+    def add_member(self, group_id, uid):
+        pass
+
+    def remove_member(self, group_id, uid):
+        pass
+
+    def flush(self):
+        """Block until every write issued so far is committed."""
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(MemoryStore):
+    # Write-behind SQLite store. Write methods only queue a statement; a
+    # writer thread commits whatever has queued up in one transaction, at
+    # most batch_size statements at a time, so handlers never wait on disk.
+    # WAL mode lets those commits append to the log instead of rewriting pages.
+    persistent = True
+
+    def __init__(self, path='chat.db', batch_size=5000, linger=0.005):
+        self.path = path
+        self.batch_size = batch_size
+        self.linger = linger        # seconds to let a batch fill after the first write
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(SCHEMA)
+        self.committed = 0          # statements committed so far
+        self.errors = 0
+        self._queue = deque()
+        self._queued = 0            # statements queued so far
+        self._cond = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, name='store-writer', daemon=True)
+        self._writer.start()
+
+    def load(self):
+        # Called once at startup, before any write, so the writer thread is idle
+        return (self.db.execute('SELECT uid, username, profile FROM users ORDER BY uid').fetchall(),
+                self.db.execute('SELECT uid, contact FROM contacts').fetchall(),
+                self.db.execute('SELECT group_id, name, admin FROM groups').fetchall(),
+                self.db.execute('SELECT group_id, uid FROM members ORDER BY rowid').fetchall())
+
+    def _submit(self, sql, params):
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('Store is closed')
+            self._queue.append((sql, params))
+            self._queued += 1
+            if len(self._queue) == 1:
+                self._cond.notify_all()
+
+    def put_user(self, uid, username, profile):
+        self._submit('INSERT OR REPLACE INTO users (uid, username, profile) VALUES (?, ?, ?)',
+                     (uid, username, json.dumps(profile)))
+
+    def put_profile(self, uid, profile):
+        self._submit('UPDATE users SET profile = ? WHERE uid = ?', (json.dumps(profile), uid))
+
+    def rename_user(self, uid, username):
+        self._submit('UPDATE users SET username = ? WHERE uid = ?', (username, uid))
+
+    def add_contact(self, uid, contact):
+        self._submit('INSERT OR IGNORE INTO contacts (uid, contact) VALUES (?, ?)', (uid, contact))
+
+    def remove_contact(self, uid, contact):
+        self._submit('DELETE FROM contacts WHERE uid = ? AND contact = ?', (uid, contact))
+
+    def put_group(self, group_id, name, admin):
+        self._submit('INSERT OR REPLACE INTO groups (group_id, name, admin) VALUES (?, ?, ?)',
+                     (group_id, name, admin))
+
+    def add_member(self, group_id, uid):
+        self._submit('INSERT OR IGNORE INTO members (group_id, uid) VALUES (?, ?)', (group_id, uid))
+
+    def remove_member(self, group_id, uid):
+        self._submit('DELETE FROM members WHERE group_id = ? AND uid = ?', (group_id, uid))
+
+    def flush(self):
+        with self._cond:
+            target = self._queued
+            while self.committed + self.errors < target and self._writer.is_alive():
+                self._cond.wait()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self.db.close()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    break
+            if self.linger and len(self._queue) < self.batch_size:
+                time.sleep(self.linger)
+            with self._cond:
+                batch = [self._queue.popleft() for _ in range(min(len(self._queue), self.batch_size))]
+            failed = self._commit(batch)
+            with self._cond:
+                self.committed += len(batch) - failed
+                self.errors += failed
+                self._cond.notify_all()
+
+    def _commit(self, batch):
+        # One transaction for the batch; if a statement fails, the halves are
+        # retried in order so only the failing statements are dropped.
+        # Returns the number of statements dropped.
+        try:
+            self.db.execute('BEGIN')
+            for sql, params in batch:
+                self.db.execute(sql, params)
+            self.db.execute('COMMIT')
+            return 0
+        except sqlite3.Error as e:
+            if self.db.in_transaction:
+                self.db.execute('ROLLBACK')
+            if len(batch) == 1:
+                print(f"Storage error, dropped write {batch[0][0].split()[0]}: {e}")
+                return 1
+        half = len(batch) // 2
+        return self._commit(batch[:half]) + self._commit(batch[half:])